@@ -0,0 +1,74 @@
+# %%
+"""Per-series overhead of the subprocess and inprocess dcm2bids backends.
+
+dcm2niix is replaced by a no-op stub, so the measured time is what each
+backend spends around the actual conversion (interpreter startup, imports,
+config loading, version checks).
+
+usage: python -m benchmarks.bench_backends [--series 20] [--jobs 1]
+"""
+
+import argparse
+import os
+import stat
+import tempfile
+import time
+from os.path import join as opj
+
+from benchmarks.synthetic import write_dicom
+from src.backends import BACKENDS
+from src.scheduler import Job, Scheduler
+
+
+def make_stub_dcm2niix(bin_dir):
+    path = opj(bin_dir, "dcm2niix")
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\nexit 0\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+
+def make_jobs(root, n_series, config):
+    jobs = []
+    for i in range(n_series):
+        directory = opj(root, "sourcedata", f"series{i:04d}")
+        os.makedirs(directory)
+        write_dicom(opj(directory, "IM00001"), f"P{i:04d}", 1024)
+        out_path = opj(root, "rawdata")
+        jobs.append(Job(directory, f"{i:05d}", "1", config, out_path, cost=1))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--series", type=int, default=20)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument(
+        "--config",
+        default=opj(os.path.dirname(__file__), "..", "configs", "example.json"),
+    )
+    args = parser.parse_args()
+    config = os.path.abspath(args.config)
+
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(opj(root, "bin"))
+        make_stub_dcm2niix(opj(root, "bin"))
+        timings = {}
+        for backend in BACKENDS:
+            jobs = make_jobs(opj(root, backend), args.series, config)
+            scheduler = Scheduler(args.jobs, backend)
+            t0 = time.monotonic()
+            results = scheduler.run(jobs)
+            timings[backend] = time.monotonic() - t0
+            failed = sum(r.returncode != 0 for r in results)
+            print(f"{backend:>10}: {failed} of {len(results)} jobs failed")
+
+    for backend, elapsed in timings.items():
+        print(
+            f"{backend:>10}: {elapsed:7.2f}s total, "
+            f"{elapsed / args.series * 1000:8.1f} ms per series"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# %%
+"""Header probing on a file server with latency: serial vs prefix buffer vs read-ahead.
+
+Every open and every read from the file system sleeps for --latency-ms, as
+a round trip to an NFS server would. Compares the previous serial probing
+through a buffered file, serial probing through the prefix buffer, and the
+Planner's read-ahead with several reads in flight.
+
+usage: python -m benchmarks.bench_header_io [--dirs 100] [--latency-ms 2]
+"""
+
+import argparse
+import io
+import os
+import tempfile
+import time
+from os.path import join as opj
+
+import src.probe
+from benchmarks.synthetic import make_participants, write_dicom
+from src.ids import preproc_ids
+from src.planner import Planner
+from src.probe import is_candidate, read_header
+from src.scan_index import ScanIndex
+
+CONFIG = opj(os.path.dirname(__file__), "..", "configs", "example.json")
+
+
+class SlowFileIO(io.FileIO):
+    latency = 0.0
+    calls = 0
+
+    def __init__(self, *args, **kwargs):
+        self._sleep()
+        super().__init__(*args, **kwargs)
+
+    def _sleep(self):
+        SlowFileIO.calls += 1
+        time.sleep(self.latency)
+
+    def readinto(self, b):
+        self._sleep()
+        return super().readinto(b)
+
+    def readall(self):
+        self._sleep()
+        return super().readall()
+
+
+def slow_open(path, mode="rb", buffering=-1):
+    raw = SlowFileIO(path, mode)
+    return raw if buffering == 0 else io.BufferedReader(raw)
+
+
+def make_tree(root, n_dirs, n_files, private_bytes):
+    for d in range(n_dirs):
+        directory = opj(root, f"pat{d:04d}", "series")
+        os.makedirs(directory, exist_ok=True)
+        for i in range(n_files):
+            write_dicom(
+                opj(directory, f"IM{i:05d}"),
+                f"P{d:04d}",
+                4096,
+                private_bytes=private_bytes,
+            )
+
+
+def walk(root):
+    for directory, _, filelist in os.walk(root):
+        if filelist:
+            yield directory, sorted(filelist)
+
+
+def probe_legacy(directory, filelist):
+    for f in filelist:
+        if not is_candidate(f):
+            continue
+        try:
+            with slow_open(opj(directory, f)) as fp:
+                dcm = read_header(fp)
+        except Exception:
+            continue
+        if dcm is not None:
+            return dcm
+    return None
+
+
+def run_serial(root, probe):
+    found = 0
+    for directory, filelist in walk(root):
+        found += probe(directory, filelist) is not None
+    return found
+
+
+def run_read_ahead(root, work, in_flight, read_ahead):
+    planner = Planner(
+        preproc_ids(make_participants(1)),
+        work,
+        CONFIG,
+        ScanIndex(work),
+        full_rescan=True,
+        probe_workers=in_flight,
+        read_ahead=read_ahead,
+    )
+    found = 0
+    for directory, filelist in planner.walk_ahead(walk(root)):
+        found += planner.reader.probe_directory(directory, filelist)[1] is not None
+    planner.reader.close()
+    planner.scan_index.close()
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dirs", type=int, default=100)
+    parser.add_argument("--files", type=int, default=2)
+    parser.add_argument("--private-kb", type=int, default=24)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    parser.add_argument("--in-flight", type=int, nargs="+", default=[4, 16])
+    parser.add_argument("--read-ahead", type=int, default=32)
+    args = parser.parse_args()
+
+    SlowFileIO.latency = args.latency_ms / 1000
+    src.probe.open = slow_open
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as work:
+        make_tree(root, args.dirs, args.files, args.private_kb * 1024)
+        cases = [
+            ("serial, buffered file", lambda: run_serial(root, probe_legacy)),
+            (
+                "serial, prefix buffer",
+                lambda: run_serial(root, src.probe.probe_directory),
+            ),
+        ] + [
+            (
+                f"read-ahead {args.read_ahead}, {n} in flight",
+                lambda n=n: run_read_ahead(root, work, n, args.read_ahead),
+            )
+            for n in args.in_flight
+        ]
+        print(f"{args.dirs} directories, {args.latency_ms} ms per open and read")
+        for name, func in cases:
+            SlowFileIO.calls = 0
+            t0 = time.perf_counter()
+            found = func()
+            seconds = time.perf_counter() - t0
+            print(
+                f"{name:>28}: {seconds:7.3f}s, {found} headers, "
+                f"{SlowFileIO.calls / max(found, 1):.1f} round trips per header"
+            )
+
+
+if __name__ == "__main__":
+    main()
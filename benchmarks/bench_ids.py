@@ -0,0 +1,72 @@
+# %%
+"""Timing of the id column normalization on synthetic participants tables.
+
+Compares the per-cell Series.apply parsing used before with the vectorized
+preproc_ids/ids2string and the long-form id table.
+
+usage: python -m benchmarks.bench_ids [--rows 1000 10000 50000]
+"""
+
+import argparse
+import ast
+import time
+
+import pandas as pd
+
+from benchmarks.synthetic import make_participants
+from src.ids import ID_COLUMNS, ids2string, ids_long, preproc_ids
+
+
+def conv2idArray(s):
+    """Parse a single id cell into a list of id strings, as done per cell before"""
+    if not isinstance(s, str) and pd.isna(s):
+        return []
+    try:
+        idAr = ast.literal_eval(str(s).strip())
+    except (ValueError, SyntaxError):
+        return [t.strip() for t in str(s).split(",") if t.strip()]
+    if not isinstance(idAr, (list, tuple)):
+        idAr = [idAr]
+    return [str(x) for x in idAr]
+
+
+def legacy_preproc_ids(df):
+    for column in ID_COLUMNS:
+        df[column] = df[column].apply(lambda x: conv2idArray(x))
+    return df
+
+
+def legacy_ids2string(df):
+    for column in ID_COLUMNS:
+        df[column] = df[column].apply(lambda x: ",".join(x))
+    return df
+
+
+def timed(func, df):
+    t0 = time.perf_counter()
+    out = func(df)
+    return out, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 50000])
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'step':>12} {'per-cell [s]':>14} {'vectorized [s]':>16}")
+    for n_rows in args.rows:
+        df = make_participants(n_rows)
+        legacy, t_legacy = timed(legacy_preproc_ids, df.copy())
+        vectorized, t_vec = timed(preproc_ids, df.copy())
+        print(f"{n_rows:>8} {'preproc_ids':>12} {t_legacy:>14.3f} {t_vec:>16.3f}")
+
+        _, t_legacy = timed(legacy_ids2string, legacy)
+        _, t_vec = timed(ids2string, vectorized.copy())
+        print(f"{n_rows:>8} {'ids2string':>12} {t_legacy:>14.3f} {t_vec:>16.3f}")
+
+        _, t_long = timed(ids_long, vectorized)
+        print(f"{n_rows:>8} {'ids_long':>12} {'':>14} {t_long:>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# %%
+"""Cost of adding many new subjects in one run.
+
+Compares growing the participants DataFrame row by row with _append, as
+done before, with the buffered ParticipantTable used by the Planner. The
+buffered version should stay close to linear: the time per subject does not
+grow with the number of subjects.
+
+usage: python -m benchmarks.bench_participants [--new 5000 10000 20000]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from os.path import join as opj
+
+from benchmarks.synthetic import make_participants
+from src.ids import ids2string, preproc_ids
+from src.participant_index import NOT_FOUND
+from src.participant_table import write_tsv
+from src.planner import Planner
+
+CONFIG = opj(os.path.dirname(__file__), "..", "configs", "example.json")
+
+
+def legacy_add(participants, n_new):
+    for i in range(n_new):
+        info = {
+            "participant_id": f"sub-new{i:06d}",
+            "osepa_id": [],
+            "lab_id": [],
+            "neurorad_id": [],
+            "dcm_header_id": [f"N{i:06d}"],
+        }
+        participants = participants._append(info, ignore_index=True)
+    return participants
+
+
+def buffered_add(participants, n_new):
+    planner = Planner(participants, tempfile.gettempdir(), CONFIG, None)
+    for i in range(n_new):
+        planner._assign("", f"N{i:06d}", NOT_FOUND)
+    return planner.participants
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000, help="existing subjects")
+    parser.add_argument("--new", type=int, nargs="+", default=[5000, 10000, 20000])
+    parser.add_argument(
+        "--legacy-max",
+        type=int,
+        default=10000,
+        help="skip the quadratic version above this many new subjects",
+    )
+    args = parser.parse_args()
+
+    print(f"{'new':>8} {'append [s]':>11} {'buffered [s]':>13} {'us/subject':>11}")
+    for n_new in args.new:
+        participants = preproc_ids(make_participants(args.rows))
+        t_legacy = float("nan")
+        if n_new <= args.legacy_max:
+            t0 = time.perf_counter()
+            legacy_add(participants.copy(), n_new)
+            t_legacy = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        result = buffered_add(participants.copy(), n_new)
+        t_buffered = time.perf_counter() - t0
+        assert len(result) == args.rows + n_new
+        print(
+            f"{n_new:>8} {t_legacy:>11.2f} {t_buffered:>13.2f} "
+            f"{t_buffered / n_new * 1e6:>11.1f}"
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        t0 = time.perf_counter()
+        write_tsv(ids2string(result), opj(tmp, "participants.tsv"))
+        print(f"atomic write of {len(result)} rows: {time.perf_counter() - t0:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
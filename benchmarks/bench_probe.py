@@ -0,0 +1,123 @@
+# %%
+"""Bytes read per directory when probing for dicoms: full read vs header only.
+
+usage: python -m benchmarks.bench_probe [--dirs 20] [--files 5] [--frame-mb 16]
+"""
+
+import argparse
+import os
+import tempfile
+from os.path import join as opj
+
+import pydicom as pydi
+
+from benchmarks.synthetic import write_dicom
+from src.probe import SPECIFIC_TAGS, is_candidate, read_header
+
+
+class CountingFile:
+    """Minimal binary file wrapper that counts the bytes handed to the reader"""
+
+    def __init__(self, path, counter):
+        self._fp = open(path, "rb")
+        self._counter = counter
+        self.name = path
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self._counter[0] += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        return self._fp.seek(offset, whence)
+
+    def tell(self):
+        return self._fp.tell()
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def make_tree(root, n_dirs, n_files, frame_bytes):
+    for d in range(n_dirs):
+        directory = opj(root, f"pat{d:04d}", "series")
+        os.makedirs(directory, exist_ok=True)
+        # a non dicom file with an empty extension, as found in PACS exports
+        with open(opj(directory, "DICOMDIR_NOTES"), "wb") as f:
+            f.write(os.urandom(4096))
+        for i in range(n_files):
+            write_dicom(opj(directory, f"IM{i:05d}"), f"P{d:04d}", frame_bytes)
+
+
+def probe_full(directory, filelist, counter):
+    # previous behaviour: full read until one succeeds, then a second full read
+    for f in filelist:
+        if not is_candidate(f):
+            continue
+        try:
+            with CountingFile(opj(directory, f), counter) as fp:
+                pydi.dcmread(fp)
+        except Exception:
+            continue
+        with CountingFile(opj(directory, f), counter) as fp:
+            return pydi.dcmread(fp)
+    return None
+
+
+def probe_header(directory, filelist, counter):
+    for f in filelist:
+        if not is_candidate(f):
+            continue
+        try:
+            with CountingFile(opj(directory, f), counter) as fp:
+                dcm = read_header(fp, SPECIFIC_TAGS)
+        except Exception:
+            continue
+        if dcm is not None:
+            return dcm
+    return None
+
+
+def run(root):
+    results = {}
+    for name, probe in [("full", probe_full), ("header", probe_header)]:
+        per_dir = []
+        for directory, _, filelist in os.walk(root):
+            if not filelist:
+                continue
+            counter = [0]
+            probe(directory, sorted(filelist), counter)
+            per_dir.append(counter[0])
+        results[name] = per_dir
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dirs", type=int, default=20)
+    parser.add_argument("--files", type=int, default=5)
+    parser.add_argument("--frame-mb", type=float, default=16)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, args.dirs, args.files, int(args.frame_mb * 2**20))
+        results = run(root)
+
+    for name, per_dir in results.items():
+        mean = sum(per_dir) / max(len(per_dir), 1)
+        print(
+            f"{name:>7}: {len(per_dir)} dirs, {mean / 2**20:10.3f} MiB read per "
+            f"directory, {sum(per_dir) / 2**20:10.3f} MiB total"
+        )
+    ratio = sum(results["full"]) / max(sum(results["header"]), 1)
+    print(f"header only probing reads {ratio:.0f}x fewer bytes")
+
+
+if __name__ == "__main__":
+    main()
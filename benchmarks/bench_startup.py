@@ -0,0 +1,100 @@
+# %%
+"""Startup time of the cvt2bids command line, checked against a budget.
+
+Runs `cvt2bids --help` the way the console script does, under `python -X
+importtime`, in fresh interpreters and reports the cumulative import time of
+src.cvt2bids, the wall time of the whole command and the slowest imports. Exits with 1 if the import time is
+over --budget-ms or one of the heavy modules, which only the conversion
+stages need, is imported before the arguments are parsed.
+
+usage: python -m benchmarks.bench_startup [--budget-ms 60] [--repeat 5]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+# as the console script, with -m the module would run as __main__ and not be timed
+COMMAND = [
+    "-c",
+    "import sys; sys.argv = ['cvt2bids', '--help'];"
+    "from src.cvt2bids import main_wrapper; sys.exit(main_wrapper())",
+]
+# imported by the stages using them, never while parsing arguments
+HEAVY_MODULES = [
+    "pandas",
+    "numpy",
+    "pydicom",
+    "dcm2bids",
+    "multiprocessing",
+    "asyncio",
+    "pkg_resources",
+]
+
+
+def parse_importtime(stderr):
+    """{module: (self_us, cumulative_us)} from the -X importtime output"""
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def run_once(command=COMMAND):
+    """Wall time in seconds and the import times of one fresh interpreter"""
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", *command],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise RuntimeError(f"{command} failed:\n{proc.stderr[-2000:]}")
+    return seconds, parse_importtime(proc.stderr)
+
+
+def measure(repeat=5, command=COMMAND):
+    """Best of repeat: wall seconds, import ms of src.cvt2bids and the import times"""
+    runs = [run_once(command) for _ in range(repeat)]
+    seconds = min(s for s, _ in runs)
+    times = min(runs, key=lambda run: run[1]["src.cvt2bids"][1])[1]
+    return seconds, times["src.cvt2bids"][1] / 1000, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budget-ms", type=float, default=60.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    seconds, import_ms, times = measure(args.repeat)
+    print(f"cvt2bids --help: {seconds * 1000:.1f} ms wall time")
+    print(f"import src.cvt2bids: {import_ms:.1f} ms (budget {args.budget_ms} ms)")
+    print("slowest imports (self time):")
+    for name, (self_us, cumulative_us) in sorted(
+        times.items(), key=lambda item: -item[1][0]
+    )[: args.top]:
+        print(f"{self_us / 1000:9.1f} ms {cumulative_us / 1000:9.1f} ms  {name}")
+
+    failed = False
+    heavy = [m for m in HEAVY_MODULES if m in times]
+    if heavy:
+        print("imported before parsing the arguments:", ", ".join(heavy))
+        failed = True
+    if import_ms > args.budget_ms:
+        print(f"over budget by {import_ms - args.budget_ms:.1f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
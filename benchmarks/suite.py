@@ -0,0 +1,260 @@
+# %%
+"""Benchmark suite on synthetic dicom trees and participants tables.
+
+Times discovery, header probing, series grouping, participant matching,
+preproc_ids, the sidecar harvest and a full cvt2bids run with a stub
+dcm2bids, so it runs offline. Every result is appended to a json lines file
+together with the current git commit; --compare prints the recorded results
+side by side per commit.
+
+usage: python -m benchmarks.suite [--patients 20] [--rows 1000 10000 100000]
+       python -m benchmarks.suite --compare
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import time
+from os.path import join as opj
+
+import pandas as pd
+
+from benchmarks.synthetic import (
+    LAYOUTS,
+    install_stubs,
+    make_participants,
+    make_sidecars,
+    make_tree,
+)
+from src.cvt2bids import find_corresponding_bids, main as cvt2bids_main
+from src.discovery import discover
+from src.grouping import group_directory
+from src.ids import preproc_ids
+from src.metrics import METRICS
+from src.participant_index import ParticipantIndex
+from src.probe import probe_directory
+from src.sidecars import harvest_sidecars
+
+RESULTS = opj(os.path.dirname(__file__), "results.jsonl")
+CONFIG = opj(os.path.dirname(__file__), "..", "configs", "example.json")
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("+" if dirty else "")
+
+
+def best_of(func, repeat):
+    """Minimum wall time of repeat calls and the result of the last one"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - t0)
+    return min(times), out
+
+
+def bench_discovery(root, repeat):
+    seconds, walked = best_of(lambda: list(discover(root)), repeat)
+    return seconds, {"dirs": len(walked), "files": sum(len(f) for _, f in walked)}
+
+
+def bench_probe(root, repeat):
+    walked = list(discover(root))
+    seconds, found = best_of(
+        lambda: [probe_directory(d, f)[0] is not None for d, f in walked], repeat
+    )
+    return seconds, {"dirs": len(walked), "with_dicom": sum(found)}
+
+
+def bench_grouping(root, repeat):
+    walked = list(discover(root))
+    seconds, groups = best_of(
+        lambda: [len(group_directory(d, f)) for d, f in walked], repeat
+    )
+    return seconds, {"dirs": len(walked), "series": sum(groups)}
+
+
+def lookup_ids(participants, n_lookups, seed=0):
+    """Half known header ids, half unknown ones"""
+    rng = random.Random(seed)
+    known = participants.lab_id.dropna().tolist() or ["X000000"]
+    ids = [rng.choice(known).split(",")[0].strip("[]' ") for _ in range(n_lookups)]
+    return [id_ if i % 2 else f"U{i:06d}" for i, id_ in enumerate(ids)]
+
+
+def bench_index_lookup(participants, ids, repeat):
+    def run():
+        index = ParticipantIndex(participants)
+        return [index.lookup(id_) for id_ in ids]
+
+    seconds, _ = best_of(run, repeat)
+    return seconds, {"lookups": len(ids)}
+
+
+def bench_find_corresponding_bids(participants, ids, repeat):
+    # the one-off helper builds its index on every call
+    seconds, _ = best_of(
+        lambda: [find_corresponding_bids(id_, participants) for id_ in ids], repeat
+    )
+    return seconds, {"lookups": len(ids)}
+
+
+def bench_preproc_ids(participants, repeat):
+    seconds, _ = best_of(lambda: preproc_ids(participants.copy()), repeat)
+    return seconds, {}
+
+
+def bench_harvest(out_path, participant_ids, repeat):
+    seconds, wide = best_of(lambda: harvest_sidecars(out_path, participant_ids), repeat)
+    return seconds, {"participants": len(wide)}
+
+
+def bench_end_to_end(root, work, jobs):
+    out_path = opj(work, "rawdata")
+    t0 = time.perf_counter()
+    cvt2bids_main(root, out_path, os.path.abspath(CONFIG), n_jobs=jobs)
+    seconds = time.perf_counter() - t0
+    counters = dict(METRICS.counters)
+    return seconds, {k: counters.get(k, 0) for k in ["dirs_walked", "jobs_run"]}
+
+
+def record(results, path):
+    with open(path, "a") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+
+def compare(path, last=5):
+    """Table of the recorded seconds, one column per commit"""
+    with open(path) as f:
+        df = pd.DataFrame([json.loads(line) for line in f])
+    df["case"] = df.benchmark + " " + df.params.apply(json.dumps)
+    commits = list(dict.fromkeys(df.commit))[-last:]
+    table = (
+        df[df.commit.isin(commits)]
+        .groupby(["case", "commit"], sort=False)
+        .seconds.min()
+        .unstack("commit")
+        .reindex(columns=commits)
+    )
+    with pd.option_context("display.width", 200, "display.max_colwidth", 80):
+        print(table.round(4).to_string())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--sessions", type=int, default=2)
+    parser.add_argument("--series", type=int, default=3)
+    parser.add_argument("--slices", type=int, default=10)
+    parser.add_argument("--frame-kb", type=int, default=64)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--lookups", type=int, default=1000)
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--results", default=RESULTS)
+    parser.add_argument("--no-record", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare(args.results)
+
+    logging.basicConfig(level=logging.WARNING)
+    commit = git_commit()
+    date = time.strftime("%Y-%m-%dT%H:%M:%S")
+    results = []
+
+    def report(benchmark, params, seconds, extra):
+        results.append(
+            {
+                "commit": commit,
+                "date": date,
+                "benchmark": benchmark,
+                "params": params,
+                "seconds": seconds,
+                **extra,
+            }
+        )
+        print(f"{benchmark:>24} {json.dumps(params):<60} {seconds:9.4f}s {extra}")
+
+    tree = {
+        "patients": args.patients,
+        "sessions": args.sessions,
+        "series": args.series,
+        "slices": args.slices,
+    }
+    with tempfile.TemporaryDirectory() as work:
+        install_stubs(opj(work, "bin"))
+        for layout in LAYOUTS:
+            for compressed in (False, True):
+                params = dict(tree, layout=layout, compressed=compressed)
+                root = opj(work, f"{layout}_{int(compressed)}")
+                make_tree(
+                    root,
+                    **tree,
+                    layout=layout,
+                    compressed=compressed,
+                    frame_bytes=args.frame_kb * 1024,
+                )
+                report("discovery", params, *bench_discovery(root, args.repeat))
+                report("probe", params, *bench_probe(root, args.repeat))
+                report("group_series", params, *bench_grouping(root, args.repeat))
+
+        root = opj(work, "nested_0")
+        params = dict(tree, layout="nested", jobs=args.jobs)
+        report("end_to_end", params, *bench_end_to_end(root, work, args.jobs))
+
+        for n_rows in args.rows:
+            participants = make_participants(n_rows)
+            ids = lookup_ids(participants, args.lookups)
+            params = {"rows": n_rows}
+            report("preproc_ids", params, *bench_preproc_ids(participants, args.repeat))
+            prepared = preproc_ids(participants.copy())
+            report(
+                "index_lookup",
+                dict(params, lookups=len(ids)),
+                *bench_index_lookup(prepared, ids, args.repeat),
+            )
+            # one index build per call, a few calls are enough to see the trend
+            report(
+                "find_corresponding_bids",
+                dict(params, lookups=10),
+                *bench_find_corresponding_bids(prepared, ids[:10], 1),
+            )
+
+        sidecars = opj(work, "sidecars")
+        n_participants = args.patients * 10
+        make_sidecars(sidecars, n_participants, args.sessions, args.series)
+        participant_ids = [f"sub-{p + 1:05d}" for p in range(n_participants)]
+        report(
+            "harvest_sidecars",
+            {"participants": n_participants, "sessions": args.sessions},
+            *bench_harvest(sidecars, participant_ids, args.repeat),
+        )
+
+    if not args.no_record:
+        record(results, args.results)
+        print("results appended to", args.results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# %%
+"""Synthetic dicom trees, participants tables and a stub dcm2bids for the benchmarks."""
+
+import json
+import os
+import random
+import stat
+from os.path import join as opj
+
+import numpy as np
+import pandas as pd
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, generate_uid
+
+from src.ids import ID_COLUMNS
+
+LAYOUTS = ["nested", "flat"]
+
+
+def write_dicom(
+    path,
+    patient_id,
+    frame_bytes,
+    study_uid=None,
+    series_uid=None,
+    instance_number=1,
+    date="20200101",
+    compressed=False,
+    private_bytes=0,
+):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4.1"  # enhanced MR
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.preamble = b"\0" * 128
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid or generate_uid()
+    ds.SeriesInstanceUID = series_uid or generate_uid()
+    ds.InstanceNumber = instance_number
+    ds.PatientID = patient_id
+    ds.PatientName = "Doe^" + patient_id
+    ds.PatientBirthDate = "19700101"
+    ds.PatientSex = "O"
+    ds.InstitutionName = "bench"
+    ds.StudyDate = date
+    ds.SeriesDate = date
+    ds.AcquisitionDate = date
+    ds.Modality = "MR"
+    if private_bytes:
+        # vendor private header of many small elements, which a reader has
+        # to step through element by element
+        block = ds.private_block(0x0029, "BENCH PRIVATE", create=True)
+        n_elements = min(240, max(private_bytes // 128, 1))
+        for i in range(n_elements):
+            block.add_new(0x10 + i, "OB", os.urandom(private_bytes // n_elements))
+    ds.Rows = 512
+    ds.Columns = max(frame_bytes // (512 * 2), 1)
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    # constant rows, so run length encoding has something to compress
+    pixels = np.repeat(np.arange(ds.Rows, dtype=np.uint16), ds.Columns)
+    ds.PixelData = pixels.tobytes()
+    try:
+        if compressed:
+            ds.compress(RLELossless, pixels.reshape(ds.Rows, ds.Columns))
+        ds.save_as(path, enforce_file_format=True)
+    except TypeError:
+        # pydicom < 3
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(path, write_like_original=False)
+
+
+def make_tree(
+    root,
+    patients=10,
+    sessions=2,
+    series=3,
+    slices=5,
+    layout="nested",
+    compressed=False,
+    frame_bytes=2**16,
+):
+    """Write patients x sessions x series x slices dicoms below root.
+
+    nested: root/patXXXX/sesX/seriesX/IMXXXXX, one series per directory.
+    flat: all files in root, like a PACS export. Returns the number of files.
+    """
+    n_files = 0
+    for p in range(patients):
+        for s in range(sessions):
+            study_uid = generate_uid()
+            date = f"2020{s % 12 + 1:02d}01"
+            for r in range(series):
+                series_uid = generate_uid()
+                if layout == "flat":
+                    directory = root
+                    prefix = f"p{p:04d}s{s}r{r}_"
+                else:
+                    directory = opj(root, f"pat{p:04d}", f"ses{s}", f"series{r}")
+                    prefix = ""
+                os.makedirs(directory, exist_ok=True)
+                for i in range(slices):
+                    write_dicom(
+                        opj(directory, f"{prefix}IM{i:05d}"),
+                        f"P{p:04d}",
+                        frame_bytes,
+                        study_uid,
+                        series_uid,
+                        i + 1,
+                        date,
+                        compressed,
+                    )
+                    n_files += 1
+    return n_files
+
+
+def make_participants(n_rows, seed=0):
+    """participants.tsv like table with ids in all the formats found in the wild"""
+    rng = random.Random(seed)
+
+    def cell():
+        ids = [f"{rng.choice('ABCDEFX')}{rng.randrange(10**6):06d}" for _ in range(3)]
+        ids = ids[: rng.randrange(4)]
+        kind = rng.randrange(4)
+        if kind == 0 or not ids:
+            return np.nan
+        if kind == 1:
+            return str(ids)  # list literal
+        return ", ".join(ids) if kind == 2 else ",".join(ids)
+
+    data = {"participant_id": [f"sub-{i + 1:05d}" for i in range(n_rows)]}
+    for column in ID_COLUMNS:
+        data[column] = [cell() for _ in range(n_rows)]
+    return pd.DataFrame(data, dtype=object)
+
+
+def make_sidecars(out_path, n_participants, sessions=2, series=3):
+    """BIDS tree with nifti placeholders and json sidecars, like dcm2bids writes"""
+    for p in range(n_participants):
+        for s in range(sessions):
+            anat = opj(out_path, f"sub-{p + 1:05d}", f"ses-{s + 1}", "anat")
+            os.makedirs(anat, exist_ok=True)
+            for r in range(series):
+                name = f"sub-{p + 1:05d}_ses-{s + 1}_run-{r + 1}_T1w"
+                open(opj(anat, name + ".nii.gz"), "wb").close()
+                with open(opj(anat, name + ".json"), "w") as f:
+                    json.dump(
+                        {
+                            "PatientName": f"Doe^P{p:04d}",
+                            "PatientID": f"P{p:04d}",
+                            "PatientBirthDate": "19700101",
+                            "PatientSex": "O",
+                            "AcquisitionDateTime": "2020-01-01T00:00:00",
+                            "DeviceSerialNumber": "0",
+                            "EchoTime": 0.003,
+                            "RepetitionTime": 2.3,
+                            "SliceTiming": [0.1 * i for i in range(64)],
+                        },
+                        f,
+                    )
+
+
+STUB_DCM2BIDS = """#!/bin/sh
+# offline stand-in for dcm2bids: writes one nifti and sidecar per call
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -p) participant=$2; shift ;;
+        -s) session=$2; shift ;;
+        -o) out=$2; shift ;;
+    esac
+    shift
+done
+anat="$out/sub-$participant/ses-$session/anat"
+mkdir -p "$anat"
+name="sub-${participant}_ses-${session}_T1w"
+: > "$anat/$name.nii.gz"
+echo '{"PatientID": "'$participant'", "AcquisitionDateTime": "2020-01-01T00:00:00"}' > "$anat/$name.json"
+"""
+
+
+def install_stubs(bin_dir):
+    """Put no-op dcm2bids and dcm2niix executables first on PATH"""
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, script in [("dcm2bids", STUB_DCM2BIDS), ("dcm2niix", "#!/bin/sh\n")]:
+        path = opj(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
@@ -23,6 +23,7 @@ VERSION = "0.9.1"
 ENTRY_POINTS = {
     "console_scripts": [
         "cvt2bids = src.cvt2bids:main_wrapper",
+        "cvt2bids-structure = src.structure_dcms:main_wrapper",
     ],
 }
 AUTHOR = "Lennart Walger"
@@ -44,10 +45,9 @@ CLASSIFIERS = [
     "Operating System :: Microsoft :: Windows",
     "Operating System :: Unix",
     "Programming Language :: Python",
-    "Programming Language :: Python :: 3.6",
-    "Programming Language :: Python :: 3.7",
-    "Programming Language :: Python :: 3.8",
     "Programming Language :: Python :: 3.9",
+    "Programming Language :: Python :: 3.10",
+    "Programming Language :: Python :: 3.11",
     "Topic :: Scientific/Engineering",
     "Topic :: Scientific/Engineering :: Bio-Informatics",
     "Topic :: Scientific/Engineering :: Medical Science Apps.",
@@ -60,7 +60,7 @@ if __name__ == "__main__":
         version=VERSION,
         packages=find_packages(exclude=['data', 'figures', 'output', 'notebooks', 'build']),
         entry_points=ENTRY_POINTS,
-        python_requires=">=3.7",
+        python_requires=">=3.9",
         use_scm_version=True,
         setup_requires=['setuptools_scm'],
         install_requires=[
@@ -70,6 +70,7 @@ if __name__ == "__main__":
           'nii2dcm',
           'dcm2bids',
           'pandas',
+          'tqdm',
         ],
         include_package_data=True,
         author=AUTHOR,
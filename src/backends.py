@@ -0,0 +1,179 @@
+# %%
+import copy
+import functools
+import json
+import logging
+import os
+import sys
+import traceback
+from collections import OrderedDict
+
+# the cli only needs BACKENDS while parsing arguments, asyncio, multiprocessing
+# and the pairing code are imported by the backends using them
+logger = logging.getLogger(__name__)
+
+BACKENDS = ["subprocess", "inprocess"]
+
+# bytes of stderr kept per job for the journal
+STDERR_TAIL = 4096
+
+
+class SubprocessBackend:
+    """Run every job as its own dcm2bids console script process"""
+
+    def __init__(self, n_jobs):
+        self.n_jobs = n_jobs
+
+    async def execute(self, job):
+        """Returns the exit code and the tail of stderr, which is passed through"""
+        import asyncio
+
+        proc = await asyncio.create_subprocess_exec(
+            *job.cmd, stderr=asyncio.subprocess.PIPE
+        )
+        tail = b""
+        while True:
+            chunk = await proc.stderr.read(65536)
+            if not chunk:
+                break
+            sys.stderr.write(chunk.decode(errors="replace"))
+            tail = (tail + chunk)[-STDERR_TAIL:]
+        return await proc.wait(), tail.decode(errors="replace")
+
+    def close(self):
+        pass
+
+
+class InProcessBackend:
+    """Drive the dcm2bids API inside long-lived worker processes.
+
+    Workers import dcm2bids once and keep loaded config files, saving the
+    interpreter startup and imports that every dcm2bids call pays otherwise.
+    """
+
+    def __init__(self, n_jobs):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.n_jobs = n_jobs
+        # spawn, not fork: jobs are submitted while discovery threads are running
+        self.pool = ProcessPoolExecutor(
+            max_workers=n_jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+        )
+
+    async def execute(self, job):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.pool,
+            run_dcm2bids,
+            job.directory,
+            job.participant,
+            job.session,
+            job.config,
+            job.out_path,
+            job.force,
+        )
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def make_backend(name, n_jobs):
+    if name == "inprocess":
+        return InProcessBackend(n_jobs)
+    if name == "subprocess":
+        return SubprocessBackend(n_jobs)
+    raise ValueError(f"unknown backend {name}, choose from {BACKENDS}")
+
+
+# %% worker side of the inprocess backend
+_configs = {}
+_load_json = None
+
+
+def _cached_load_json(filename):
+    key = (str(filename), os.stat(filename).st_mtime_ns)
+    if key not in _configs:
+        _configs[key] = _load_json(filename)
+    # dcm2bids may modify the config while moving files
+    return copy.deepcopy(_configs[key])
+
+
+def _run_once(func):
+    done = set()
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        if args not in done:
+            done.add(args)
+            return func(*args)
+
+    return wrapper
+
+
+_matchers = {}
+
+
+def _cached_build_graph(self):
+    """SidecarPairing.build_graph with criteria compiled once per config"""
+    from .pairing import DescriptionMatcher
+
+    key = (
+        json.dumps(self.descriptions, sort_keys=True),
+        self.searchMethod,
+        self.caseSensitive,
+    )
+    if key not in _matchers:
+        _matchers[key] = DescriptionMatcher(
+            self.descriptions, self.searchMethod, self.caseSensitive
+        )
+    matcher = _matchers[key]
+    self.graph = OrderedDict(
+        (sidecar, [self.descriptions[i] for i in matcher.match(sidecar.data)])
+        for sidecar in self.sidecars
+    )
+    return self.graph
+
+
+def init_worker():
+    global _load_json
+    import dcm2bids.dcm2bids as d2b
+
+    # config files are only read in Dcm2bids.__init__, sidecars use their own import
+    _load_json = d2b.load_json
+    d2b.load_json = _cached_load_json
+    # the online version check and dcm2niix version call do not change between jobs
+    d2b.check_latest = _run_once(d2b.check_latest)
+    d2b.dcm2niix_version = functools.lru_cache(maxsize=None)(d2b.dcm2niix_version)
+    # match sidecars against precompiled criteria, memoized across jobs
+    d2b.SidecarPairing.build_graph = _cached_build_graph
+
+
+def run_dcm2bids(directory, participant, session, config, out_path, force=True):
+    from dcm2bids import Dcm2bids
+
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    try:
+        Dcm2bids(
+            directory,
+            participant,
+            config,
+            output_dir=out_path,
+            session=session,
+            forceDcm2niix=force,
+        ).run()
+        return 0, ""
+    except Exception:
+        logger.exception("%s: dcm2bids failed", directory)
+        return 1, traceback.format_exc()[-STDERR_TAIL:]
+    finally:
+        # every Dcm2bids instance adds a log file handler to the root logger
+        for handler in list(root.handlers):
+            if handler not in handlers:
+                root.removeHandler(handler)
+                handler.close()
@@ -0,0 +1,73 @@
+# %%
+from dataclasses import dataclass
+
+from .probe import probe_file
+
+# implicit VR little endian, assumed for files without file meta
+DEFAULT_TRANSFER_SYNTAX = "1.2.840.10008.1.2"
+
+UNCOMPRESSED_TRANSFER_SYNTAXES = {
+    "1.2.840.10008.1.2",  # implicit VR little endian
+    "1.2.840.10008.1.2.1",  # explicit VR little endian
+    "1.2.840.10008.1.2.2",  # explicit VR big endian
+}
+
+# compressed transfer syntaxes dcm2niix decodes itself (release builds come
+# with JPEG, JPEG-LS and JPEG 2000 decoders). Everything else, e.g. deflate,
+# 12 bit JPEG, HTJ2K or video, has to be decompressed before the conversion.
+DCM2NIIX_TRANSFER_SYNTAXES = UNCOMPRESSED_TRANSFER_SYNTAXES | {
+    "1.2.840.10008.1.2.4.50",  # JPEG baseline
+    "1.2.840.10008.1.2.4.57",  # JPEG lossless
+    "1.2.840.10008.1.2.4.70",  # JPEG lossless, first-order prediction
+    "1.2.840.10008.1.2.4.80",  # JPEG-LS lossless
+    "1.2.840.10008.1.2.4.81",  # JPEG-LS near lossless
+    "1.2.840.10008.1.2.4.90",  # JPEG 2000 lossless
+    "1.2.840.10008.1.2.4.91",  # JPEG 2000
+    "1.2.840.10008.1.2.5",  # RLE lossless
+}
+
+CLASSIFY_TAGS = ["NumberOfFrames"]
+
+
+@dataclass
+class DicomFile:
+    """A file recognized as dicom by its preamble, whatever its extension"""
+
+    path: str
+    transfer_syntax: str = DEFAULT_TRANSFER_SYNTAX
+    n_frames: int = 1
+
+    @property
+    def compressed(self):
+        return self.transfer_syntax not in UNCOMPRESSED_TRANSFER_SYNTAXES
+
+    @property
+    def needs_decompression(self):
+        """True if dcm2niix can not read the pixel data as it is"""
+        return self.transfer_syntax not in DCM2NIIX_TRANSFER_SYNTAXES
+
+
+def classify(path, dcm):
+    """DicomFile of a header read by probe_file, transfer syntax from the file meta"""
+    file_meta = getattr(dcm, "file_meta", None)
+    transfer_syntax = str(
+        getattr(file_meta, "TransferSyntaxUID", None) or DEFAULT_TRANSFER_SYNTAX
+    )
+    try:
+        n_frames = max(int(dcm.get("NumberOfFrames") or 1), 1)
+    except (TypeError, ValueError):
+        n_frames = 1
+    return DicomFile(path, transfer_syntax, n_frames)
+
+
+def classify_file(path, specific_tags=()):
+    """(DicomFile, header with specific_tags) of path, (None, None) if it is no dicom.
+
+    The header is read through probe_file, so only the leading bytes of the
+    file are read and files without the dicom preamble are rejected
+    without parsing them.
+    """
+    dcm = probe_file(path, list(specific_tags) + CLASSIFY_TAGS)
+    if dcm is None:
+        return None, None
+    return classify(path, dcm), dcm
@@ -1,81 +1,38 @@
 # %%
 import os
 import sys
-import pandas as pd
 import subprocess
-import numpy as np
-import multiprocessing
 from os.path import join as opj
 import argparse
-import pydicom as pydi
-import glob
-from pkg_resources import require
-import json
-import re
+import logging
 
-import dcm2bids
+# only what is needed to parse the arguments is imported here, pandas,
+# pydicom, dcm2bids and the scheduler are imported by the stages using them
+from .backends import BACKENDS
+from .discovery import DEFAULT_IN_FLIGHT, DEFAULT_READ_AHEAD, DEFAULT_WORKERS
+from .metrics import METRICS, PROFILERS, profiled, setup_logging
+from .watch import DEFAULT_POLL_INTERVAL, DEFAULT_QUIESCENCE, DEFAULT_WRITE_INTERVAL
 
+logger = logging.getLogger(__name__)
 
-# %%
-def find_corresponding_bids(id_, df):
-    id_names = [
-        x
-        for x in df.columns
-        if x in ["osepa_id", "lab_id", "neurorad_id", "dcm_header_id"]
-    ]
+METRICS_NAME = "metrics.jsonl"
 
-    for _, r in df.iterrows():
-        for m in [r[id_name] for id_name in id_names]:
-            if str(id_).strip() in m:
-                return r.participant_id
 
-    for _, r in df.iterrows():
-        if str(id_).strip() == str(r.participant_id):
-            return r.participant_id
+# %%
+def find_corresponding_bids(id_, df):
+    from .participant_index import ParticipantIndex
 
-    # print(id)
-    return str(-1)
+    # one-off lookup, main() keeps a ParticipantIndex for the whole walk
+    return ParticipantIndex(df).lookup(id_)
 
 
 def start_proc(cmd_list):
+    returncodes = []
     for cdm in cmd_list:
-        print("Running:", cdm)
+        logger.info("Running: %s", cdm)
         proc = subprocess.Popen(cdm)
-        proc.wait()
-
-
-def conv2idArray(s):
-    try:
-        idAr = eval(s)
-        if type(idAr) != list:
-            idAr = [str(idAr)]
-        return idAr
-    except:
-        return [t.strip() for t in str(s).split(",")] if s is not np.nan else []
-
-
-def preproc_ids(df):
-    if "osepa_id" in df.columns:
-        df.osepa_id = df.osepa_id.apply(lambda x: conv2idArray(x))
-    if "lab_id" in df.columns:
-        df.lab_id = df.lab_id.apply(lambda x: conv2idArray(x))
-    if "neurorad_id" in df.columns:
-        df.neurorad_id = df.neurorad_id.apply(lambda x: conv2idArray(x))
-    if "dcm_header_id" in df.columns:
-        df.dcm_header_id = df.dcm_header_id.apply(lambda x: conv2idArray(x))
-    return df
-
-
-def ids2string(df):
-    if "osepa_id" in df.columns:
-        df.osepa_id = df.osepa_id.apply(lambda x: ",".join(x))
-    if "lab_id" in df.columns:
-        df.lab_id = df.lab_id.apply(lambda x: ",".join(x))
-    if "neurorad_id" in df.columns:
-        df.neurorad_id = df.neurorad_id.apply(lambda x: ",".join(x))
-    if "dcm_header_id" in df.columns:
-        df.dcm_header_id = df.dcm_header_id.apply(lambda x: ",".join(x))
-    return df
+        returncodes.append(proc.wait())
+    return returncodes
 
 
 def convert2abs(path):
@@ -85,84 +42,77 @@ def convert2abs(path):
         return os.path.normpath(opj(os.getcwd(), path))
 
 
-def get_max_bids_id(df):
-    ids = df.participant_id.apply(lambda x: int(x.split("-")[1][-5:]))
-    if len(ids) == 0:
-        return 0
+def package_version(name):
+    """Version of an installed distribution, without importing it"""
+    from importlib import metadata
 
-    max_id = np.max(np.array(ids))
-    if max_id >= 1:
-        return max_id
-    else:
-        return 0
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return "unknown"
 
 
-def extract_participant_info(dcm_path):
-    if not os.path.isfile(dcm_path):
-        raise ValueError
-    # return dict with participant info from dcm header
-    infotags = {
-        "institution_name": ("0x0008", "0x0080"),
-        "acquisition_date": ("0x0008", "0x0022"),
-        "content_date": ("0x0008", "0x0023"),
-        "name": ("0x0010", "0x0010"),
-        "id": ("0x0010", "0x0020"),
-        "dob": ("0x0010", "0x0030"),
-        "sex": ("0x0010", "0x0040"),
-        #'other_ids':("0x0010","0x1000"),
-        #'other_names':("0x0010","0x1001"),
-        #'birth_name':("0x0010","0x1005"),
-        # 'age':("0x0010","0x1010"),
-        "size": ("0x0010", "0x1020"),
-        "weight": ("0x0010", "0x1030"),
-    }
-    subject_info = {}
-
-    for key in infotags:
-        subject_info[key] = []
-    # for f in os.listdir(dcm_path):
-
-    dcm = pydi.dcmread(dcm_path)
-    for key in infotags:
-        tg = pydi.tag.Tag(infotags[key])
-        if tg in dcm:
-            if (
-                str(dcm[tg].value) not in subject_info[key]
-                and str(dcm[tg].value) != ""
-                and str(dcm[tg].value) is not None
-            ):
-                subject_info[key].append(str(dcm[tg].value))
+class VersionAction(argparse.Action):
+    """--version, the installed versions are only looked up when it is given"""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, help=None):
+        super().__init__(
+            option_strings, dest, nargs=0, default=argparse.SUPPRESS, help=help
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        parser.exit(
+            message="{} (dcm2bids {})\n".format(
+                package_version("cvt2bids"), package_version("dcm2bids")
+            )
+        )
+
 
-    returnDict = {}
-    for key in subject_info:
-        print(key, subject_info[key])
-        returnDict[key] = ",".join(subject_info[key])
+def welcome():
+    METRICS.reset()
+    logger.info(
+        "cvt2bids %s, dcm2bids %s",
+        package_version("cvt2bids"),
+        package_version("dcm2bids"),
+    )
+
+
+def write_metrics(out_path, metrics_path=None):
+    """Append the metrics of this run to metrics_path, by default in out_path/.cvt2bids"""
+    from .scan_index import INDEX_DIR
 
-    return returnDict
+    metrics_path = metrics_path or opj(out_path, INDEX_DIR, METRICS_NAME)
+    METRICS.write_jsonl(metrics_path)
+    logger.info(METRICS.summary())
+    logger.info("Metrics written to %s", metrics_path)
 
 
 # %% prepare conversion
-def main(
+def make_planner(
     dicom_path,
     out_path,
-    config_path,
+    config_file_path,
     id_=None,
     participants_file=None,
     pathology="",
-    multiproc=False,
+    full_rescan=False,
+    substring_match=False,
+    skip_converted=False,
+    group_series=False,
+    probe_workers=DEFAULT_IN_FLIGHT,
+    read_ahead=DEFAULT_READ_AHEAD,
 ):
-    welcome_str = "cvt2bids " + require("cvt2bids")[0].version
-    welcome_decor = "-" * len(welcome_str)
-    print(welcome_decor + "\n" + welcome_str + "\n" + welcome_decor)
+    """Load participants.tsv and the scan index of out_path into a Planner"""
+    import pandas as pd
 
-    dicom_path = convert2abs(dicom_path)
-    out_path = convert2abs(out_path)
+    from .ids import preproc_ids
+    from .planner import Planner
+    from .scan_index import ScanIndex
+    from .subjects import parse_ids
 
     patho = pathology
     os.makedirs(out_path, exist_ok=True)
 
-    config_file_path = convert2abs(config_path)
-
     if participants_file:
         participants_file = convert2abs(participants_file)
         participants = pd.read_csv(participants_file, sep="\t", dtype=object)
@@ -179,250 +129,732 @@ def main(
             )
 
     if "dcm_header_id" not in participants.columns:
-        participants["dcm_header_id"] = []
-
-    subject = None
-    if id_:
-        if id_ in participants.participant_id.values:
-            subject = participants[participants.participant_id == id_].iloc[0]
-
-        else:
-            print("Did not find participant_id", id_)
+        participants["dcm_header_id"] = ""
+
+    subjects = None
+    catch_all = None
+    ids = parse_ids(id_)
+    if ids:
+        subjects = set(ids)
+        if "folder_path" not in participants.columns:
+            participants["folder_path"] = ""
+        new_ids = [i for i in ids if i not in participants.participant_id.values]
+        if len(new_ids) > 1:
+            raise ValueError(
+                f"Only one participant_id that is not in participants.tsv can be given, got {new_ids}"
+            )
+        if new_ids:
+            catch_all = new_ids[0]
+            logger.warning(
+                "Did not find participant_id %s, all dicoms of unknown ids in %s are stored under it",
+                catch_all,
+                dicom_path,
+            )
             # the whole folder becomes the id, since an id is provided but not found in participants.tsv
-            # folder_id = os.path.basename(dicom_path)
-            participants.append(
-                {
-                    "participan_id": id_,
-                    "dcm_header_id": [],
-                    "folder_path": dicom_path,
-                },
+            participants = pd.concat(
+                [
+                    participants,
+                    pd.DataFrame(
+                        [
+                            {
+                                "participant_id": catch_all,
+                                "dcm_header_id": "",
+                                "folder_path": dicom_path,
+                            }
+                        ],
+                        dtype=object,
+                    ),
+                ],
                 ignore_index=True,
             )
-            # dicom_path = opj(dicom_path, "../")
-            subject = participants[participants.participant_id == id].iloc[0]
 
     participants = preproc_ids(participants)
 
-    commandStrings = []
-    commands = []
-    commands_dict = {}
+    scan_index = ScanIndex(out_path)
+    if full_rescan:
+        logger.info("Full rescan requested, ignoring the scan index...")
+    return Planner(
+        participants,
+        out_path,
+        config_file_path,
+        scan_index,
+        pathology=patho,
+        subjects=subjects,
+        catch_all=catch_all,
+        full_rescan=full_rescan,
+        substring_match=substring_match,
+        skip_converted=skip_converted,
+        group_series=group_series,
+        probe_workers=probe_workers,
+        read_ahead=read_ahead,
+    )
 
-    used_ids = []
-    bids_id_count = get_max_bids_id(participants)
 
-    # dcm2nii conversion
-    for directory, subdirlist, filelist in os.walk(dicom_path):
-        print(directory)
-
-        # find all subfolders containing dicoms:
-        conv = False
-        ind = 0
-        print(f"{directory}: Trying to find dcm files...")
-        for i, f in enumerate(filelist):
-            _, ext = os.path.splitext(f)
-            if ext == ".dcm" or ext == "":
-                try:
-                    pydi.dcmread(os.path.join(directory, f))
-                    conv = True
-                    ind = i
-                    print(f"{directory}: Found dcm files!")
-                    break
-                except:
-                    # could not read file as dcm, so continue
-                    continue
+def make_scratch(scratch, scratch_max_gb=None):
+    if scratch is None:
+        return None
+    from .scratch import Scratch
 
-        if conv:
-            try:
-                dcm_info = extract_participant_info(
-                    os.path.join(directory, filelist[ind])
-                )
-            except:
-                print(os.path.join(directory, filelist[ind]))
-                continue
-        else:
-            print(f"{directory}: Did not find dcm files...")
-            continue
+    max_bytes = None if scratch_max_gb is None else int(scratch_max_gb * 1e9)
+    return Scratch(convert2abs(scratch), max_bytes)
 
-        # here only if conv == True -> dcm_info is defined
 
-        print(f"{directory}: Searching for bids ID for", dcm_info["id"])
+def deduplicate(out_path, deduplicator):
+    """The jobs of deduplicator that are no duplicates, the others are reported"""
+    from .dedup import DUPLICATES_NAME, write_duplicates
+    from .scan_index import INDEX_DIR
 
-        # greifswald addon
-        if dcm_info["id"] == "":
-            print(f"{directory}: Could not find ID for", dcm_info["id"])
-            continue
+    jobs, duplicates = deduplicator.collapse()
+    write_duplicates(duplicates, opj(out_path, INDEX_DIR, DUPLICATES_NAME))
+    return jobs
 
-        id_ = dcm_info["id"]  # .split("_")[0]
 
-        bids_id = find_corresponding_bids(id_, participants)
-        session = "tmp"
-        if "acquisition_date" in dcm_info and dcm_info["acquisition_date"] != "":
-            session = re.sub(r"[^0-9]", "", dcm_info["acquisition_date"])
-        elif "content_date" in dcm_info and dcm_info["content_date"] != "":
-            session = re.sub(r"[^0-9]", "", dcm_info["content_date"])
-        else:
-            print(f"{directory}: Could not find session for", id_)
-            session = "1"
-        print(f"{directory}: Found session", session, "for", id_)
-        if subject is not None:
-            if bids_id in subject.participant_id:
-                if bids_id not in commands_dict.keys():
-                    commands_dict[bids_id] = []
-
-                cmd = [
-                    "dcm2bids",
-                    "-d",
-                    directory,
-                    "-p",
-                    bids_id.split("-")[1],
-                    "-c",
-                    config_file_path,
-                    "-o",
-                    out_path,
-                    "--forceDcm2niix",
-                    "-s",
-                    session,
-                ]
-                commandStrings.append(" ".join(cmd))
-                commands.append(cmd)
-                commands_dict[bids_id].append(cmd)
-        else:
-            if bids_id == "-1":
-                bids_id = "sub-" + patho + str(bids_id_count + 1).zfill(5)
-                bids_id_count += 1
-                print(f"{directory}: Could not find entry for", id_)
-                print(f"{directory}: Creating new subject with BIDS id", bids_id)
-
-                # info = extract_participant_info(fname)
-                info = {}
-                info["participant_id"] = bids_id
-                info["osepa_id"] = []
-                info["lab_id"] = []
-                info["neurorad_id"] = []
-                info["dcm_header_id"] = [id_]
-                # info["folder_path"] = [opj(directory.split()))]
-                participants = participants._append(info, ignore_index=True)
+def main(
+    dicom_path,
+    out_path,
+    config_path,
+    id_=None,
+    participants_file=None,
+    pathology="",
+    multiproc=False,
+    full_rescan=False,
+    substring_match=False,
+    n_jobs=None,
+    backend="subprocess",
+    discovery_workers=DEFAULT_WORKERS,
+    max_depth=None,
+    ignore=None,
+    skip_converted=False,
+    group_series=False,
+    metrics_path=None,
+    resume=False,
+    retry_failed=0,
+    scratch=None,
+    scratch_max_gb=None,
+    io_workers=DEFAULT_IN_FLIGHT,
+    read_ahead=DEFAULT_READ_AHEAD,
+    dedup=False,
+):
+    import multiprocessing
+
+    from .dedup import Deduplicator
+    from .ids import ids2string
+    from .journal import JOURNAL_NAME, Journal
+    from .pairing import load_config
+    from .participant_table import write_tsv
+    from .scan_index import INDEX_DIR
+    from .scheduler import Scheduler
+    from .subjects import walk_subjects
+
+    welcome()
+
+    dicom_path = convert2abs(dicom_path)
+    out_path = convert2abs(out_path)
+    config_file_path = convert2abs(config_path)
+    # fail before walking anything if the config is broken
+    load_config(config_file_path)
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count() if multiproc else 1
+    os.makedirs(opj(out_path, INDEX_DIR), exist_ok=True)
+    journal = Journal(opj(out_path, INDEX_DIR, JOURNAL_NAME), resume)
+    if resume and journal.discovered:
+        jobs = journal.unfinished()
+        logger.info("Resuming %d unfinished jobs of the last run...", len(jobs))
+        scheduler = Scheduler(
+            n_jobs,
+            backend,
+            journal,
+            retry_failed,
+            make_scratch(scratch, scratch_max_gb),
+        )
+        with METRICS.stage("conversion_wait"):
+            results = scheduler.run(jobs)
+        logger.info(scheduler.stats.report())
+        journal.close()
+        finish_jobs(results)
+        write_metrics(out_path, metrics_path)
+        logger.info("Finished!")
+        return 1 if scheduler.stats.failed else 0
+    if resume:
+        logger.warning("The last run did not finish discovery, walking again...")
+
+    planner = make_planner(
+        dicom_path,
+        out_path,
+        config_file_path,
+        id_,
+        participants_file,
+        pathology,
+        full_rescan,
+        substring_match,
+        skip_converted,
+        group_series,
+        io_workers,
+        read_ahead,
+    )
+    scan_index = planner.scan_index
+
+    # conversion starts with the first series found, while discovery goes on
+    logger.info(
+        "Starting conversion to BIDS format with %d parallel workers...", n_jobs
+    )
+    scheduler = Scheduler(
+        n_jobs, backend, journal, retry_failed, make_scratch(scratch, scratch_max_gb)
+    )
+    scheduler.start()
+    # with dedup, conversion waits until the instances of all jobs are known
+    deduplicator = Deduplicator(scan_index, planner.reader) if dedup else None
+
+    # dcm2nii conversion
+    for batch in planner.walk_batches(
+        METRICS.timed_iter(
+            walk_subjects(planner, dicom_path, discovery_workers, max_depth, ignore),
+            "walk",
+        )
+    ):
+        filelists = dict(batch)
+        with METRICS.stage("plan"):
+            jobs = planner.plan_batch(batch)
+        for job in jobs:
+            if deduplicator is not None:
+                deduplicator.add(job, filelists.get(job.directory))
             else:
-                print(f"{directory}: Found entry for", id_, bids_id)
-                if (
-                    id_
-                    not in participants[participants.participant_id == bids_id]
-                    .iloc[0]
-                    .dcm_header_id
-                ):
-                    participants[participants.participant_id == bids_id].iloc[
-                        0
-                    ].dcm_header_id.append(id_)
-
-            if bids_id not in commands_dict.keys():
-                commands_dict[bids_id] = []
-
-            cmd = [
-                "dcm2bids",
-                "-d",
-                directory,
-                "-p",
-                bids_id.split("-")[1],
-                "-c",
-                config_file_path,
-                "-o",
-                out_path,
-                "--forceDcm2niix",
-                "-s",
-                session,
-            ]
-            commandStrings.append([" ".join(cmd)])
-            commands.append([cmd])
-            commands_dict[bids_id].append(cmd)
+                scheduler.submit(job)
+    if deduplicator is not None:
+        for job in deduplicate(out_path, deduplicator):
+            scheduler.submit(job)
+    planner.reader.close()
+
+    scan_index.commit()
 
     # save participants.tsv back to output directory
-    print("Temporary saving participants.tsv to BIDS format... ")
-
-    participants = ids2string(participants)
-    participants.to_csv(opj(out_path, "participants.tsv"), sep="\t", index=False)
-
-    # %% start conversion
-    print("Starting conversion to BIDS format... ")
-    if multiproc:
-        num_cpus = multiprocessing.cpu_count()
-        print("Running in parallel with", num_cpus, "cores.")
-        p = multiprocessing.Pool(min(len(commands_dict), num_cpus))
-        print(list(commands_dict.values())[0])
-        p.map(start_proc, commands_dict.values())
-    else:
-        for cmd in commands:
-            start_proc(cmd)
-    #
-    print("Final saving participants.tsv to BIDS format... ")
-
-    fields = [
-        "PatientName",
-        "PatientID",
-        "PatientBirthDate",
-        "PatientAge",
-        "PatientSex",
-        "AcquisitionDateTime",
-        "DeviceSerialNumber",
-    ]
-    # populate with additional info
-
-    additional_infos = []
-
-    for pat in participants.participant_id:
-        info = {}
-        # find all json sidecars in out_path
-        json_sidecars = glob.glob(opj(out_path, pat, "*", "*", "*.json"))
-        for field in fields:
-            info[field] = []
-        for js in json_sidecars:
-            print("found sidecar", js)
-            with open(js) as jf:
-                data = json.load(jf)
-            for field in fields:
-                try:
-                    tmpvar = data[field]
-                    if field == "AcquisitionDateTime":
-                        tmpvar = tmpvar.split("T")[0]
-                    if tmpvar not in info[field]:
-                        info[field].append(tmpvar)
-                except:
-                    continue
+    logger.info("Temporary saving participants.tsv to BIDS format... ")
 
-        for field in fields:
-            info[field] = ";".join(info[field])
+    with METRICS.stage("participants_write"):
+        participants = ids2string(planner.participants)
+        write_tsv(participants, opj(out_path, "participants.tsv"))
+    journal.mark_discovered()
 
-        additional_infos.append({k: t for k, t in info.items()})
+    # %% wait for conversion
+    logger.info("Discovery finished, waiting for conversion to BIDS format... ")
+    with METRICS.stage("conversion_wait"):
+        results = scheduler.join()
+    logger.info(scheduler.stats.report())
+    journal.close()
 
-    df = pd.DataFrame.from_dict(additional_infos)
+    planner.finish(results)
+    report_pairing(out_path, results)
+    logger.info("Final saving participants.tsv to BIDS format... ")
+    finalize_participants(out_path, participants, scan_index)
+    scan_index.close()
 
-    for field in fields:
-        participants[field] = df[field]
+    write_metrics(out_path, metrics_path)
+    logger.info("Finished!")
+    return 1 if scheduler.stats.failed else 0
 
-    participants.to_csv(opj(out_path, "participants.tsv"), sep="\t", index=False)
 
-    print("Finished!")
+def report_pairing(out_path, results, report_name=None):
+    """Write the sidecars dcm2bids could not pair to out_path/.cvt2bids"""
+    from .pairing import REPORT_NAME, write_pairing_report
+    from .scan_index import INDEX_DIR
 
+    with METRICS.stage("pairing_report"):
+        write_pairing_report(
+            results, opj(out_path, INDEX_DIR, report_name or REPORT_NAME)
+        )
 
-# %%
 
+def finalize_participants(out_path, participants, scan_index):
+    from .participant_table import write_tsv
+    from .sidecars import enrich_participants, harvest_sidecars
 
-def main_wrapper():
-    """Load arguments for main"""
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        description=""" Convert DICOMS to NIFTIS and back, with possible defacing and header annonymization {}""".format(
-            require("dcm2bids")[0].version  # TODO
-        ),
-        epilog=""" Documentation not yet at https://github.com/1-w/cvt2bids """,
+    # populate with additional info from the json sidecars
+    with METRICS.stage("harvest"):
+        harvested = harvest_sidecars(
+            out_path, participants.participant_id, cache=scan_index
+        )
+    participants = enrich_participants(participants, harvested)
+
+    with METRICS.stage("participants_write"):
+        write_tsv(participants, opj(out_path, "participants.tsv"))
+
+
+def merge_participants(out_path, scan_index):
+    """Merge the sidecar fields into participants.tsv of out_path"""
+    import pandas as pd
+
+    logger.info("Final saving participants.tsv to BIDS format... ")
+    participants = pd.read_csv(
+        opj(out_path, "participants.tsv"), sep="\t", dtype=object
     )
+    finalize_participants(out_path, participants, scan_index)
 
-    parser.add_argument(
-        "--version",
-        action="version",
-        help="Display verison.",
-        version=require("cvt2bids")[0].version,
+
+def group_by_out_path(results):
+    by_out_path = {}
+    for result in results:
+        by_out_path.setdefault(result.job.out_path, []).append(result)
+    return by_out_path
+
+
+def record_job_results(scan_index, results):
+    """Record results, run with any config, in scan_index"""
+    from .fingerprint import config_hash
+    from .planner import record_results
+
+    by_config = {}
+    for result in results:
+        by_config.setdefault(result.job.config, []).append(result)
+    for config, config_results in by_config.items():
+        record_results(scan_index, config_results, config_hash(config))
+
+
+def finish_jobs(results):
+    """Record results in the scan index of their out_path, report the sidecars
+    dcm2bids could not pair and merge the sidecars"""
+    from .scan_index import ScanIndex
+
+    for out_path, out_results in group_by_out_path(results).items():
+        scan_index = ScanIndex(out_path)
+        record_job_results(scan_index, out_results)
+        report_pairing(out_path, out_results)
+        merge_participants(out_path, scan_index)
+        scan_index.close()
+
+
+def finish_range(results, start, stop):
+    """Write the results of the jobs [start, stop) of a plan next to its
+    journal, for cvt2bids merge to record in the scan index, and report the
+    sidecars dcm2bids could not pair"""
+    from .journal import RESULTS_NAME, write_results
+    from .scan_index import INDEX_DIR
+
+    for out_path, out_results in group_by_out_path(results).items():
+        write_results(
+            out_results,
+            opj(out_path, INDEX_DIR, RESULTS_NAME.format(start=start, stop=stop)),
+        )
+        report_pairing(out_path, out_results, f"pairing_report-{start}-{stop}.tsv")
+
+
+# %% plan and execute
+def plan(
+    dicom_path,
+    out_path,
+    config_path,
+    plan_path,
+    id_=None,
+    participants_file=None,
+    pathology="",
+    full_rescan=False,
+    substring_match=False,
+    discovery_workers=DEFAULT_WORKERS,
+    max_depth=None,
+    ignore=None,
+    skip_converted=False,
+    group_series=False,
+    metrics_path=None,
+    io_workers=DEFAULT_IN_FLIGHT,
+    read_ahead=DEFAULT_READ_AHEAD,
+    dedup=False,
+):
+    """Walk dicom_path and write the dcm2bids jobs to plan_path without running them.
+
+    New subjects are added to participants.tsv right away, so the bids ids in
+    the plan stay valid for every node executing a part of it.
+    """
+    from .dedup import Deduplicator
+    from .ids import ids2string
+    from .pairing import load_config
+    from .participant_table import write_tsv
+    from .plan import order_plan, plan_row, write_plan
+    from .subjects import walk_subjects
+
+    welcome()
+
+    dicom_path = convert2abs(dicom_path)
+    out_path = convert2abs(out_path)
+    config_file_path = convert2abs(config_path)
+    # fail before walking anything if the config is broken
+    load_config(config_file_path)
+    plan_path = convert2abs(plan_path)
+
+    planner = make_planner(
+        dicom_path,
+        out_path,
+        config_file_path,
+        id_,
+        participants_file,
+        pathology,
+        full_rescan,
+        substring_match,
+        skip_converted,
+        group_series,
+        io_workers,
+        read_ahead,
+    )
+
+    planned = []
+    deduplicator = Deduplicator(planner.scan_index, planner.reader) if dedup else None
+    for batch in planner.walk_batches(
+        METRICS.timed_iter(
+            walk_subjects(planner, dicom_path, discovery_workers, max_depth, ignore),
+            "walk",
+        )
+    ):
+        filelists = dict(batch)
+        with METRICS.stage("plan"):
+            jobs = planner.plan_batch(batch)
+        for job in jobs:
+            files = filelists.get(job.directory)
+            if files is None:
+                files = os.listdir(job.directory)
+            planned.append((job, files))
+            if deduplicator is not None:
+                deduplicator.add(job, files)
+    if deduplicator is not None:
+        keep = {id(job) for job in deduplicate(out_path, deduplicator)}
+        planned = [(job, files) for job, files in planned if id(job) in keep]
+    rows = [plan_row(job, files) for job, files in planned]
+    planner.reader.close()
+    planner.scan_index.close()
+
+    logger.info("Saving participants.tsv to BIDS format... ")
+    participants = ids2string(planner.participants)
+    write_tsv(participants, opj(out_path, "participants.tsv"))
+
+    conversion_plan = order_plan(rows)
+    write_plan(conversion_plan, plan_path)
+    logger.info(
+        "Planned %d jobs, %d files, %.2f GB, estimated %.2f h of conversion",
+        len(conversion_plan),
+        conversion_plan.n_files.sum(),
+        conversion_plan.n_bytes.sum() / 1e9,
+        conversion_plan.est_seconds.sum() / 3600,
+    )
+    logger.info("Plan written to %s", plan_path)
+    write_metrics(out_path, metrics_path)
+
+
+def execute(
+    plan_path,
+    start=None,
+    stop=None,
+    shard=None,
+    n_jobs=None,
+    backend="subprocess",
+    multiproc=False,
+    metrics_path=None,
+    resume=False,
+    retry_failed=0,
+    scratch=None,
+    scratch_max_gb=None,
+):
+    """Run the jobs [start, stop) of a plan, or shard "k/n" of it"""
+    import multiprocessing
+
+    from .journal import Journal
+    from .pairing import load_config
+    from .plan import job_from_row, read_plan, shard_range
+    from .scan_index import INDEX_DIR
+    from .scheduler import Scheduler
+
+    welcome()
+
+    conversion_plan = read_plan(convert2abs(plan_path))
+    if shard is not None:
+        k, n = (int(x) for x in shard.split("/"))
+        start, stop = shard_range(conversion_plan, k, n)
+    start = 0 if start is None else start
+    stop = len(conversion_plan) if stop is None else min(stop, len(conversion_plan))
+    part = conversion_plan.iloc[start:stop]
+    logger.info(
+        "Executing jobs %d to %d of %d, estimated %.2f h",
+        start,
+        stop,
+        len(conversion_plan),
+        part.est_seconds.sum() / 3600,
     )
 
+    if not len(part):
+        return 0
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count() if multiproc else 1
+    # one journal per range, shards may share out_path
+    index_dir = opj(part.out_path.iloc[0], INDEX_DIR)
+    os.makedirs(index_dir, exist_ok=True)
+    journal = Journal(opj(index_dir, f"journal-{start}-{stop}.jsonl"), resume)
+    jobs = [job_from_row(row) for _, row in part.iterrows()]
+    for config in {job.config for job in jobs}:
+        load_config(config)
+    if resume:
+        jobs = [job for job in jobs if not journal.done(job.directory)]
+        logger.info("Resuming %d unfinished jobs...", len(jobs))
+
+    scheduler = Scheduler(
+        n_jobs, backend, journal, retry_failed, make_scratch(scratch, scratch_max_gb)
+    )
+    with METRICS.stage("conversion_wait"):
+        results = scheduler.run(jobs)
+    logger.info(scheduler.stats.report())
+    journal.close()
+
+    # other ranges may run on other nodes, they must not write the scan
+    # index or participants.tsv, cvt2bids merge does once all finished
+    if start == 0 and stop == len(conversion_plan):
+        finish_jobs(results)
+        write_metrics(part.out_path.iloc[0], metrics_path)
+    else:
+        finish_range(results, start, stop)
+        write_metrics(
+            part.out_path.iloc[0],
+            metrics_path or opj(index_dir, f"metrics-{start}-{stop}.jsonl"),
+        )
+        logger.info(
+            "Run 'cvt2bids merge --plan %s' once all ranges finished to record "
+            "them in the scan index and add the sidecar fields to participants.tsv",
+            plan_path,
+        )
+    logger.info("Finished!")
+    return 1 if scheduler.stats.failed else 0
+
+
+def merge(plan_path, metrics_path=None):
+    """Record the results of all ranges of a plan in the scan index and merge
+    the sidecars into participants.tsv, once all ranges ran"""
+    import glob
+
+    from .journal import RESULTS_GLOB, read_results
+    from .plan import read_plan
+    from .scan_index import INDEX_DIR, ScanIndex
+
+    welcome()
+
+    conversion_plan = read_plan(convert2abs(plan_path))
+    out_paths = sorted(set(conversion_plan.out_path))
+    for out_path in out_paths:
+        scan_index = ScanIndex(out_path)
+        results_paths = sorted(glob.glob(opj(out_path, INDEX_DIR, RESULTS_GLOB)))
+        with METRICS.stage("scan_index_write"):
+            for results_path in results_paths:
+                record_job_results(scan_index, read_results(results_path))
+            scan_index.commit()
+        # recorded, a later merge must not record older results over newer ones
+        for results_path in results_paths:
+            os.remove(results_path)
+        logger.info("Recorded the results of %d ranges", len(results_paths))
+        merge_participants(out_path, scan_index)
+        scan_index.close()
+
+    if out_paths:
+        write_metrics(out_paths[0], metrics_path)
+    logger.info("Finished!")
+    return 0
+
+
+# %% watch
+def watch(
+    dicom_path,
+    out_path,
+    config_path,
+    id_=None,
+    participants_file=None,
+    pathology="",
+    multiproc=False,
+    full_rescan=False,
+    substring_match=False,
+    n_jobs=None,
+    backend="subprocess",
+    discovery_workers=DEFAULT_WORKERS,
+    max_depth=None,
+    ignore=None,
+    skip_converted=False,
+    group_series=False,
+    metrics_path=None,
+    retry_failed=0,
+    scratch=None,
+    scratch_max_gb=None,
+    io_workers=DEFAULT_IN_FLIGHT,
+    read_ahead=DEFAULT_READ_AHEAD,
+    quiescence=DEFAULT_QUIESCENCE,
+    poll=False,
+    poll_interval=DEFAULT_POLL_INTERVAL,
+    write_interval=DEFAULT_WRITE_INTERVAL,
+):
+    """Convert the series directories showing up in dicom_path until stopped.
+
+    participants and the participant index are loaded once and stay in
+    memory. A directory is converted once it did not change for quiescence
+    seconds, participants.tsv is written at most every write_interval
+    seconds. SIGINT or SIGTERM stop watching, queued jobs are finished first.
+    """
+    import multiprocessing
+    import signal
+    import threading
+    import time
+
+    from .ids import ids2string
+    from .pairing import load_config
+    from .participant_table import write_tsv
+    from .scheduler import Scheduler
+    from .watch import Quiescence, list_files, make_watcher
+
+    welcome()
+
+    dicom_path = convert2abs(dicom_path)
+    out_path = convert2abs(out_path)
+    config_file_path = convert2abs(config_path)
+    # fail before walking anything if the config is broken
+    load_config(config_file_path)
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count() if multiproc else 1
+
+    planner = make_planner(
+        dicom_path,
+        out_path,
+        config_file_path,
+        id_,
+        participants_file,
+        pathology,
+        full_rescan,
+        substring_match,
+        skip_converted,
+        group_series,
+        io_workers,
+        read_ahead,
+    )
+    scan_index = planner.scan_index
+    # a daemon would grow the journal forever, the scan index is enough to
+    # pick up where it stopped
+    scheduler = Scheduler(
+        n_jobs, backend, None, retry_failed, make_scratch(scratch, scratch_max_gb)
+    )
+    scheduler.start()
+    watcher = make_watcher(
+        dicom_path, poll, poll_interval, discovery_workers, max_depth, ignore
+    )
+    pending = Quiescence(quiescence)
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info("Stopping, finishing the queued jobs first (again to abort)...")
+        stop.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    handlers = {
+        signum: signal.signal(signum, request_stop)
+        for signum in (signal.SIGINT, signal.SIGTERM)
+    }
+
+    def convert(batch):
+        with METRICS.stage("plan"):
+            jobs = planner.plan_batch(batch)
+        for job in jobs:
+            scheduler.submit(job)
+
+    def write_participants(harvest):
+        # the planner keeps using the id lists, write a copy
+        participants = ids2string(planner.participants.copy())
+        if harvest:
+            finalize_participants(out_path, participants, scan_index)
+        else:
+            with METRICS.stage("participants_write"):
+                write_tsv(participants, opj(out_path, "participants.tsv"))
+        scan_index.commit()
+
+    results = []
+    try:
+        # what changed while nobody was watching, directories that are still
+        # being written wait like new ones
+        logger.info("Converting what is new in %s...", dicom_path)
+        started = time.time()
+        for directory, filelist in planner.walk_ahead(
+            METRICS.timed_iter(watcher.start(), "walk")
+        ):
+            if not filelist or stop.is_set():
+                planner.discard(directory)
+                continue
+            try:
+                recent = started - os.stat(directory).st_mtime < quiescence
+            except OSError:
+                planner.discard(directory)
+                continue
+            if recent:
+                planner.discard(directory)
+                pending.touch(directory)
+            else:
+                convert([(directory, filelist)])
+        write_participants(False)
+
+        logger.info(
+            "Watching %s, directories are converted %s s after their last change",
+            dicom_path,
+            quiescence,
+        )
+        last_write = time.monotonic()
+        n_participants = len(planner.table)
+        harvest = False
+        while not stop.is_set():
+            for directory in watcher.changes(timeout=1.0):
+                pending.touch(directory)
+            released = []
+            for directory in pending.ready():
+                try:
+                    filelist = list_files(directory)
+                except OSError:
+                    continue
+                if filelist:
+                    logger.info("%s: No changes for %s s", directory, quiescence)
+                    released.append((directory, filelist))
+            if released:
+                convert(released)
+
+            finished = scheduler.take_results()
+            if finished:
+                planner.finish(finished)
+                results += finished
+                harvest = True
+            if time.monotonic() - last_write >= write_interval and (
+                harvest or len(planner.table) != n_participants
+            ):
+                write_participants(harvest)
+                last_write = time.monotonic()
+                n_participants = len(planner.table)
+                harvest = False
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        watcher.close()
+        planner.reader.close()
+
+    if len(pending):
+        logger.info(
+            "%d directories were still changing, they are converted by the next run",
+            len(pending),
+        )
+    with METRICS.stage("conversion_wait"):
+        finished = scheduler.join()
+    planner.finish(finished)
+    results += finished
+    logger.info(scheduler.stats.report())
+
+    report_pairing(out_path, results)
+    logger.info("Final saving participants.tsv to BIDS format... ")
+    write_participants(True)
+    scan_index.close()
+
+    write_metrics(out_path, metrics_path)
+    logger.info("Finished!")
+    return 1 if scheduler.stats.failed else 0
+
+
+# %%
+
+
+def add_discovery_arguments(parser):
     parser.add_argument(
         "-d",
         "--dicom_path",
@@ -448,8 +880,9 @@ def main_wrapper():
         "-i",
         "--id",
         required=False,
-        help="Single participant_id. Only this id will be processed from participants.tsv file. If no participants.tsv file is provided, all found DICOMS will be stored under this id",
-    )  # TODO
+        nargs="+",
+        help="participant_ids, also comma separated. Only the dicoms of these participants are (re)converted, discovery is restricted to their folder_path in participants.tsv or the directories the scan index knows. Participants without either are searched for header-only, stopping once all are found. If an id is not in participants.tsv, all dicoms of unknown ids will be stored under this id",
+    )
 
     parser.add_argument(
         "-p",
@@ -466,7 +899,78 @@ def main_wrapper():
         help="specify pathology for pat ID",
     )
 
-    # unfortunately not supported currently by dcm2bids/dcm2niix .. but we can at least parallelise subjects
+    parser.add_argument(
+        "--discovery-workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="maximum number of directories listed at the same time during discovery, limits the load on the file server",
+    )
+
+    parser.add_argument(
+        "--io-workers",
+        type=int,
+        default=DEFAULT_IN_FLIGHT,
+        help="maximum number of dicom header reads in flight at the same time",
+    )
+
+    parser.add_argument(
+        "--read-ahead",
+        type=int,
+        default=DEFAULT_READ_AHEAD,
+        metavar="N",
+        help="read the headers of the next N discovered directories in the background while the current one is processed, 0 to disable",
+    )
+
+    parser.add_argument(
+        "--max-depth",
+        type=int,
+        default=None,
+        help="do not descend more than this many directory levels below dicom_path",
+    )
+
+    parser.add_argument(
+        "--ignore",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="skip directories whose name or path relative to dicom_path matches this glob, can be given several times",
+    )
+
+    parser.add_argument(
+        "--skip-converted",
+        action="store_true",
+        help="fingerprint every series (file names, sizes and SOPInstanceUIDs) and skip series whose fingerprint and config are unchanged and whose recorded outputs all exist",
+    )
+
+    parser.add_argument(
+        "--full-rescan",
+        action="store_true",
+        help="ignore the scan index in out_path/.cvt2bids and probe every directory again",
+    )
+
+    parser.add_argument(
+        "--substring-match",
+        action="store_true",
+        help="also match dicom header ids that are only a substring of an id in participants.tsv",
+    )
+
+    parser.add_argument(
+        "--group-series",
+        action="store_true",
+        help="read the header of every dicom and split directories holding several patients, studies or series into one symlinked staging directory per series under out_path/.cvt2bids/staging. A manifest of the series is written to out_path/.cvt2bids/series_manifest.jsonl",
+    )
+
+
+def add_dedup_argument(parser):
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="read the SOPInstanceUIDs of every series (header-only) and skip series whose instances are the same as, or a subset of, those of another series or of one converted before. Conversion starts after discovery. Skipped series are listed in out_path/.cvt2bids/duplicates.tsv",
+    )
+
+
+def add_conversion_arguments(parser, journal=True):
+    # unfortunately not supported currently by dcm2bids/dcm2niix .. but we can at least run independent series in parallel
     parser.add_argument(
         "-m",
         "--multiproc",
@@ -475,6 +979,283 @@ def main_wrapper():
         control whether multi- or singlecore processing should be used""",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of dcm2bids jobs to run at the same time. Defaults to the number of cores with -m, else 1",
+    )
+
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="subprocess",
+        help="run dcm2bids as one subprocess per series or inprocess in long-lived worker processes that import dcm2bids only once",
+    )
+
+    if journal:
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="continue the last run from the job journal in .cvt2bids: only jobs that did not finish or failed are run again. If the last run finished discovery, dicom_path is not walked again",
+        )
+
+    parser.add_argument(
+        "--retry-failed",
+        type=int,
+        default=0,
+        metavar="N",
+        help="run a failed dcm2bids job up to N more times",
+    )
+
+    parser.add_argument(
+        "--scratch",
+        default=None,
+        metavar="DIR",
+        help="directory on fast local storage (SSD, tmpfs) for the temporary dcm2niix/dcm2bids output of every job. Only the final BIDS files are moved to out_path",
+    )
+
+    parser.add_argument(
+        "--scratch-max-gb",
+        type=float,
+        default=None,
+        metavar="GB",
+        help="start jobs only while the dicoms of the jobs running in scratch stay below this size",
+    )
+
+
+def add_instrumentation_arguments(parser):
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="also log every directory and matching step",
+    )
+
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="only log warnings and errors",
+    )
+
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        metavar="FILE",
+        help="json lines file the counters, stage timings and job wall times of the run are appended to. Defaults to out_path/.cvt2bids/metrics.jsonl",
+    )
+
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="FILE",
+        help="profile the run and write the result to FILE",
+    )
+
+    parser.add_argument(
+        "--profiler",
+        choices=PROFILERS,
+        default="cprofile",
+        help="cprofile writes pstats data, pyinstrument (needs to be installed) an html report",
+    )
+
+
+def plan_wrapper(argv):
+    """Load arguments for plan"""
+    parser = argparse.ArgumentParser(
+        prog="cvt2bids plan",
+        description="""Walk dicom_path, match the dicoms to participants and write the dcm2bids jobs to a plan without running them""",
+    )
+    add_discovery_arguments(parser)
+    add_dedup_argument(parser)
+    parser.add_argument(
+        "--plan",
+        required=True,
+        help="plan file to write, json or, if it ends with .parquet, parquet (needs pyarrow)",
+    )
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+    setup_logging(args.verbose - args.quiet)
+    with profiled(args.profile, args.profiler):
+        return plan(
+            args.dicom_path,
+            args.out_path,
+            args.config_path,
+            args.plan,
+            args.id,
+            args.participants_file,
+            args.pathology,
+            args.full_rescan,
+            args.substring_match,
+            args.discovery_workers,
+            args.max_depth,
+            args.ignore,
+            args.skip_converted,
+            args.group_series,
+            args.metrics,
+            args.io_workers,
+            args.read_ahead,
+            args.dedup,
+        )
+
+
+def execute_wrapper(argv):
+    """Load arguments for execute"""
+    parser = argparse.ArgumentParser(
+        prog="cvt2bids execute",
+        description="""Run the dcm2bids jobs of a plan written by cvt2bids plan, or a range of them""",
+    )
+    parser.add_argument(
+        "--plan", required=True, help="plan file written by cvt2bids plan"
+    )
+    parser.add_argument(
+        "--start", type=int, default=None, help="index of the first job to run"
+    )
+    parser.add_argument(
+        "--stop", type=int, default=None, help="index after the last job to run"
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        metavar="K/N",
+        help="run the K-th (0-based) of N index ranges of about equal estimated conversion time. Ranges never split the jobs of one subject and session",
+    )
+    add_conversion_arguments(parser)
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+    setup_logging(args.verbose - args.quiet)
+    with profiled(args.profile, args.profiler):
+        return execute(
+            args.plan,
+            args.start,
+            args.stop,
+            args.shard,
+            args.jobs,
+            args.backend,
+            args.multiproc,
+            args.metrics,
+            args.resume,
+            args.retry_failed,
+            args.scratch,
+            args.scratch_max_gb,
+        )
+
+
+def merge_wrapper(argv):
+    """Load arguments for merge"""
+    parser = argparse.ArgumentParser(
+        prog="cvt2bids merge",
+        description="""Add the sidecar fields of all converted series to participants.tsv, after every range of a plan was run by cvt2bids execute""",
+    )
+    parser.add_argument(
+        "--plan", required=True, help="plan file written by cvt2bids plan"
+    )
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+    setup_logging(args.verbose - args.quiet)
+    with profiled(args.profile, args.profiler):
+        return merge(args.plan, args.metrics)
+
+
+def watch_wrapper(argv):
+    """Load arguments for watch"""
+    parser = argparse.ArgumentParser(
+        prog="cvt2bids watch",
+        description="""Keep converting the series directories showing up in dicom_path, e.g. from a PACS export, until stopped with Ctrl-C or SIGTERM""",
+    )
+    add_discovery_arguments(parser)
+    parser.add_argument(
+        "--quiescence",
+        type=float,
+        default=DEFAULT_QUIESCENCE,
+        metavar="SECONDS",
+        help="convert a directory once its files did not change for this long",
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="list dicom_path every --poll-interval seconds instead of using inotify, e.g. for network file systems written by other hosts. Also used if inotify_simple is not installed",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        metavar="SECONDS",
+        help="seconds between two listings of dicom_path when polling",
+    )
+    parser.add_argument(
+        "--write-interval",
+        type=float,
+        default=DEFAULT_WRITE_INTERVAL,
+        metavar="SECONDS",
+        help="write participants.tsv and the scan index at most this often",
+    )
+    add_conversion_arguments(parser, journal=False)
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+    setup_logging(args.verbose - args.quiet)
+    with profiled(args.profile, args.profiler):
+        return watch(
+            args.dicom_path,
+            args.out_path,
+            args.config_path,
+            args.id,
+            args.participants_file,
+            args.pathology,
+            args.multiproc,
+            args.full_rescan,
+            args.substring_match,
+            args.jobs,
+            args.backend,
+            args.discovery_workers,
+            args.max_depth,
+            args.ignore,
+            args.skip_converted,
+            args.group_series,
+            args.metrics,
+            args.retry_failed,
+            args.scratch,
+            args.scratch_max_gb,
+            args.io_workers,
+            args.read_ahead,
+            args.quiescence,
+            args.poll,
+            args.poll_interval,
+            args.write_interval,
+        )
+
+
+def main_wrapper():
+    """Load arguments for main, or for the plan, execute, merge and watch commands"""
+    if len(sys.argv) > 1 and sys.argv[1] == "plan":
+        return plan_wrapper(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "execute":
+        return execute_wrapper(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        return merge_wrapper(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "watch":
+        return watch_wrapper(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=""" Convert DICOMS to NIFTIS and back, with possible defacing and header annonymization""",
+        epilog=""" Use 'cvt2bids plan', 'cvt2bids execute' and 'cvt2bids merge' to split discovery and conversion, 'cvt2bids watch' to convert new dicoms continuously. Documentation not yet at https://github.com/1-w/cvt2bids """,
+    )
+
+    parser.add_argument(
+        "--version",
+        action=VersionAction,
+        help="Display verison.",
+    )
+
+    add_discovery_arguments(parser)
+    add_dedup_argument(parser)
+    add_conversion_arguments(parser)
+    add_instrumentation_arguments(parser)
+
     if len(sys.argv) == 1:
         parser.print_help()
         return 0
@@ -485,16 +1266,35 @@ def main_wrapper():
         parser.print_usage()
         return -1
 
+    setup_logging(args.verbose - args.quiet)
     # args =parser.parse_args(args, namespace = v)
-    return main(
-        args.dicom_path,
-        args.out_path,
-        args.config_path,
-        args.id,
-        args.participants_file,
-        args.pathology,
-        args.multiproc,
-    )
+    with profiled(args.profile, args.profiler):
+        return main(
+            args.dicom_path,
+            args.out_path,
+            args.config_path,
+            args.id,
+            args.participants_file,
+            args.pathology,
+            args.multiproc,
+            args.full_rescan,
+            args.substring_match,
+            args.jobs,
+            args.backend,
+            args.discovery_workers,
+            args.max_depth,
+            args.ignore,
+            args.skip_converted,
+            args.group_series,
+            args.metrics,
+            args.resume,
+            args.retry_failed,
+            args.scratch,
+            args.scratch_max_gb,
+            args.io_workers,
+            args.read_ahead,
+            args.dedup,
+        )
 
 
 # %%
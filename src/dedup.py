@@ -0,0 +1,152 @@
+# %%
+import logging
+import os
+from dataclasses import dataclass
+from os.path import join as opj
+
+import pandas as pd
+
+from .metrics import METRICS
+from .participant_table import write_tsv
+from .probe import is_candidate
+
+logger = logging.getLogger(__name__)
+
+DUPLICATES_NAME = "duplicates.tsv"
+
+
+def instance_uids(reader, directory, filelist):
+    """SOPInstanceUIDs of the dicoms in directory, read header-only by reader"""
+    paths = [opj(directory, f) for f in filelist if is_candidate(f)]
+    uids = set()
+    for dcm in reader.map(paths, ["SOPInstanceUID"]):
+        if dcm is not None and "SOPInstanceUID" in dcm:
+            uids.add(str(dcm.SOPInstanceUID))
+    return frozenset(uids)
+
+
+@dataclass
+class Duplicate:
+    job: object
+    canonical: str  # directory converted instead
+    relation: str  # identical or subset
+    n_instances: int
+
+
+class Deduplicator:
+    """Collect the jobs of a run and drop those whose instances are converted anyway.
+
+    The SOPInstanceUIDs of every job directory are read header-only. A job
+    is a duplicate if its instances are the same as, or a subset of, those of
+    another job of the run or of a directory converted by an earlier run.
+    Of identical directories the first in path order is converted.
+    """
+
+    def __init__(self, scan_index, reader):
+        self.scan_index = scan_index
+        self.reader = reader
+        self._jobs = []
+
+    def add(self, job, filelist=None):
+        if filelist is None:
+            filelist = sorted(os.listdir(job.directory))
+        with METRICS.stage("dedup_read"):
+            uids = instance_uids(self.reader, job.directory, filelist)
+        self._jobs.append((job, uids))
+
+    def _original(self, uids, current, by_uid):
+        """(directory, its instance count) holding all of uids, (None, 0) if none.
+
+        Directories converted by earlier runs come first.
+        """
+        uid = next(iter(uids))
+        for directory in self.scan_index.instance_directories(uid):
+            if directory in current:
+                continue
+            earlier = self.scan_index.instances_of(directory)
+            if uids <= earlier:
+                return directory, len(earlier)
+        for directory, other in by_uid.get(uid, []):
+            if uids <= other:
+                return directory, len(other)
+        return None, 0
+
+    def collapse(self):
+        """(jobs to run, Duplicates), the instances of the jobs to run are indexed"""
+        current = {job.directory for job, _ in self._jobs}
+        # larger directories first, a subset always comes after its superset
+        ordered = sorted(
+            self._jobs, key=lambda item: (-len(item[1]), item[0].directory)
+        )
+        keep = set()
+        by_uid = {}
+        duplicates = []
+        with METRICS.stage("dedup"):
+            for job, uids in ordered:
+                if not uids:
+                    keep.add(job.directory)
+                    continue
+                original, n_original = self._original(uids, current, by_uid)
+                if original is None:
+                    keep.add(job.directory)
+                    for uid in uids:
+                        by_uid.setdefault(uid, []).append((job.directory, uids))
+                    self.scan_index.record_instances(job.directory, uids)
+                    continue
+                relation = "identical" if len(uids) == n_original else "subset"
+                logger.info(
+                    "%s: Duplicate (%s) of %s, not converted",
+                    job.directory,
+                    relation,
+                    original,
+                )
+                duplicates.append(Duplicate(job, original, relation, len(uids)))
+                self.scan_index.forget_instances(job.directory)
+                if job.source is None:
+                    self.scan_index.set_status(job.directory, "duplicate")
+        METRICS.count("duplicates_skipped", len(duplicates))
+        return [job for job, _ in self._jobs if job.directory in keep], duplicates
+
+
+def duplicates_report(duplicates):
+    """The skipped directories and the directories converted instead"""
+    return pd.DataFrame(
+        [
+            {
+                "directory": d.job.source or d.job.directory,
+                "series": d.job.directory if d.job.source else "",
+                "canonical": d.canonical,
+                "relation": d.relation,
+                "n_instances": d.n_instances,
+                "participant_id": f"sub-{d.job.participant}",
+                "session": d.job.session,
+            }
+            for d in duplicates
+        ],
+        columns=[
+            "directory",
+            "series",
+            "canonical",
+            "relation",
+            "n_instances",
+            "participant_id",
+            "session",
+        ],
+    )
+
+
+def write_duplicates(duplicates, path):
+    report = duplicates_report(duplicates)
+    write_tsv(report, path)
+    if not len(report):
+        logger.info("No duplicate directories found")
+        return
+    counts = report.relation.value_counts()
+    logger.warning(
+        "Skipped %d duplicate directories (%d identical, %d subsets, %d instances), see %s",
+        len(report),
+        counts.get("identical", 0),
+        counts.get("subset", 0),
+        report.n_instances.sum(),
+        path,
+    )
@@ -0,0 +1,94 @@
+# %%
+import heapq
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatch
+
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+# header reads in flight at the same time, and directories probed ahead of
+# the one being planned, see header_reader
+DEFAULT_IN_FLIGHT = 16
+DEFAULT_READ_AHEAD = 32
+
+
+def is_ignored(path, root, ignore):
+    name = os.path.basename(path)
+    rel = os.path.relpath(path, root)
+    return any(fnmatch(name, pat) or fnmatch(rel, pat) for pat in ignore)
+
+
+def scan_dir(path):
+    """List one directory with os.scandir, returns (files, subdirs)"""
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # like os.walk, symlinked directories are not followed
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                else:
+                    files.append(entry.name)
+    except OSError as e:
+        logger.warning("%s: Could not list directory: %s", path, e)
+        METRICS.count("list_errors")
+    METRICS.count("dirs_walked")
+    METRICS.count("files_seen", len(files))
+    return files, subdirs
+
+
+def discover(root, max_workers=DEFAULT_WORKERS, max_depth=None, ignore=()):
+    """Walk root with a pool of max_workers threads listing directories.
+
+    Yields (directory, filenames) in the pre-order of os.walk with sorted
+    subdirectories, while the rest of the tree is still being walked. The
+    earliest directories in that order are listed first, a directory is
+    yielded once it and every directory before it are listed. max_workers
+    bounds the number of concurrent directory listings on the file server.
+    Directories deeper than max_depth (root is depth 0) or matching one of
+    the ignore globs (by name or path relative to root) are pruned.
+    """
+    ignore = list(ignore or [])
+    max_workers = max(int(max_workers), 1)
+    # directories are ordered by the tuple of their path components below
+    # root, which sorts them in pre-order
+    unlisted = [((), root, 0)]
+    unyielded = [()]
+    running = {}
+    listed = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        try:
+            while unyielded:
+                while unlisted and len(running) < max_workers:
+                    key, directory, depth = heapq.heappop(unlisted)
+                    running[pool.submit(scan_dir, directory)] = key, directory, depth
+                if unyielded[0] in listed:
+                    yield listed.pop(heapq.heappop(unyielded))
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, directory, depth = running.pop(future)
+                    files, subdirs = future.result()
+                    listed[key] = directory, sorted(files)
+                    if max_depth is not None and depth >= max_depth:
+                        continue
+                    for sub in subdirs:
+                        if ignore and is_ignored(sub, root, ignore):
+                            continue
+                        sub_key = key + (os.path.basename(sub),)
+                        heapq.heappush(unlisted, (sub_key, sub, depth + 1))
+                        heapq.heappush(unyielded, sub_key)
+        finally:
+            # generator closed early, do not list the rest of the tree
+            for future in running:
+                future.cancel()
@@ -0,0 +1,85 @@
+# %%
+import glob
+import hashlib
+import os
+from os.path import join as opj
+
+from .probe import is_candidate, probe_file
+
+SOP_INSTANCE_UID = 0x00080018
+
+
+def series_fingerprint(directory, filelist, reader=None):
+    """Hash of sorted (file name, size, SOPInstanceUID) of a series directory.
+
+    Only the header up to SOPInstanceUID is read from each file, on the pool
+    of reader (a HeaderReader) if given. Files that are no dicoms contribute
+    their name and size.
+    """
+    sizes = []
+    for f in sorted(filelist):
+        try:
+            sizes.append((f, os.stat(opj(directory, f)).st_size))
+        except OSError:
+            continue
+    paths = [opj(directory, f) for f, _ in sizes if is_candidate(f)]
+    if reader is not None:
+        headers = reader.map(paths, [SOP_INSTANCE_UID])
+    else:
+        headers = (probe_file(path, [SOP_INSTANCE_UID]) for path in paths)
+    headers = iter(headers)
+
+    h = hashlib.sha1()
+    for f, size in sizes:
+        uid = ""
+        if is_candidate(f):
+            dcm = next(headers)
+            if dcm is not None:
+                uid = str(dcm.get("SOPInstanceUID", ""))
+        h.update(f"{f}\0{size}\0{uid}\n".encode())
+    return h.hexdigest()
+
+
+def config_hash(config_path):
+    with open(config_path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def session_dir(out_path, participant, session):
+    return opj(out_path, "sub-" + participant, "ses-" + session)
+
+
+def session_files(out_path, participant, session):
+    """{path relative to out_path: mtime_ns} of the files in sub-<participant>/ses-<session>"""
+    files = {}
+    for dirpath, _, filenames in os.walk(session_dir(out_path, participant, session)):
+        rel = os.path.relpath(dirpath, out_path)
+        for f in filenames:
+            try:
+                files[opj(rel, f)] = os.stat(opj(dirpath, f)).st_mtime_ns
+            except OSError:
+                continue
+    return files
+
+
+def written_files(before, after):
+    """Files of session_files snapshot after that are new or rewritten since before"""
+    return sorted(
+        path for path, mtime_ns in after.items() if before.get(path) != mtime_ns
+    )
+
+
+def outputs_exist(out_path, outputs, participant=None, session=None):
+    """True if the outputs recorded for a series are all still in out_path.
+
+    Unknown outputs (None) count as missing. A series that wrote nothing,
+    e.g. because dcm2bids found its files already there, has none recorded;
+    then any image in its session directory counts, if that is known.
+    """
+    if outputs is None:
+        return False
+    if not outputs:
+        return participant is not None and bool(
+            glob.glob(opj(session_dir(out_path, participant, session), "*", "*.nii*"))
+        )
+    return all(os.path.exists(opj(out_path, f)) for f in outputs)
@@ -0,0 +1,91 @@
+# %%
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from os.path import join as opj
+
+from .probe import SPECIFIC_TAGS, is_candidate, probe_file
+
+GROUP_TAGS = ["PatientID", "StudyInstanceUID", "SeriesInstanceUID"]
+GROUP_SPECIFIC_TAGS = SPECIFIC_TAGS + GROUP_TAGS
+
+
+@dataclass
+class SeriesGroup:
+    """Files of one series found in a directory"""
+
+    patient_id: str
+    study_uid: str
+    series_uid: str
+    files: list = field(default_factory=list)
+    header: object = None  # header of the first file, with the infotags
+
+    @property
+    def first_file(self):
+        return self.files[0]
+
+
+def group_directory(directory, filelist, max_workers=8, reader=None):
+    """Bucket the dicoms of a directory by PatientID/StudyInstanceUID/SeriesInstanceUID.
+
+    Headers are read header-only on a thread pool, or by a HeaderReader
+    shared with the rest of the run. Returns the groups in the order their
+    first file appears in filelist.
+    """
+    candidates = [f for f in filelist if is_candidate(f)]
+    if reader is not None:
+        headers = reader.map(
+            [opj(directory, f) for f in candidates], GROUP_SPECIFIC_TAGS
+        )
+        return _group(candidates, headers)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        headers = pool.map(
+            lambda f: probe_file(opj(directory, f), GROUP_SPECIFIC_TAGS), candidates
+        )
+        return _group(candidates, headers)
+
+
+def _group(filelist, headers):
+    groups = {}
+    for f, dcm in zip(filelist, headers):
+        if dcm is None:
+            continue
+        key = tuple(str(dcm.get(tag, "")) for tag in GROUP_TAGS)
+        if key not in groups:
+            groups[key] = SeriesGroup(*key, header=dcm)
+        groups[key].files.append(f)
+    return list(groups.values())
+
+
+def stage_series(group, directory, staging_root):
+    """Symlink the files of one series into its own staging directory"""
+    source = hashlib.sha1(directory.encode()).hexdigest()[:8]
+    staged = opj(staging_root, f"{group.series_uid or 'unknown'}_{source}")
+    # files may have been removed since the last run
+    shutil.rmtree(staged, ignore_errors=True)
+    os.makedirs(staged)
+    for f in group.files:
+        os.symlink(opj(directory, f), opj(staged, f))
+    return staged
+
+
+def write_manifest(path, directory, groups, staged_dirs):
+    """Append one line per series of directory to a json lines manifest"""
+    with open(path, "a") as f:
+        for group, staged in zip(groups, staged_dirs):
+            f.write(
+                json.dumps(
+                    {
+                        "directory": directory,
+                        "patient_id": group.patient_id,
+                        "study_uid": group.study_uid,
+                        "series_uid": group.series_uid,
+                        "n_files": len(group.files),
+                        "staged": staged,
+                    }
+                )
+                + "\n"
+            )
@@ -0,0 +1,48 @@
+# %%
+from concurrent.futures import ThreadPoolExecutor
+
+from .discovery import DEFAULT_IN_FLIGHT, DEFAULT_READ_AHEAD
+from .probe import SPECIFIC_TAGS, probe_directory, probe_file
+
+
+class HeaderReader:
+    """Dicom header reads on a thread pool, at most max_in_flight at a time.
+
+    On a network file system a header read is bound by round trips rather
+    than bandwidth, so many reads are issued concurrently. Directories can be
+    submitted ahead of time; probe_directory then returns the prefetched
+    result instead of reading again.
+    """
+
+    def __init__(self, max_in_flight=DEFAULT_IN_FLIGHT):
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        self._ahead = {}
+
+    def map(self, paths, specific_tags=SPECIFIC_TAGS):
+        """Headers of paths in order, None for files that are no dicom"""
+        return self._pool.map(lambda path: probe_file(path, specific_tags), paths)
+
+    def submit_directory(self, directory, filelist):
+        """Start probing directory in the background"""
+        if directory not in self._ahead:
+            self._ahead[directory] = self._pool.submit(
+                probe_directory, directory, filelist
+            )
+
+    def probe_directory(self, directory, filelist):
+        """(filename, header) of the first dicom in filelist, see probe.probe_directory"""
+        future = self._ahead.pop(directory, None)
+        if future is None:
+            return probe_directory(directory, filelist)
+        return future.result()
+
+    def discard(self, directory):
+        """Drop the prefetched result of directory, e.g. because it changed"""
+        future = self._ahead.pop(directory, None)
+        if future is not None:
+            future.cancel()
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self._ahead.clear()
@@ -0,0 +1,89 @@
+# %%
+import pandas as pd
+
+ID_COLUMNS = ["osepa_id", "lab_id", "neurorad_id", "dcm_header_id"]
+
+_SEPARATORS = r"\s*,[\s,]*"
+_STRIP = " \t\r\n,"
+# separators of list literals like "['a', 'b']" written by older versions,
+# with the quotes around the ids
+_LITERAL_SEPARATORS = r"""['"]?\s*,\s*['"]?"""
+_QUOTES = " \t'\""
+
+
+def _strip_ids(s):
+    t = s.fillna("").astype(str).str.strip(_STRIP)
+    # only whole list literals lose their brackets and quotes, ids like
+    # "X(1)" or "O'Brien" are kept as they are
+    literal = t.str.startswith("[") & t.str.endswith("]")
+    if literal.any():
+        inner = (
+            t[literal]
+            .str.slice(1, -1)
+            .str.replace(_LITERAL_SEPARATORS, ",", regex=True)
+            .str.strip(_QUOTES)
+            .str.strip(_STRIP)
+        )
+        t = t.where(~literal, inner)
+    return t
+
+
+def split_ids(s):
+    """Id column to a column of id lists"""
+    t = _strip_ids(s)
+    lists = t.str.split(_SEPARATORS, regex=True)
+    empty = t == ""
+    if empty.any():
+        lists[empty] = pd.Series([[] for _ in range(empty.sum())], index=t.index[empty])
+    return lists
+
+
+def join_ids(s):
+    """Column of id lists back to the 'a,b' form used in participants.tsv"""
+    return s.str.join(",").fillna("")
+
+
+def preproc_ids(df):
+    for column in ID_COLUMNS:
+        if column in df.columns:
+            df[column] = split_ids(df[column])
+    return df
+
+
+def ids2string(df):
+    for column in ID_COLUMNS:
+        if column in df.columns:
+            df[column] = join_ids(df[column])
+    return df
+
+
+def ids_long(df):
+    """Long form (row, participant_id, column, id) table of all ids in df.
+
+    Works on raw and on preprocessed (list) id columns. Rows keep the order
+    of df, so the first occurrence of an id is the one a top-down scan finds.
+    """
+    frames = []
+    for column in ID_COLUMNS:
+        if column not in df.columns:
+            continue
+        values = df[column]
+        if len(values) and not isinstance(values.iloc[0], list):
+            values = split_ids(values)
+        ids = values.explode().dropna().astype(str).str.strip()
+        ids = ids[ids != ""]
+        frames.append(
+            pd.DataFrame(
+                {
+                    "row": ids.index,
+                    "participant_id": df.participant_id.loc[ids.index].values,
+                    "column": column,
+                    "id": ids.values,
+                }
+            )
+        )
+    if not frames:
+        return pd.DataFrame(columns=["row", "participant_id", "column", "id"])
+    long = pd.concat(frames, ignore_index=True)
+    order = df.index.get_indexer(long.row).argsort(kind="stable")
+    return long.iloc[order].reset_index(drop=True)
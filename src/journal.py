@@ -0,0 +1,144 @@
+# %%
+import dataclasses
+import json
+import os
+import threading
+import time
+
+from .scheduler import Job, JobResult
+
+JOURNAL_NAME = "journal.jsonl"
+# results of a job range run by cvt2bids execute, folded into the scan index
+# by cvt2bids merge
+RESULTS_NAME = "results-{start}-{stop}.jsonl"
+RESULTS_GLOB = "results-*.jsonl"
+
+
+class Journal:
+    """Append-only json lines log of the status of every conversion job.
+
+    Jobs are recorded when queued (with everything needed to run them
+    again), when started and when finished, with exit code, duration and
+    the tail of stderr. Finished records are fsynced, so the journal
+    survives the run being killed.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self.jobs, self.status, self.discovered = (
+            self.load(path) if resume else ({}, {}, False)
+        )
+        self._f = open(path, "a" if resume else "w")
+
+    @staticmethod
+    def load(path):
+        """({directory: Job}, {directory: last record}, discovery finished)"""
+        jobs, status, discovered = {}, {}, False
+        if not os.path.isfile(path):
+            return jobs, status, discovered
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line of a killed run
+                    continue
+                if record["status"] == "discovered":
+                    discovered = True
+                    continue
+                if "job" in record:
+                    jobs[record["directory"]] = Job(**record["job"])
+                status[record["directory"]] = record
+        return jobs, status, discovered
+
+    def unfinished(self):
+        """Jobs that were queued but did not finish successfully"""
+        return [
+            job
+            for directory, job in self.jobs.items()
+            if self.status[directory]["status"] != "done"
+        ]
+
+    def done(self, directory):
+        record = self.status.get(directory)
+        return record is not None and record["status"] == "done"
+
+    def _write(self, record, sync=False):
+        record["time"] = time.time()
+        with self._lock:
+            self._f.write(json.dumps(record) + "\n")
+            self._f.flush()
+            if sync:
+                os.fsync(self._f.fileno())
+
+    def queued(self, job):
+        record = {
+            "status": "queued",
+            "directory": job.directory,
+            "job": dataclasses.asdict(job),
+        }
+        self.jobs[job.directory] = job
+        self.status[job.directory] = record
+        self._write(record)
+
+    def running(self, job, attempt):
+        self._write(
+            {"status": "running", "directory": job.directory, "attempt": attempt}
+        )
+
+    def finished(self, result, attempt):
+        record = {
+            "status": "done" if result.returncode == 0 else "failed",
+            "directory": result.job.directory,
+            "attempt": attempt,
+            "returncode": result.returncode,
+            "duration": result.wall_time,
+            "stderr": result.stderr,
+        }
+        self.status[result.job.directory] = record
+        self._write(record, sync=True)
+
+    def mark_discovered(self):
+        """All jobs of the run are queued, a resume does not need to walk again"""
+        self.discovered = True
+        self._write({"status": "discovered"}, sync=True)
+
+    def close(self):
+        self._f.close()
+
+
+def write_results(results, path):
+    """Write what the scan index needs of results to path as json lines.
+
+    Ranges run on other nodes do not open the shared scan index, sqlite
+    locking is not reliable on network file systems. The file is written
+    under a temporary name and renamed, so merge never reads half of it.
+    """
+    with open(path + ".part", "w") as f:
+        for result in results:
+            record = {
+                "job": dataclasses.asdict(result.job),
+                "returncode": result.returncode,
+                "wall_time": result.wall_time,
+                "outputs": result.outputs,
+            }
+            f.write(json.dumps(record) + "\n")
+    os.replace(path + ".part", path)
+
+
+def read_results(path):
+    """JobResults written by write_results"""
+    results = []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            results.append(
+                JobResult(
+                    Job(**record["job"]),
+                    record["returncode"],
+                    record["wall_time"],
+                    outputs=record["outputs"],
+                )
+            )
+    return results
@@ -0,0 +1,177 @@
+# %%
+import contextlib
+import json
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+logger = logging.getLogger(__name__)
+
+PROFILERS = ["cprofile", "pyinstrument"]
+
+# upper bounds in seconds of the job wall time histogram buckets
+WALL_TIME_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1800, float("inf")]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+class Metrics:
+    """Thread safe counters, per stage wall times and histograms of one run"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.counters = Counter()
+            self.stages = defaultdict(lambda: [0, 0.0])  # calls, seconds
+            self.observations = defaultdict(list)
+            self.events = []
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name, value):
+        with self._lock:
+            self.observations[name].append(value)
+
+    def event(self, **fields):
+        with self._lock:
+            self.events.append(fields)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            entry = self.stages[name]
+            entry[0] += 1
+            entry[1] += seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def timed_iter(self, iterable, name):
+        """Yield from iterable, adding the time spent waiting for items to stage name"""
+        iterator = iter(iterable)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - t0)
+                return
+            self.add_time(name, time.perf_counter() - t0)
+            yield item
+
+    def histogram(self, name, buckets=WALL_TIME_BUCKETS):
+        values = self.observations[name]
+        counts = [0] * len(buckets)
+        for value in values:
+            counts[next(i for i, b in enumerate(buckets) if value <= b)] += 1
+        return {
+            "count": len(values),
+            "sum": sum(values),
+            "min": min(values, default=float("nan")),
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "max": max(values, default=float("nan")),
+            "buckets": {str(b): c for b, c in zip(buckets, counts)},
+        }
+
+    def records(self):
+        """All metrics as a list of json serializable dicts"""
+        run = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started))
+        with self._lock:
+            records = [
+                {"run": run, "type": "counter", "name": k, "value": v}
+                for k, v in sorted(self.counters.items())
+            ]
+            records += [
+                {"run": run, "type": "stage", "name": k, "calls": c, "seconds": s}
+                for k, (c, s) in sorted(self.stages.items())
+            ]
+            names = sorted(self.observations)
+            events = list(self.events)
+        records += [
+            {"run": run, "type": "histogram", "name": k, **self.histogram(k)}
+            for k in names
+        ]
+        records += [{"run": run, "type": "event", **e} for e in events]
+        return records
+
+    def write_jsonl(self, path):
+        """Append the metrics of this run to a json lines file"""
+        with open(path, "a") as f:
+            for record in self.records():
+                f.write(json.dumps(record) + "\n")
+
+    def summary(self):
+        lines = [
+            "counters: "
+            + ", ".join(f"{k} {v}" for k, v in sorted(self.counters.items()))
+        ]
+        lines += [
+            f"stage {k}: {s:.1f}s in {c} calls"
+            for k, (c, s) in sorted(self.stages.items())
+        ]
+        return "\n".join(lines)
+
+
+# metrics of the current run, shared by all modules
+METRICS = Metrics()
+
+
+@contextlib.contextmanager
+def profiled(path, profiler="cprofile"):
+    """Profile the enclosed block into path, a no-op if path is None.
+
+    cprofile writes pstats data (e.g. for snakeviz), pyinstrument an html
+    report. Both only see the calling thread.
+    """
+    if path is None:
+        yield
+        return
+    if profiler == "pyinstrument":
+        from pyinstrument import Profiler  # optional dependency
+
+        prof = Profiler()
+        prof.start()
+        try:
+            yield
+        finally:
+            prof.stop()
+            with open(path, "w") as f:
+                f.write(prof.output_html())
+    else:
+        import cProfile
+
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(path)
+    logger.info("Profile written to %s", path)
+
+
+def setup_logging(verbosity=0):
+    """-q/-v style verbosity to a logging level for the root logger"""
+    level = {-1: logging.WARNING, 0: logging.INFO}.get(
+        max(verbosity, -1), logging.DEBUG
+    )
+    logging.basicConfig(
+        level=level, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
@@ -0,0 +1,257 @@
+# %%
+import fnmatch
+import glob
+import json
+import logging
+import os
+import re
+from os.path import join as opj
+
+import pandas as pd
+
+from .metrics import METRICS
+from .participant_table import write_tsv
+from .sidecars import read_sidecar
+
+logger = logging.getLogger(__name__)
+
+SEARCH_METHODS = ["fnmatch", "re"]
+REPORT_NAME = "pairing_report.tsv"
+REPORT_COLUMNS = ["participant_id", "session", "sidecar", "status", "descriptions"]
+# dcm2bids keeps dcm2niix output, including the sidecars it could not pair,
+# and its logs in output_dir/tmp_dcm2bids
+TMP_DIR_NAME = "tmp_dcm2bids"
+
+_configs = {}
+
+
+def load_config(path):
+    """Read and validate a dcm2bids config, once per file version.
+
+    Returns the config and its DescriptionMatcher. Raises ValueError naming
+    the description with a missing key or a pattern that does not compile,
+    instead of every dcm2bids job failing.
+    """
+    key = (path, os.stat(path).st_mtime_ns)
+    if key in _configs:
+        return _configs[key]
+    with open(path) as f:
+        try:
+            config = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"{path}: not a valid json file: {e}")
+    search_method = config.get("searchMethod", "fnmatch")
+    if search_method not in SEARCH_METHODS:
+        raise ValueError(
+            f"{path}: unknown searchMethod {search_method}, choose from {SEARCH_METHODS}"
+        )
+    descriptions = config.get("descriptions")
+    if not isinstance(descriptions, list):
+        raise ValueError(f"{path}: 'descriptions' must be a list")
+    for i, description in enumerate(descriptions):
+        for field in ["dataType", "modalityLabel", "criteria"]:
+            if field not in description:
+                raise ValueError(f"{path}: description {i} has no '{field}'")
+        if not isinstance(description["criteria"], dict):
+            raise ValueError(f"{path}: criteria of description {i} must be a dict")
+    # compiles every pattern once, raising on invalid ones
+    matcher = DescriptionMatcher(
+        descriptions, search_method, config.get("caseSensitive", True), path
+    )
+    _configs[key] = config, matcher
+    return config, matcher
+
+
+def _freeze(value):
+    """Hashable version of a sidecar value or criteria pattern"""
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        # only ever compared as a string
+        return str(value)
+    return value
+
+
+class DescriptionMatcher:
+    """All criteria of a config's descriptions, compiled once.
+
+    Matches like dcm2bids does, but every distinct (field, pattern) pair is
+    compiled once and evaluated once per sidecar, and results are memoized
+    by the values of the criteria fields, so a protocol repeated across
+    subjects is classified once.
+    """
+
+    def __init__(
+        self, descriptions, search_method="fnmatch", case_sensitive=True, name=""
+    ):
+        self.descriptions = descriptions
+        self.search_method = search_method
+        self.case_sensitive = case_sensitive
+        self._patterns = {}  # (field, pattern) -> compiled pattern(s)
+        self._criteria = []  # per description: list of (field, pattern) keys
+        for i, description in enumerate(descriptions):
+            keys = []
+            for field, pattern in (description.get("criteria") or {}).items():
+                key = (field, _freeze(pattern))
+                if key not in self._patterns:
+                    try:
+                        self._patterns[key] = self._compile(pattern)
+                    except (re.error, TypeError) as e:
+                        raise ValueError(
+                            f"{name}: invalid pattern {pattern!r} for {field} "
+                            f"in description {i}: {e}"
+                        )
+                keys.append(key)
+            self._criteria.append(keys)
+        self.fields = sorted({field for field, _ in self._patterns})
+        self._cache = {}
+
+    def _compile(self, pattern):
+        if isinstance(pattern, list):
+            return tuple(self._compile(p) for p in pattern)
+        if self.search_method == "re":
+            if not isinstance(pattern, str):
+                raise TypeError("regular expressions must be strings")
+            return re.compile(pattern)
+        pattern = str(pattern)
+        if not self.case_sensitive:
+            pattern = pattern.lower()
+        return re.compile(fnmatch.translate(pattern))
+
+    def _compare(self, name, compiled):
+        name = str(name)
+        if self.search_method != "re" and not self.case_sensitive:
+            name = name.lower()
+        return compiled.match(name) is not None
+
+    def _is_link(self, value, compiled):
+        if isinstance(value, tuple):
+            return (
+                isinstance(compiled, tuple)
+                and len(value) == len(compiled)
+                and all(self._compare(v, c) for v, c in zip(value, compiled))
+            )
+        if isinstance(compiled, tuple):
+            return False
+        return self._compare(value, compiled)
+
+    def key(self, data):
+        """Values of the criteria fields of a sidecar"""
+        return tuple(_freeze(data.get(field, "")) for field in self.fields)
+
+    def match(self, data):
+        """Indices of the descriptions matching the sidecar data"""
+        key = self.key(data)
+        if key in self._cache:
+            METRICS.count("pairing_cache_hits")
+            return self._cache[key]
+        values = dict(zip(self.fields, key))
+        links = {}
+        for pattern_key, compiled in self._patterns.items():
+            links[pattern_key] = self._is_link(values[pattern_key[0]], compiled)
+        matched = tuple(
+            i
+            for i, keys in enumerate(self._criteria)
+            if keys and all(links[k] for k in keys)
+        )
+        self._cache[key] = matched
+        return matched
+
+    def label(self, i):
+        description = self.descriptions[i]
+        label = f"{description['dataType']}/{description['modalityLabel']}"
+        if description.get("customLabels"):
+            label += f" ({description['customLabels']})"
+        return label
+
+
+def _cell(value):
+    return json.dumps(value) if isinstance(value, (list, dict)) else value
+
+
+def unpaired_sidecars(out_path, participant, session):
+    """Sidecars dcm2bids left in tmp_dcm2bids for a participant and session"""
+    prefix = f"sub-{participant}" + (f"_ses-{session}" if session else "")
+    return sorted(glob.glob(opj(out_path, TMP_DIR_NAME, prefix, "*.json")))
+
+
+def collect_unpaired(out_path, job):
+    """Report rows of the sidecars job left unpaired in out_path/tmp_dcm2bids.
+
+    dcm2bids leaves the dcm2niix output of every sidecar it could not pair
+    with exactly one description in tmp_dcm2bids. Those are matched again
+    here to tell sidecars without any description from those with several.
+    The next job of the same participant and session removes them, so this
+    runs right after every job.
+    """
+    rows = []
+    try:
+        _, matcher = load_config(job.config)
+        for path in unpaired_sidecars(out_path, job.participant, job.session):
+            _, data = read_sidecar(path, matcher.fields)
+            matched = matcher.match(data)
+            if len(matched) == 1:
+                # left over from a failed job
+                continue
+            rows.append(
+                {
+                    "participant_id": f"sub-{job.participant}",
+                    "session": job.session,
+                    "sidecar": os.path.relpath(path, out_path),
+                    "status": "unmatched" if not matched else "several",
+                    "descriptions": ", ".join(matcher.label(i) for i in matched),
+                    **{field: _cell(data.get(field, "")) for field in matcher.fields},
+                }
+            )
+    except (OSError, ValueError) as e:
+        logger.warning(
+            "%s: Could not check the unpaired sidecars: %s", job.directory, e
+        )
+    return rows
+
+
+def pairing_report(results):
+    """Unmatched and multiply matched sidecars of the job results, as a DataFrame"""
+    rows = [row for result in results for row in result.unpaired or []]
+    columns = list(REPORT_COLUMNS)
+    for row in rows:
+        columns += [field for field in row if field not in columns]
+    return pd.DataFrame(rows, columns=columns).sort_values(
+        ["participant_id", "session", "sidecar"], ignore_index=True
+    )
+
+
+def log_report(report, path):
+    if not len(report):
+        logger.info("Every sidecar was paired with exactly one description")
+        return
+    counts = report.status.value_counts()
+    logger.warning(
+        "%d sidecars unmatched, %d matched several descriptions, see %s",
+        counts.get("unmatched", 0),
+        counts.get("several", 0),
+        path,
+    )
+    fields = list(report.columns[5:])
+    if not fields:
+        return
+    for values, group in report.groupby(fields, sort=False, dropna=False):
+        values = values if isinstance(values, tuple) else (values,)
+        criteria = ", ".join(f"{f}={v!r}" for f, v in zip(fields, values))
+        if group.status.iloc[0] == "several":
+            logger.warning(
+                "Several Pairing (%d sidecars): %s -> %s",
+                len(group),
+                criteria,
+                group.descriptions.iloc[0],
+            )
+        else:
+            logger.info("No Pairing (%d sidecars): %s", len(group), criteria)
+
+
+def write_pairing_report(results, report_path):
+    """Write the pairing report of all jobs of a run to report_path"""
+    report = pairing_report(results)
+    write_tsv(report, report_path)
+    log_report(report, report_path)
+    return report
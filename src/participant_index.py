@@ -0,0 +1,104 @@
+# %%
+from collections import defaultdict
+
+from .ids import ids_long
+
+NOT_FOUND = str(-1)
+NGRAM = 3
+
+
+def normalize_id(id_):
+    return str(id_).strip()
+
+
+def ngrams(s, n=NGRAM):
+    return {s[i : i + n] for i in range(len(s) - n + 1)}
+
+
+class ParticipantIndex:
+    """Hashed lookup from any known id to its participant_id.
+
+    Ids from the id-list columns take precedence over participant_ids, and
+    earlier rows take precedence over later ones, as in a top-down scan of
+    participants.tsv. Substring matching is opt-in and backed by a trigram
+    index over all known ids, built on first use.
+    """
+
+    def __init__(self, df=None):
+        self._by_id = {}
+        self._by_participant = {}
+        self._rows = {}
+        self._rank = {}
+        self._ngrams = None
+        if df is not None:
+            self.update(df)
+
+    def __len__(self):
+        return len(self._rank)
+
+    def update(self, df):
+        for row, participant_id in zip(df.index, df.participant_id.values):
+            self.add(participant_id, row=row)
+        # first occurrence of every id in row order
+        long = ids_long(df).drop_duplicates("id")
+        for participant_id, id_ in zip(long.participant_id.values, long.id.values):
+            self.add_id(str(participant_id), id_)
+
+    def add(self, participant_id, ids=(), row=None):
+        """Register a participant with a list of its ids"""
+        participant_id = str(participant_id)
+        if participant_id not in self._rank:
+            self._rank[participant_id] = len(self._rank)
+        if row is not None:
+            self._rows.setdefault(participant_id, row)
+        self._by_participant.setdefault(normalize_id(participant_id), participant_id)
+        for id_ in ids:
+            self.add_id(participant_id, id_)
+
+    def add_id(self, participant_id, id_):
+        key = normalize_id(id_)
+        if key in self._by_id:
+            return
+        self._by_id[key] = participant_id
+        if self._ngrams is not None:
+            self._index_ngrams(key)
+
+    def row(self, participant_id):
+        """Row label of participant_id in the indexed DataFrame"""
+        return self._rows.get(participant_id)
+
+    def lookup(self, id_, substring=False):
+        key = normalize_id(id_)
+        if key in self._by_id:
+            return self._by_id[key]
+        if substring:
+            match = self._lookup_substring(key)
+            if match is not None:
+                return match
+        return self._by_participant.get(key, NOT_FOUND)
+
+    def _index_ngrams(self, key):
+        for gram in ngrams(key):
+            self._ngrams[gram].add(key)
+
+    def _lookup_substring(self, key):
+        if not key:
+            return None
+        if self._ngrams is None:
+            self._ngrams = defaultdict(set)
+            for k in self._by_id:
+                self._index_ngrams(k)
+
+        if len(key) < NGRAM:
+            # too short to be selective, check every id
+            candidates = self._by_id.keys()
+        else:
+            postings = sorted(
+                (self._ngrams.get(g, set()) for g in ngrams(key)), key=len
+            )
+            candidates = set.intersection(*postings)
+
+        matches = [self._by_id[k] for k in candidates if key in k]
+        if not matches:
+            return None
+        return min(matches, key=self._rank.__getitem__)
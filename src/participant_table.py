@@ -0,0 +1,61 @@
+# %%
+import os
+
+import pandas as pd
+
+
+def write_tsv(df, path):
+    """Write df as tsv to a temporary file next to path and rename it over path.
+
+    Readers never see a half written participants.tsv, and an interrupted
+    run leaves the previous version in place.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        df.to_csv(tmp, sep="\t", index=False)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class ParticipantTable:
+    """The participants DataFrame plus the subjects added during a run.
+
+    New subjects are buffered as dicts and concatenated to the frame in one
+    go when it is needed, instead of copying the whole frame per subject.
+    Rows are addressed by the label they have (or will have) in the frame,
+    which has a default RangeIndex.
+    """
+
+    def __init__(self, df):
+        self._df = df.reset_index(drop=True)
+        self._new = []
+
+    def __len__(self):
+        return len(self._df) + len(self._new)
+
+    def append(self, row):
+        """Buffer a new row, returns its label"""
+        self._new.append(row)
+        return len(self) - 1
+
+    def get(self, label, column):
+        """Cell of a row, the same list object for id list columns"""
+        if label >= len(self._df):
+            return self._new[label - len(self._df)].get(column)
+        return self._df.at[label, column]
+
+    def set(self, label, column, value):
+        if label >= len(self._df):
+            self._new[label - len(self._df)][column] = value
+        else:
+            self._df.at[label, column] = value
+
+    @property
+    def frame(self):
+        if self._new:
+            new = pd.DataFrame(self._new, dtype=object)
+            self._df = pd.concat([self._df, new], ignore_index=True)
+            self._new = []
+        return self._df
@@ -0,0 +1,137 @@
+# %%
+import json
+import os
+from os.path import join as opj
+
+import pandas as pd
+
+from .scheduler import Job
+
+PLAN_COLUMNS = [
+    "directory",
+    "source",
+    "bids_id",
+    "participant",
+    "session",
+    "n_files",
+    "n_bytes",
+    "est_seconds",
+    "config",
+    "out_path",
+    "force",
+    "fingerprint",
+]
+
+# rough cost model of one dcm2bids call: interpreter and dcm2bids start-up
+# plus dcm2niix reading the dicoms
+JOB_OVERHEAD_S = 0.3
+BYTES_PER_S = 50e6
+
+
+def estimate_seconds(n_bytes):
+    return JOB_OVERHEAD_S + n_bytes / BYTES_PER_S
+
+
+def directory_size(directory, filelist):
+    n_bytes = 0
+    for f in filelist:
+        try:
+            n_bytes += os.stat(opj(directory, f)).st_size
+        except OSError:
+            pass
+    return n_bytes
+
+
+def plan_row(job, filelist):
+    """One plan entry for a job, filelist are the files of job.directory"""
+    n_bytes = directory_size(job.directory, filelist)
+    return {
+        "directory": job.directory,
+        "source": job.source or job.directory,
+        "bids_id": "sub-" + job.participant,
+        "participant": job.participant,
+        "session": job.session,
+        "n_files": len(filelist),
+        "n_bytes": n_bytes,
+        "est_seconds": round(estimate_seconds(n_bytes), 3),
+        "config": job.config,
+        "out_path": job.out_path,
+        "force": job.force,
+        "fingerprint": job.fingerprint,
+    }
+
+
+def order_plan(rows):
+    """Plan DataFrame with all jobs of a (participant, session) next to each other.
+
+    dcm2bids shares a temporary directory per subject and session, so a shard
+    must get all of them. Keys keep the order they were discovered in.
+    """
+    plan = pd.DataFrame(rows, columns=PLAN_COLUMNS)
+    first_seen = plan.groupby(["participant", "session"], sort=False).ngroup()
+    return plan.iloc[first_seen.argsort(kind="stable")].reset_index(drop=True)
+
+
+def write_plan(plan, path):
+    if path.endswith(".parquet"):
+        # needs pyarrow or fastparquet
+        plan.to_parquet(path, index=False)
+    else:
+        # json.dump keeps the paths readable, pandas escapes every "/"
+        with open(path, "w") as f:
+            json.dump(json.loads(plan.to_json(orient="records")), f, indent=1)
+
+
+def read_plan(path):
+    if path.endswith(".parquet"):
+        plan = pd.read_parquet(path)
+    else:
+        plan = pd.read_json(path, orient="records", dtype=False)
+    plan = plan.reindex(columns=PLAN_COLUMNS)
+    plan = plan.astype({"participant": str, "session": str})
+    return plan.where(plan.notna(), None)
+
+
+def key_boundaries(plan):
+    """Indices at which a new (participant, session) group starts, and len(plan)"""
+    keys = list(zip(plan.participant, plan.session))
+    starts = [i for i in range(len(keys)) if i == 0 or keys[i] != keys[i - 1]]
+    return starts + [len(keys)]
+
+
+def shard_range(plan, shard, n_shards):
+    """[start, stop) of shard out of n_shards with about equal estimated time.
+
+    Boundaries never split the jobs of one (participant, session).
+    """
+    boundaries = key_boundaries(plan)
+    cumulative = plan.est_seconds.cumsum().tolist()
+    total = cumulative[-1] if cumulative else 0
+
+    def boundary(k):
+        if k == 0:
+            return 0
+        if k == n_shards:
+            return len(plan)
+        target = total * k / n_shards
+        # first group boundary whose preceding jobs reach the target
+        for b in boundaries:
+            if b > 0 and cumulative[b - 1] >= target:
+                return b
+        return len(plan)
+
+    return boundary(shard), boundary(shard + 1)
+
+
+def job_from_row(row):
+    return Job(
+        row["directory"],
+        row["participant"],
+        row["session"],
+        row["config"],
+        row["out_path"],
+        cost=int(row["n_files"]),
+        force=bool(row["force"]),
+        fingerprint=row["fingerprint"],
+        source=row["source"] if row["source"] != row["directory"] else None,
+    )
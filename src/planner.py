@@ -0,0 +1,471 @@
+# %%
+import collections
+import logging
+import os
+from os.path import join as opj
+
+import numpy as np
+import pandas as pd
+
+from .fingerprint import config_hash, outputs_exist, series_fingerprint
+from .grouping import group_directory, stage_series, write_manifest
+from .header_reader import DEFAULT_IN_FLIGHT, DEFAULT_READ_AHEAD, HeaderReader
+from .metrics import METRICS
+from .participant_index import NOT_FOUND, ParticipantIndex
+from .participant_table import ParticipantTable
+from .probe import extract_participant_info
+from .scan_index import FINAL_STATES, INDEX_DIR, dir_fingerprint
+from .scheduler import Job
+from .sessions import StudySessions
+
+logger = logging.getLogger(__name__)
+
+STAGING_DIR = "staging"
+MANIFEST_NAME = "series_manifest.jsonl"
+
+# a series to plan, source is the scanned directory of a staged series
+Series = collections.namedtuple(
+    "Series", ["directory", "filelist", "fingerprint", "dcm_info", "source"]
+)
+
+
+def get_max_bids_id(df):
+    # participant_ids given with --id need not be numbered
+    ids = pd.to_numeric(
+        df.participant_id.astype(str).str.split("-").str[1].str[-5:], errors="coerce"
+    ).dropna()
+    if len(ids) == 0:
+        return 0
+
+    max_id = int(np.max(np.array(ids)))
+    if max_id >= 1:
+        return max_id
+    else:
+        return 0
+
+
+def make_job(directory, bids_id, session, config_file_path, out_path, cost=0):
+    return Job(
+        directory, bids_id.split("-")[1], session, config_file_path, out_path, cost
+    )
+
+
+class Planner:
+    """Turn discovered dicom directories into dcm2bids jobs.
+
+    Assigns bids ids and sessions, adds new subjects to participants and keeps
+    the scan index up to date. With group_series, the dicoms of a directory
+    are bucketed by patient/study/series first and every series gets its own
+    job on a symlinked staging directory.
+
+    Headers are read by a HeaderReader with at most probe_workers reads in
+    flight. walk_ahead starts reading the headers of the next read_ahead
+    directories of the walk while the current one is planned.
+
+    Sessions are derived for a batch of series at once and are the same for
+    all series of a study, see sessions.StudySessions.
+
+    With subjects, only the dicoms of these participant_ids are converted,
+    also when they were converted before, and the scan index entries of
+    other subjects are left alone. Dicoms of unknown ids are assigned to
+    catch_all, if given.
+    """
+
+    def __init__(
+        self,
+        participants,
+        out_path,
+        config_file_path,
+        scan_index,
+        pathology="",
+        subjects=None,
+        catch_all=None,
+        full_rescan=False,
+        substring_match=False,
+        skip_converted=False,
+        group_series=False,
+        probe_workers=DEFAULT_IN_FLIGHT,
+        read_ahead=DEFAULT_READ_AHEAD,
+    ):
+        self.table = ParticipantTable(participants)
+        self.participant_index = ParticipantIndex(self.table.frame)
+        self.bids_id_count = get_max_bids_id(participants)
+        self.out_path = out_path
+        self.config_file_path = config_file_path
+        self.scan_index = scan_index
+        self.cfg_hash = config_hash(config_file_path)
+        self.pathology = pathology
+        self.subjects = subjects
+        self.catch_all = catch_all
+        self.full_rescan = full_rescan
+        self.substring_match = substring_match
+        self.skip_converted = skip_converted
+        self.group_series = group_series
+        self.reader = HeaderReader(probe_workers)
+        self.read_ahead = read_ahead
+        self.sessions = StudySessions(scan_index)
+        self._checked = {}
+
+        self.staging_root = opj(out_path, INDEX_DIR, STAGING_DIR)
+        self.manifest_path = opj(out_path, INDEX_DIR, MANIFEST_NAME)
+        if group_series:
+            os.makedirs(self.staging_root, exist_ok=True)
+            # the manifest describes the series of the current run only
+            open(self.manifest_path, "w").close()
+
+    def _check(self, directory, filelist):
+        """(fingerprint, index entry, True if directory is unchanged and done)"""
+        fingerprint = dir_fingerprint(directory, filelist)
+        entry = (
+            None if self.full_rescan else self.scan_index.lookup(directory, fingerprint)
+        )
+        done = (
+            entry is not None
+            and entry["status"] in FINAL_STATES
+            and not (
+                self.skip_converted
+                and entry["status"] == "converted"
+                and not self._still_converted(directory, entry)
+            )
+        )
+        return fingerprint, entry, done
+
+    def _still_converted(self, directory, entry):
+        """True if directory was converted with the current config and its
+        recorded outputs exist"""
+        if self.scan_index.series_record(directory)[1] != self.cfg_hash:
+            return False
+        participant = session = None
+        if entry["bids_id"] is not None and entry["session"] is not None:
+            participant, session = entry["bids_id"].split("-")[1], entry["session"]
+        return outputs_exist(
+            self.out_path,
+            self.scan_index.series_outputs(directory),
+            participant,
+            session,
+        )
+
+    def walk_ahead(self, walk):
+        """Yield the (directory, filelist) of walk, read_ahead items late.
+
+        The headers of the directories waiting in between are probed in the
+        background, unless the scan index says they are not needed.
+        """
+        waiting = collections.deque()
+        for directory, filelist in walk:
+            if self.read_ahead > 0:
+                checked = self._checked[directory] = self._check(directory, filelist)
+                _, entry, done = checked
+                if not (
+                    done
+                    or self.group_series
+                    or (entry is not None and entry["dcm_info"] is not None)
+                ):
+                    self.reader.submit_directory(directory, filelist)
+            waiting.append((directory, filelist))
+            if len(waiting) > self.read_ahead:
+                yield waiting.popleft()
+        while waiting:
+            yield waiting.popleft()
+
+    def walk_batches(self, walk):
+        """walk_ahead in lists of up to read_ahead items, for plan_batch"""
+        batch = []
+        for item in self.walk_ahead(walk):
+            batch.append(item)
+            if len(batch) >= max(self.read_ahead, 1):
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def discard(self, directory):
+        """Forget what walk_ahead read of directory, it is planned later"""
+        self._checked.pop(directory, None)
+        self.reader.discard(directory)
+
+    def plan_batch(self, batch):
+        """Return the jobs needed to convert the dicoms of the
+        (directory, filelist) items of batch.
+
+        The header info of all series is collected first, then their
+        sessions are derived together.
+        """
+        series = []
+        sources = {}
+        for directory, filelist in batch:
+            series += self._find_series(directory, filelist, sources)
+        sessions = self.sessions.assign([s.dcm_info for s in series])
+
+        jobs = []
+        for s, session in zip(series, sessions):
+            job = self._plan_series(
+                s.directory, s.filelist, s.fingerprint, s.dcm_info, session
+            )
+            if job is not None:
+                job.source = s.source
+                jobs.append(job)
+        # the status of a split source directory follows its series jobs
+        queued = {job.source for job in jobs}
+        for source, fingerprint in sources.items():
+            self.scan_index.record(
+                source,
+                fingerprint,
+                None,
+                status="queued" if source in queued else "probed",
+            )
+        return jobs
+
+    def _find_series(self, directory, filelist, sources):
+        """Series of directory to plan, split directories are added to sources"""
+        checked = self._checked.pop(directory, None)
+        fingerprint, entry, done = checked or self._check(directory, filelist)
+        if done and not (
+            self.subjects is not None and entry["bids_id"] in self.subjects
+        ):
+            logger.debug(
+                "%s: Unchanged since last run (%s)", directory, entry["status"]
+            )
+            METRICS.count("dirs_unchanged")
+            return []
+
+        if self.group_series:
+            return self._group_series(directory, filelist, fingerprint, sources)
+
+        if entry is not None and entry["dcm_info"] is not None:
+            # unchanged, but not converted yet: reuse the indexed header info
+            dcm_info = entry["dcm_info"]
+        else:
+            # find all subfolders containing dicoms:
+            logger.debug("%s: Trying to find dcm files...", directory)
+            with METRICS.stage("probe"):
+                fname, dcm = self.reader.probe_directory(directory, filelist)
+
+            if fname is not None:
+                logger.debug("%s: Found dcm files!", directory)
+                try:
+                    dcm_info = extract_participant_info(
+                        os.path.join(directory, fname), dcm
+                    )
+                except:
+                    logger.warning(
+                        "%s: Could not read dcm header", os.path.join(directory, fname)
+                    )
+                    return []
+            else:
+                logger.debug("%s: Did not find dcm files...", directory)
+                self.scan_index.record(directory, fingerprint, None, status="no_dicom")
+                return []
+
+        return [Series(directory, filelist, fingerprint, dcm_info, None)]
+
+    def _group_series(self, directory, filelist, fingerprint, sources):
+        logger.debug("%s: Grouping dcm files by series...", directory)
+        with METRICS.stage("probe"):
+            groups = group_directory(directory, filelist, reader=self.reader)
+        if not groups:
+            logger.debug("%s: Did not find dcm files...", directory)
+            self.scan_index.record(directory, fingerprint, None, status="no_dicom")
+            return []
+
+        if len(groups) == 1:
+            # nothing to split, convert the directory itself
+            group = groups[0]
+            dcm_info = extract_participant_info(
+                opj(directory, group.first_file), group.header
+            )
+            return [Series(directory, filelist, fingerprint, dcm_info, None)]
+
+        logger.info("%s: Found %d series", directory, len(groups))
+        staged_dirs = [stage_series(g, directory, self.staging_root) for g in groups]
+        write_manifest(self.manifest_path, directory, groups, staged_dirs)
+        sources[directory] = fingerprint
+        return [
+            Series(
+                staged,
+                group.files,
+                None,
+                extract_participant_info(
+                    opj(directory, group.first_file), group.header
+                ),
+                directory,
+            )
+            for group, staged in zip(groups, staged_dirs)
+        ]
+
+    def _plan_series(self, directory, filelist, fingerprint, dcm_info, session):
+        """Job for a single series, None if it is skipped.
+
+        Staged series are not recorded in the scan index (fingerprint None),
+        their source directory is.
+        """
+
+        def record(*args):
+            if fingerprint is not None:
+                self.scan_index.record(directory, fingerprint, dcm_info, *args)
+
+        logger.debug("%s: Searching for bids ID for %s", directory, dcm_info["id"])
+
+        # greifswald addon
+        if dcm_info["id"] == "":
+            logger.debug("%s: Could not find ID", directory)
+            record(None, None, "no_id")
+            return None
+
+        id_ = dcm_info["id"]  # .split("_")[0]
+
+        with METRICS.stage("match"):
+            bids_id = self.participant_index.lookup(id_, substring=self.substring_match)
+        if session is None:
+            logger.debug("%s: Could not find session for %s", directory, id_)
+            session = "1"
+        logger.debug("%s: Found session %s for %s", directory, session, id_)
+        if self.subjects is not None:
+            if bids_id == NOT_FOUND and self.catch_all is not None:
+                with METRICS.stage("match"):
+                    bids_id = self._assign(directory, id_, self.catch_all)
+            if bids_id not in self.subjects:
+                # another subject's dicoms, keep its index entry as it is
+                return None
+        else:
+            with METRICS.stage("match"):
+                bids_id = self._assign(directory, id_, bids_id)
+
+        job = make_job(
+            directory,
+            bids_id,
+            session,
+            self.config_file_path,
+            self.out_path,
+            len(filelist),
+        )
+        if self.skip_converted:
+            with METRICS.stage("fingerprint"):
+                job.fingerprint = series_fingerprint(directory, filelist, self.reader)
+            unchanged = self.scan_index.series_record(directory) == (
+                job.fingerprint,
+                self.cfg_hash,
+            )
+            if unchanged and outputs_exist(
+                self.out_path,
+                self.scan_index.series_outputs(directory),
+                job.participant,
+                session,
+            ):
+                logger.debug("%s: Already converted, skipping", directory)
+                METRICS.count("series_skipped")
+                record(bids_id, session, "converted")
+                return None
+
+        record(bids_id, session, "queued")
+        METRICS.count("jobs_planned")
+        return job
+
+    def _assign(self, directory, id_, bids_id):
+        """Return the bids id for id_, adding a new subject if there is none"""
+        if bids_id == NOT_FOUND:
+            bids_id = "sub-" + self.pathology + str(self.bids_id_count + 1).zfill(5)
+            self.bids_id_count += 1
+            logger.info("%s: Creating new subject %s for %s", directory, bids_id, id_)
+            METRICS.count("subjects_created")
+
+            info = {}
+            info["participant_id"] = bids_id
+            info["osepa_id"] = []
+            info["lab_id"] = []
+            info["neurorad_id"] = []
+            info["dcm_header_id"] = [id_]
+            row = self.table.append(info)
+            self.participant_index.add(bids_id, [id_], row=row)
+        else:
+            logger.debug("%s: Found entry %s for %s", directory, bids_id, id_)
+            dcm_header_ids = self.table.get(
+                self.participant_index.row(bids_id), "dcm_header_id"
+            )
+            if id_ not in dcm_header_ids:
+                dcm_header_ids.append(id_)
+                self.participant_index.add_id(bids_id, id_)
+        return bids_id
+
+    def locate(self, walk):
+        """Yield (directory, bids_id) for the directories of walk holding
+        dicoms of one of the subjects.
+
+        Reads one header per directory, directories the scan index knows are
+        not read again. Nothing is recorded.
+        """
+        for directory, filelist in self.walk_ahead(walk):
+            checked = self._checked.pop(directory, None)
+            _, entry, done = checked or self._check(directory, filelist)
+            if entry is not None and (done or entry["bids_id"] is not None):
+                bids_id = entry["bids_id"]
+            else:
+                fname, dcm = self.reader.probe_directory(directory, filelist)
+                if fname is None:
+                    continue
+                try:
+                    dcm_info = extract_participant_info(opj(directory, fname), dcm)
+                except Exception:
+                    continue
+                bids_id = self.participant_index.lookup(
+                    dcm_info["id"], substring=self.substring_match
+                )
+            if bids_id in self.subjects:
+                yield directory, bids_id
+
+    def known_locations(self, bids_id):
+        """(folder_paths, directories) of bids_id from participants and the scan index"""
+        row = self.participant_index.row(bids_id)
+        folder_path = self.table.get(row, "folder_path") if row is not None else None
+        folder_paths = []
+        if isinstance(folder_path, str):
+            folder_paths = [
+                p for p in folder_path.split(os.pathsep) if os.path.isdir(p)
+            ]
+        directories = [
+            d for d in self.scan_index.directories_of(bids_id) if os.path.isdir(d)
+        ]
+        return folder_paths, directories
+
+    def set_folder_path(self, bids_id, paths):
+        self.table.set(
+            self.participant_index.row(bids_id), "folder_path", os.pathsep.join(paths)
+        )
+
+    @property
+    def participants(self):
+        """participants DataFrame including the subjects added so far"""
+        return self.table.frame
+
+    def finish(self, results):
+        """Record the outcome of the conversion jobs in the scan index"""
+        record_results(self.scan_index, results, self.cfg_hash)
+
+
+def record_results(scan_index, results, cfg_hash):
+    failed = {}
+    source_outputs = {}
+    for result in results:
+        source = result.job.source or result.job.directory
+        failed[source] = failed.get(source, False) or result.returncode != 0
+        if result.returncode == 0 and result.job.fingerprint is not None:
+            scan_index.record_series(
+                result.job.directory,
+                result.job.fingerprint,
+                cfg_hash,
+                result.outputs,
+            )
+        if result.returncode == 0 and result.job.source is not None:
+            outputs = source_outputs.setdefault(
+                result.job.source,
+                set(scan_index.series_outputs(result.job.source) or []),
+            )
+            outputs.update(result.outputs or [])
+        if result.returncode != 0:
+            # only converted directories count as the original of a duplicate
+            scan_index.forget_instances(result.job.directory)
+    for source, outputs in source_outputs.items():
+        # lets an unchanged source directory be skipped as a whole
+        scan_index.record_series(source, None, cfg_hash, outputs)
+    for source, any_failed in failed.items():
+        scan_index.set_status(source, "failed" if any_failed else "converted")
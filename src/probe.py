@@ -0,0 +1,223 @@
+# %%
+import logging
+import os
+import threading
+
+import pydicom as pydi
+
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# dicom tags needed for participant info, (group, element) as in the header
+INFOTAGS = {
+    "study_date": ("0x0008", "0x0020"),
+    "series_date": ("0x0008", "0x0021"),
+    "acquisition_date": ("0x0008", "0x0022"),
+    "content_date": ("0x0008", "0x0023"),
+    "institution_name": ("0x0008", "0x0080"),
+    "name": ("0x0010", "0x0010"),
+    "id": ("0x0010", "0x0020"),
+    "dob": ("0x0010", "0x0030"),
+    "sex": ("0x0010", "0x0040"),
+    #'other_ids':("0x0010","0x1000"),
+    #'other_names':("0x0010","0x1001"),
+    #'birth_name':("0x0010","0x1005"),
+    # 'age':("0x0010","0x1010"),
+    "size": ("0x0010", "0x1020"),
+    "weight": ("0x0010", "0x1030"),
+    "study_uid": ("0x0020", "0x000D"),
+}
+
+PREAMBLE_LENGTH = 128
+DICOM_MAGIC = b"DICM"
+# never dicom, skipped without opening them
+NON_DICOM_EXTENSIONS = {
+    ".json",
+    ".nii",
+    ".gz",
+    ".bval",
+    ".bvec",
+    ".txt",
+    ".log",
+    ".csv",
+    ".tsv",
+    ".xml",
+    ".html",
+    ".pdf",
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".zip",
+    ".tmp",
+    ".part",  # partly written by structure_dcms
+}
+# leading bytes read with a single call, enough for most headers including
+# large private tags. Reads past it fall through to the file.
+HEADER_READ_SIZE = 64 * 1024
+
+
+def build_specific_tags(infotags=INFOTAGS):
+    return [pydi.tag.Tag(infotags[key]) for key in infotags]
+
+
+SPECIFIC_TAGS = build_specific_tags()
+
+
+def has_dicom_magic(fp):
+    """Check the 128 byte preamble followed by 'DICM' and rewind fp"""
+    preamble = fp.read(PREAMBLE_LENGTH + len(DICOM_MAGIC))
+    fp.seek(0)
+    return (
+        len(preamble) == PREAMBLE_LENGTH + len(DICOM_MAGIC)
+        and preamble[PREAMBLE_LENGTH:] == DICOM_MAGIC
+    )
+
+
+class PrefixReader:
+    """Read-only binary file object serving the first bytes of fp from a buffer.
+
+    pydicom parses the header with many small reads, each of which can be a
+    network round trip on NFS. Here the prefix is read with one call and
+    only reads beyond it go to the file, unless the prefix is the whole file.
+    """
+
+    def __init__(self, fp, buffer, n_bytes, whole_file=False):
+        self._fp = fp
+        self._buf = memoryview(buffer)[:n_bytes]
+        self._whole_file = whole_file
+        self._pos = 0
+        self.name = getattr(fp, "name", "<buffer>")
+        self.bytes_read = n_bytes
+
+    def read(self, size=-1):
+        n_prefix = len(self._buf)
+        if self._pos < n_prefix:
+            end = n_prefix if size is None or size < 0 else self._pos + size
+            data = bytes(self._buf[self._pos : end])
+            self._pos += len(data)
+            if size is not None and 0 <= size == len(data):
+                return data
+            size = -1 if size is None or size < 0 else size - len(data)
+            return data + self._read_file(size)
+        return self._read_file(size)
+
+    def _read_file(self, size):
+        if self._whole_file:
+            return b""
+        self._fp.seek(self._pos)
+        data = self._fp.read(size)
+        self._pos += len(data)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = self._fp.seek(offset, whence)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+_local = threading.local()
+
+
+def _read_buffer(size):
+    """Buffer of at least size bytes, reused by all reads of a thread"""
+    buffer = getattr(_local, "buffer", None)
+    if buffer is None or len(buffer) < size:
+        buffer = _local.buffer = bytearray(size)
+    return buffer
+
+
+def read_header(fp, specific_tags=SPECIFIC_TAGS):
+    """Read only the requested header tags from an open binary file object.
+
+    Returns None if fp does not start with a dicom preamble.
+    """
+    if not has_dicom_magic(fp):
+        return None
+    return pydi.dcmread(fp, stop_before_pixels=True, specific_tags=specific_tags)
+
+
+def probe_file(path, specific_tags=SPECIFIC_TAGS, read_size=HEADER_READ_SIZE):
+    """Header of path read through a prefix buffer, None if it is no dicom"""
+    METRICS.count("files_probed")
+    try:
+        with open(path, "rb") as fp:
+            buffer = _read_buffer(read_size)
+            # a single read, the buffered file would try again to fill it
+            n_bytes = fp.raw.readinto(memoryview(buffer)[:read_size])
+            # network file systems may return less than asked before the end
+            whole_file = os.fstat(fp.fileno()).st_size <= n_bytes
+            reader = PrefixReader(fp, buffer, n_bytes, whole_file)
+            try:
+                return read_header(reader, specific_tags)
+            finally:
+                METRICS.count("bytes_read", reader.bytes_read)
+    except Exception:
+        # could not read file as dcm
+        return None
+
+
+def is_candidate(filename):
+    """False for files that are never dicom, the preamble decides about the rest.
+
+    Dicoms come as .dcm, .IMA, numbered (IM.0001) or without extension, so
+    only known other formats, hidden files and DICOMDIR (a dicom without
+    images) are skipped without opening them.
+    """
+    if filename.startswith(".") or filename.upper() == "DICOMDIR":
+        return False
+    _, ext = os.path.splitext(filename)
+    return ext.lower() not in NON_DICOM_EXTENSIONS
+
+
+def probe_directory(directory, filelist, specific_tags=SPECIFIC_TAGS):
+    """Return (filename, header) of the first readable dicom in filelist or (None, None)"""
+    for f in filelist:
+        if not is_candidate(f):
+            continue
+        dcm = probe_file(os.path.join(directory, f), specific_tags)
+        if dcm is not None:
+            return f, dcm
+    return None, None
+
+
+def extract_participant_info(dcm_path, dcm=None):
+    if not os.path.isfile(dcm_path):
+        raise ValueError
+    # return dict with participant info from dcm header
+    infotags = INFOTAGS
+    subject_info = {}
+
+    for key in infotags:
+        subject_info[key] = []
+    # for f in os.listdir(dcm_path):
+
+    if dcm is None:
+        # header only, pixel data is never needed here
+        dcm = pydi.dcmread(
+            dcm_path, stop_before_pixels=True, specific_tags=SPECIFIC_TAGS
+        )
+    for key in infotags:
+        tg = pydi.tag.Tag(infotags[key])
+        if tg in dcm:
+            if (
+                str(dcm[tg].value) not in subject_info[key]
+                and str(dcm[tg].value) != ""
+                and str(dcm[tg].value) is not None
+            ):
+                subject_info[key].append(str(dcm[tg].value))
+
+    returnDict = {}
+    for key in subject_info:
+        logger.debug("%s %s", key, subject_info[key])
+        returnDict[key] = ",".join(subject_info[key])
+
+    return returnDict
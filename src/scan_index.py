@@ -0,0 +1,237 @@
+# %%
+import json
+import os
+import sqlite3
+import time
+from os.path import join as opj
+
+INDEX_DIR = ".cvt2bids"
+INDEX_NAME = "scan_index.sqlite"
+
+# directories with one of these states are not touched again while unchanged
+FINAL_STATES = ("converted", "no_dicom", "no_id", "duplicate")
+
+
+def dir_fingerprint(directory, filelist):
+    """(mtime_ns, inode, file count) of a directory, costs a single stat"""
+    st = os.stat(directory)
+    return st.st_mtime_ns, st.st_ino, len(filelist)
+
+
+class ScanIndex:
+    """On-disk index of scanned dicom directories under out_path/.cvt2bids/
+
+    Stores the fingerprint, extracted dcm_info, assigned bids_id/session and
+    conversion status of every directory seen by a previous run.
+    """
+
+    def __init__(self, out_path, commit_every=500):
+        index_dir = opj(out_path, INDEX_DIR)
+        os.makedirs(index_dir, exist_ok=True)
+        self.path = opj(index_dir, INDEX_NAME)
+        self.commit_every = commit_every
+        self._pending = 0
+        self.con = sqlite3.connect(self.path)
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS directories (
+                directory TEXT PRIMARY KEY,
+                mtime_ns INTEGER,
+                inode INTEGER,
+                n_files INTEGER,
+                dcm_info TEXT,
+                bids_id TEXT,
+                session TEXT,
+                status TEXT,
+                updated REAL
+            )
+            """)
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS series (
+                directory TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                config_hash TEXT,
+                outputs TEXT
+            )
+            """)
+        columns = [row[1] for row in self.con.execute("PRAGMA table_info(series)")]
+        if "outputs" not in columns:
+            # index of an older version, its series are converted once more
+            self.con.execute("ALTER TABLE series ADD COLUMN outputs TEXT")
+        # SOPInstanceUIDs of the directories converted with --dedup
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS instances (
+                uid TEXT,
+                directory TEXT,
+                PRIMARY KEY (uid, directory)
+            ) WITHOUT ROWID
+            """)
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS instances_directory ON instances (directory)"
+        )
+        # the session label every study got, see sessions.StudySessions
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS studies (
+                patient_id TEXT,
+                study_uid TEXT,
+                session TEXT,
+                PRIMARY KEY (patient_id, study_uid)
+            ) WITHOUT ROWID
+            """)
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS sidecars (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER,
+                fields TEXT
+            )
+            """)
+        self.con.commit()
+
+    def lookup(self, directory, fingerprint):
+        """Return the stored entry if the directory is unchanged, else None"""
+        row = self.con.execute(
+            "SELECT mtime_ns, inode, n_files, dcm_info, bids_id, session, status "
+            "FROM directories WHERE directory = ?",
+            (directory,),
+        ).fetchone()
+        if row is None or tuple(row[:3]) != tuple(fingerprint):
+            return None
+        return {
+            "dcm_info": json.loads(row[3]) if row[3] else None,
+            "bids_id": row[4],
+            "session": row[5],
+            "status": row[6],
+        }
+
+    def record(
+        self, directory, fingerprint, dcm_info, bids_id=None, session=None, status=""
+    ):
+        self.con.execute(
+            "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                directory,
+                *fingerprint,
+                json.dumps(dcm_info) if dcm_info is not None else None,
+                bids_id,
+                session,
+                status,
+                time.time(),
+            ),
+        )
+        self._maybe_commit()
+
+    def directories_of(self, bids_id):
+        """Directories whose dicoms were assigned to bids_id"""
+        return [
+            row[0]
+            for row in self.con.execute(
+                "SELECT directory FROM directories WHERE bids_id = ?", (bids_id,)
+            )
+        ]
+
+    def set_status(self, directory, status):
+        self.con.execute(
+            "UPDATE directories SET status = ?, updated = ? WHERE directory = ?",
+            (status, time.time(), directory),
+        )
+        self._maybe_commit()
+
+    def series_record(self, directory):
+        """(fingerprint, config_hash) of the last successful conversion"""
+        row = self.con.execute(
+            "SELECT fingerprint, config_hash FROM series WHERE directory = ?",
+            (directory,),
+        ).fetchone()
+        return tuple(row) if row is not None else (None, None)
+
+    def series_outputs(self, directory):
+        """Files dcm2bids wrote for directory, relative to out_path, None if unknown"""
+        row = self.con.execute(
+            "SELECT outputs FROM series WHERE directory = ?", (directory,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None and row[0] else None
+
+    def record_series(self, directory, fingerprint, config_hash, outputs=None):
+        self.con.execute(
+            "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?)",
+            (
+                directory,
+                fingerprint,
+                config_hash,
+                json.dumps(sorted(outputs)) if outputs is not None else None,
+            ),
+        )
+        self._maybe_commit()
+
+    def record_instances(self, directory, uids):
+        """Replace the SOPInstanceUIDs stored for directory"""
+        self.con.execute("DELETE FROM instances WHERE directory = ?", (directory,))
+        self.con.executemany(
+            "INSERT OR IGNORE INTO instances VALUES (?, ?)",
+            [(uid, directory) for uid in uids],
+        )
+        self._maybe_commit()
+
+    def forget_instances(self, directory):
+        self.con.execute("DELETE FROM instances WHERE directory = ?", (directory,))
+        self._maybe_commit()
+
+    def instance_directories(self, uid):
+        """Directories holding an instance with SOPInstanceUID uid"""
+        return [
+            row[0]
+            for row in self.con.execute(
+                "SELECT directory FROM instances WHERE uid = ?", (uid,)
+            )
+        ]
+
+    def instances_of(self, directory):
+        return frozenset(
+            row[0]
+            for row in self.con.execute(
+                "SELECT uid FROM instances WHERE directory = ?", (directory,)
+            )
+        )
+
+    def load_studies(self):
+        """{(patient_id, study_uid): session} of all studies seen"""
+        return {
+            (patient_id, study_uid): session
+            for patient_id, study_uid, session in self.con.execute(
+                "SELECT patient_id, study_uid, session FROM studies"
+            )
+        }
+
+    def record_studies(self, rows):
+        """rows of (patient_id, study_uid, session), known studies keep theirs"""
+        self.con.executemany("INSERT OR IGNORE INTO studies VALUES (?, ?, ?)", rows)
+        self._maybe_commit()
+
+    def load_sidecars(self):
+        """{path: (mtime_ns, fields)} of all cached sidecars"""
+        return {
+            path: (mtime_ns, json.loads(fields))
+            for path, mtime_ns, fields in self.con.execute(
+                "SELECT path, mtime_ns, fields FROM sidecars"
+            )
+        }
+
+    def store_sidecars(self, rows):
+        """rows of (path, mtime_ns, {field: value})"""
+        self.con.executemany(
+            "INSERT OR REPLACE INTO sidecars VALUES (?, ?, ?)",
+            [(path, mtime_ns, json.dumps(fields)) for path, mtime_ns, fields in rows],
+        )
+        self.commit()
+
+    def _maybe_commit(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.con.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.con.close()
@@ -0,0 +1,324 @@
+# %%
+import asyncio
+import dataclasses
+import heapq
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+
+from .backends import make_backend
+from .fingerprint import session_files, written_files
+from .pairing import collect_unpaired
+from .metrics import METRICS, percentile
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    """A single dcm2bids call for one dicom directory"""
+
+    directory: str
+    participant: str
+    session: str
+    config: str
+    out_path: str
+    cost: int = 0  # e.g. number of dicom files, larger jobs are started first
+    force: bool = True
+    fingerprint: str = None  # of the dicoms, recorded once converted
+    source: str = None  # scanned directory, if directory is a staged series of it
+
+    @property
+    def cmd(self):
+        cmd = [
+            "dcm2bids",
+            "-d",
+            self.directory,
+            "-p",
+            self.participant,
+            "-c",
+            self.config,
+            "-o",
+            self.out_path,
+        ]
+        if self.force:
+            cmd.append("--forceDcm2niix")
+        return cmd + ["-s", self.session]
+
+    @property
+    def key(self):
+        # dcm2bids works in out_path/tmp_dcm2bids/sub-<participant>_ses-<session>,
+        # jobs sharing that directory must not run at the same time
+        return self.participant, self.session
+
+
+@dataclass
+class JobResult:
+    job: Job
+    returncode: int
+    wall_time: float
+    stderr: str = ""  # tail of what dcm2bids wrote to stderr
+    outputs: list = None  # files written to the session directory, relative to out_path
+    unpaired: list = None  # pairing report rows of the sidecars left in tmp_dcm2bids
+
+
+@dataclass
+class SchedulerStats:
+    started: float = 0.0
+    finished: float = 0.0
+    queue_depths: list = field(default_factory=list)
+    wall_times: list = field(default_factory=list)
+    failed: int = 0
+    retried: int = 0
+
+    def report(self):
+        n = len(self.wall_times)
+        elapsed = max(self.finished - self.started, 1e-9)
+        lines = [
+            f"jobs run: {n}, failed: {self.failed}, retried: {self.retried}, "
+            f"elapsed: {elapsed:.1f}s, "
+            f"throughput: {n / elapsed * 60:.2f} jobs/min"
+        ]
+        if self.queue_depths:
+            lines.append(
+                f"queue depth: max {max(self.queue_depths)}, "
+                f"mean {sum(self.queue_depths) / len(self.queue_depths):.1f}"
+            )
+        if n:
+            lines.append(
+                "job wall time [s]: "
+                + ", ".join(
+                    f"{name} {value:.1f}"
+                    for name, value in zip(
+                        ["min", "p50", "p90", "max"],
+                        [percentile(self.wall_times, q) for q in (0, 50, 90, 100)],
+                    )
+                )
+            )
+        return "\n".join(lines)
+
+
+class Scheduler:
+    """Run dcm2bids jobs on an asyncio event loop, at most n_jobs at a time.
+
+    The event loop runs in a background thread, so jobs can be submitted
+    while discovery is still running. Pending jobs are started largest
+    first. Jobs with the same (participant, session) key are never run
+    concurrently. With a Scratch, jobs run in their own scratch directory
+    and are only started while the scratch usage cap allows it.
+    """
+
+    def __init__(
+        self, n_jobs=1, backend="subprocess", journal=None, retries=0, scratch=None
+    ):
+        self.n_jobs = max(int(n_jobs), 1)
+        self.backend = backend
+        self.journal = journal
+        self.retries = retries
+        self.scratch = scratch
+        self._sizes = {}
+        self.stats = SchedulerStats()
+        self._thread = None
+        self._ready = threading.Event()
+
+    def run(self, jobs):
+        self.start()
+        for job in jobs:
+            self.submit(job)
+        return self.join()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=asyncio.run, args=(self._main(),), daemon=True
+        )
+        self._thread.start()
+        self._ready.wait()
+
+    def submit(self, job):
+        if self.scratch is not None and self.scratch.max_bytes is not None:
+            # stat the dicoms in the submitting thread, not on the event loop
+            self._sizes[job.directory] = self.scratch.estimate(job)
+        asyncio.run_coroutine_threadsafe(self._push(job), self._loop).result()
+
+    def take_results(self):
+        """Results of the jobs finished since the last call, while jobs are running.
+
+        Taken results are not returned by join again.
+        """
+        return asyncio.run_coroutine_threadsafe(self._take(), self._loop).result()
+
+    def join(self):
+        """Wait until all submitted jobs are done and return their results"""
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._results
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._pending = []
+        self._counter = itertools.count()
+        self._busy = set()
+        self._scratch_in_use = 0
+        self._attempts = {}
+        self._results = []
+        self._closed = False
+        self._error = None
+        self._cond = asyncio.Condition()
+        self._backend = make_backend(self.backend, self.n_jobs)
+        self.stats.started = time.monotonic()
+        self._ready.set()
+        try:
+            await asyncio.gather(*[self._worker() for _ in range(self.n_jobs)])
+        except Exception as e:
+            self._error = e
+        finally:
+            self._backend.close()
+        self.stats.finished = time.monotonic()
+
+    async def _push(self, job):
+        if self.journal is not None:
+            self.journal.queued(job)
+        async with self._cond:
+            heapq.heappush(self._pending, (-job.cost, next(self._counter), job))
+            self._cond.notify()
+
+    async def _take(self):
+        async with self._cond:
+            results, self._results = self._results, []
+        return results
+
+    async def _close(self):
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _pop_runnable(self):
+        skipped = []
+        job = None
+        while self._pending:
+            item = heapq.heappop(self._pending)
+            if item[2].key in self._busy or not self._fits_scratch(item[2]):
+                skipped.append(item)
+                continue
+            job = item[2]
+            break
+        for item in skipped:
+            heapq.heappush(self._pending, item)
+        return job
+
+    def _fits_scratch(self, job):
+        if self.scratch is None:
+            return True
+        return self.scratch.fits(
+            self._sizes.get(job.directory, 0), self._scratch_in_use
+        )
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                job = self._pop_runnable()
+                while job is None:
+                    if self._closed and not self._pending:
+                        return
+                    # nothing queued yet, or only jobs of busy subject/session
+                    # pairs or too large for the scratch left
+                    await self._cond.wait()
+                    job = self._pop_runnable()
+                self._busy.add(job.key)
+                self._scratch_in_use += self._sizes.get(job.directory, 0)
+                self.stats.queue_depths.append(len(self._pending))
+
+            attempt = self._attempts.get(job.directory, 0)
+            if self.journal is not None:
+                self.journal.running(job, attempt)
+            result = await self._execute(job)
+            if self.journal is not None:
+                self.journal.finished(result, attempt)
+
+            async with self._cond:
+                self._busy.discard(job.key)
+                self._scratch_in_use -= self._sizes.get(job.directory, 0)
+                self.stats.wall_times.append(result.wall_time)
+                if result.returncode != 0 and attempt < self.retries:
+                    logger.warning(
+                        "%s: Retrying (%d of %d)",
+                        job.directory,
+                        attempt + 1,
+                        self.retries,
+                    )
+                    self._attempts[job.directory] = attempt + 1
+                    heapq.heappush(self._pending, (-job.cost, next(self._counter), job))
+                    self.stats.retried += 1
+                else:
+                    self._results.append(result)
+                    if result.returncode != 0:
+                        self.stats.failed += 1
+                self._cond.notify_all()
+
+    async def _execute(self, job):
+        run_job = job
+        if self.scratch is not None:
+            run_job = dataclasses.replace(job, out_path=self.scratch.job_dir(job))
+            self.scratch.prepare(run_job.out_path)
+        loop = asyncio.get_running_loop()
+        # jobs of a session never run at the same time, what is new in its
+        # directory afterwards was written by this job
+        before = await loop.run_in_executor(
+            None, session_files, job.out_path, job.participant, job.session
+        )
+        logger.info("Running: %s", " ".join(run_job.cmd))
+        t0 = time.monotonic()
+        try:
+            returncode, stderr = await self._backend.execute(run_job)
+        except Exception as e:
+            logger.error("%s: Could not run dcm2bids: %s", job.directory, e)
+            returncode, stderr = -1, str(e)
+        with METRICS.stage("pairing_collect"):
+            # before the next job of this participant and session clears them
+            unpaired = await loop.run_in_executor(
+                None, collect_unpaired, run_job.out_path, job
+            )
+        if self.scratch is not None:
+            try:
+                with METRICS.stage("scratch_collect"):
+                    await loop.run_in_executor(
+                        None,
+                        self.scratch.collect,
+                        run_job.out_path,
+                        job.out_path,
+                        returncode == 0,
+                    )
+            except OSError as e:
+                logger.error(
+                    "%s: Could not move the output to %s: %s",
+                    job.directory,
+                    job.out_path,
+                    e,
+                )
+                if returncode == 0:
+                    returncode, stderr = -1, str(e)
+        wall_time = time.monotonic() - t0
+        outputs = None
+        if returncode == 0:
+            after = await loop.run_in_executor(
+                None, session_files, job.out_path, job.participant, job.session
+            )
+            outputs = written_files(before, after)
+        if returncode != 0:
+            logger.warning("%s: dcm2bids exited with %s", job.directory, returncode)
+        METRICS.count("jobs_run")
+        METRICS.count("jobs_failed", int(returncode != 0))
+        METRICS.observe("job_wall_time", wall_time)
+        METRICS.event(
+            name="job",
+            directory=job.directory,
+            participant=job.participant,
+            session=job.session,
+            returncode=returncode,
+            wall_time=wall_time,
+        )
+        return JobResult(job, returncode, wall_time, stderr, outputs, unpaired)
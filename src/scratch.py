@@ -0,0 +1,91 @@
+# %%
+import hashlib
+import logging
+import os
+import shutil
+from os.path import join as opj
+
+from .metrics import METRICS
+from .pairing import TMP_DIR_NAME
+from .plan import directory_size
+
+logger = logging.getLogger(__name__)
+
+# what is kept of tmp_dcm2bids: logs and the sidecars of unpaired series, not
+# their images
+TMP_KEEP_SUFFIXES = (".log", ".json")
+
+
+class Scratch:
+    """Local directories for the temporary work of dcm2bids jobs.
+
+    Every job runs dcm2bids with its own directory below root as output
+    directory, so dcm2niix writes and dcm2bids renames on local storage.
+    Afterwards the BIDS files are moved to the real out_path in one pass and
+    the job directory is removed.
+
+    max_bytes caps the dicom bytes of the jobs using scratch at the same
+    time, a job larger than that still runs when scratch is otherwise empty.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def job_dir(self, job):
+        """Directory of a job, keyed by its dicom directory"""
+        key = hashlib.sha1(job.directory.encode()).hexdigest()[:16]
+        return opj(self.root, f"sub-{job.participant}_ses-{job.session}_{key}")
+
+    def prepare(self, job_dir):
+        # leftovers of a killed run or a failed attempt
+        shutil.rmtree(job_dir, ignore_errors=True)
+        os.makedirs(job_dir)
+
+    def estimate(self, job):
+        """Bytes of scratch a job is expected to use, the size of its dicoms"""
+        try:
+            filelist = os.listdir(job.directory)
+        except OSError:
+            return 0
+        return directory_size(job.directory, filelist)
+
+    def fits(self, n_bytes, in_use):
+        return (
+            self.max_bytes is None or not in_use or in_use + n_bytes <= self.max_bytes
+        )
+
+    def collect(self, job_dir, out_path, success=True):
+        """Move the output of a job from job_dir into out_path, then remove job_dir.
+
+        Existing BIDS files are not overwritten, like dcm2bids without
+        --clobber. Of a failed job only the logs and sidecars in
+        tmp_dcm2bids are kept.
+        """
+        n_files = n_bytes = 0
+        try:
+            for dirpath, dirnames, filenames in os.walk(job_dir):
+                rel = os.path.relpath(dirpath, job_dir)
+                in_tmp = rel.split(os.sep)[0] == TMP_DIR_NAME
+                if rel == "." and not success:
+                    dirnames[:] = [d for d in dirnames if d == TMP_DIR_NAME]
+                    continue
+                dst_dir = os.path.normpath(opj(out_path, rel))
+                for f in filenames:
+                    if in_tmp and not f.endswith(TMP_KEEP_SUFFIXES):
+                        continue
+                    dst = opj(dst_dir, f)
+                    if not in_tmp and os.path.lexists(dst):
+                        logger.info("'%s' already exists", dst)
+                        continue
+                    src = opj(dirpath, f)
+                    os.makedirs(dst_dir, exist_ok=True)
+                    n_bytes += os.path.getsize(src)
+                    shutil.move(src, dst)
+                    n_files += 1
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+        METRICS.count("scratch_files_moved", n_files)
+        METRICS.count("scratch_bytes_moved", n_bytes)
+        return n_files, n_bytes
@@ -0,0 +1,76 @@
+# %%
+import pandas as pd
+
+from .metrics import METRICS
+
+# dcm_info fields a session label is taken from, the first one set wins
+SESSION_DATES = ["study_date", "acquisition_date", "series_date", "content_date"]
+
+
+def series_frame(infos):
+    """DataFrame of the patient id, study uid and dates of dcm_infos, one row each.
+
+    Fields missing from a dcm_info, e.g. one indexed by an older version,
+    are empty.
+    """
+    frame = pd.DataFrame.from_records(
+        infos, columns=["id", "study_uid", *SESSION_DATES]
+    )
+    return frame.fillna("").astype(str)
+
+
+def derive_sessions(frame):
+    """Session label of every row of series_frame, None if it has no date.
+
+    Rows are grouped by (id, study_uid). A study is labeled with its
+    StudyDate, else the earliest AcquisitionDate, SeriesDate or ContentDate
+    of its series, so series acquired after midnight stay in the session of
+    their study. Rows without study_uid are a study of their own.
+    """
+    dates = frame[SESSION_DATES].apply(
+        lambda column: column.str.split(",")
+        .str[0]
+        .str.replace(r"[^0-9]", "", regex=True)
+    )
+    study = frame.study_uid.where(
+        frame.study_uid != "", "row-" + frame.index.astype(str)
+    )
+    earliest = dates.where(dates != "").groupby([frame["id"], study]).transform("min")
+    session = earliest[SESSION_DATES[0]]
+    for column in SESSION_DATES[1:]:
+        session = session.where(session.notna(), earliest[column])
+    return [s if isinstance(s, str) else None for s in session]
+
+
+class StudySessions:
+    """Session labels of the studies seen so far, stored in the scan index.
+
+    A study keeps the label it got first, so its series found in a later
+    batch or run join the same session.
+    """
+
+    def __init__(self, scan_index):
+        self.scan_index = scan_index
+        self._labels = scan_index.load_studies()
+
+    def assign(self, infos):
+        """Session label, or None, for each of the dcm_infos"""
+        if not infos:
+            return []
+        with METRICS.stage("sessions"):
+            frame = series_frame(infos)
+            derived = derive_sessions(frame)
+        labels = []
+        new = []
+        for patient, study, label in zip(frame["id"], frame.study_uid, derived):
+            if study != "":
+                known = self._labels.get((patient, study))
+                if known is not None:
+                    label = known
+                elif label is not None:
+                    self._labels[(patient, study)] = label
+                    new.append((patient, study, label))
+            labels.append(label)
+        if new:
+            self.scan_index.record_studies(new)
+        return labels
@@ -0,0 +1,121 @@
+# %%
+import glob
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join as opj
+
+import pandas as pd
+
+try:
+    # optional, several times faster than the standard library parser
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_FIELDS = [
+    "PatientName",
+    "PatientID",
+    "PatientBirthDate",
+    "PatientAge",
+    "PatientSex",
+    "AcquisitionDateTime",
+    "DeviceSerialNumber",
+]
+
+
+def find_sidecars(out_path, participant_ids):
+    """Return {sidecar path: participant_id} for sub-*/ses-*/<datatype>/*.json"""
+    participant_ids = set(participant_ids)
+    sidecars = {}
+    for js in glob.glob(opj(out_path, "*", "*", "*", "*.json")):
+        pat = os.path.relpath(js, out_path).split(os.sep)[0]
+        if pat in participant_ids:
+            sidecars[js] = pat
+    return sidecars
+
+
+def read_sidecar(path, fields=SIDECAR_FIELDS):
+    """(mtime_ns, {field: value}) with only the requested fields of a sidecar"""
+    mtime_ns = os.stat(path).st_mtime_ns
+    METRICS.count("sidecars_read")
+    try:
+        with open(path, "rb") as f:
+            data = _loads(f.read())
+    except (OSError, ValueError) as e:
+        logger.warning("%s: Could not read sidecar: %s", path, e)
+        data = {}
+    return mtime_ns, {field: data[field] for field in fields if field in data}
+
+
+def harvest_sidecars(
+    out_path, participant_ids, fields=SIDECAR_FIELDS, cache=None, max_workers=8
+):
+    """Collect the sidecar fields of every participant into one DataFrame.
+
+    Returns one row per participant_id with sidecars and one column per
+    field, holding the unique values joined by ';'. Sidecars are read in
+    parallel; with a ScanIndex as cache, sidecars whose mtime did not change
+    since the last run are not read again.
+    """
+    sidecars = find_sidecars(out_path, participant_ids)
+    paths = sorted(sidecars)
+    cached = cache.load_sidecars() if cache is not None else {}
+
+    def read(path):
+        if path in cached:
+            mtime_ns, values = cached[path]
+            if os.stat(path).st_mtime_ns == mtime_ns:
+                return path, mtime_ns, values, False
+        return (path, *read_sidecar(path, fields), True)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        harvested = list(pool.map(read, paths))
+
+    if cache is not None:
+        cache.store_sidecars(
+            [
+                (path, mtime_ns, values)
+                for path, mtime_ns, values, new in harvested
+                if new
+            ]
+        )
+
+    long = pd.DataFrame(
+        [
+            (sidecars[path], field, str(value))
+            for path, _, values, _ in harvested
+            for field, value in values.items()
+            if field in fields
+        ],
+        columns=["participant_id", "field", "value"],
+    )
+    is_datetime = long.field == "AcquisitionDateTime"
+    long.loc[is_datetime, "value"] = (
+        long.loc[is_datetime, "value"].str.split("T").str[0]
+    )
+    long = long.drop_duplicates()
+
+    wide = (
+        long.groupby(["participant_id", "field"], sort=False)["value"]
+        .agg(";".join)
+        .unstack("field")
+        .reindex(columns=fields)
+        .reset_index()
+    )
+    wide.columns.name = None
+    return wide
+
+
+def enrich_participants(participants, harvested, fields=SIDECAR_FIELDS):
+    """Merge harvested sidecar fields into participants, replacing old values"""
+    participants = participants.drop(
+        columns=[field for field in fields if field in participants.columns]
+    )
+    participants = participants.merge(harvested, on="participant_id", how="left")
+    participants[fields] = participants[fields].fillna("")
+    return participants
@@ -1,11 +1,38 @@
 # %%
+import argparse
+import logging
 import os
+import shutil
+import sys
+from collections import Counter
 import pydicom  # pydicom is using the gdcm package for decompression
-import tqdm
-import multiprocessing
 from os.path import join as opj
-from tqdm.contrib.concurrent import process_map  # or thread_map
-import pickle
+from tqdm.contrib.concurrent import process_map, thread_map
+
+from .classify import UNCOMPRESSED_TRANSFER_SYNTAXES, classify_file
+from .discovery import DEFAULT_WORKERS, discover
+from .metrics import setup_logging
+from .probe import is_candidate
+
+logger = logging.getLogger(__name__)
+
+# header tags needed to build the destination path
+STRUCTURE_TAGS = [
+    "PatientID",
+    "StudyDate",
+    "StudyDescription",
+    "SeriesDescription",
+    "Modality",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "InstanceNumber",
+]
+
+# --decompress modes: only what dcm2niix can not read, everything, nothing
+DECOMPRESS_MODES = ["auto", "all", "none"]
+# files are written under this suffix and renamed when complete, so a killed
+# run never leaves a truncated file that counts as already structured
+PART_SUFFIX = ".part"
 
 
 # %%
@@ -17,94 +44,244 @@ def clean_text(string):
     return string.lower()
 
 
-# %%
-# user specified parameters
-src = "/media/NAS99/Data/dicoms/Horos Data/DATABASE.noindex"
-dst = "/media/NAS99/Data/all_lab_data/sourcedata"
-
-print("reading file list...")
-unsortedList = []
-for root, dirs, files in os.walk(src):
-    for file in tqdm.tqdm(files):
-        _, ext = os.path.splitext(file)
-        if ext == ".dcm" or ext == "":  # exclude non-dicoms, good for messy folders
-            unsortedList.append(os.path.join(root, file))
-
-print("%s files found." % len(unsortedList))
-# %%
+def examine(dicom_loc, dst):
+    """(destination, DicomFile) of a file, None if it is no dicom"""
+    dicom_file, ds = classify_file(dicom_loc, STRUCTURE_TAGS)
+    if dicom_file is None:
+        return None
+    return destination(ds, dst), dicom_file
 
-with open("all_dicoms.pkl", "wb") as fp:  # Pickling
-    pickle.dump(unsortedList, fp)
-# def create_folders(dicom_loc):
-#     # for dicom_loc in tqdm.tqdm(unsortedList):
-#     # read the file
-#     ds = pydicom.read_file(dicom_loc, force=True)
 
-#     # get patient, study, and series information
-#     patientID = clean_text(ds.get("PatientID", "NA"))
-#     studyDate = clean_text(ds.get("StudyDate", "NA"))
-#     studyDescription = clean_text(ds.get("StudyDescription", "NA"))
-#     seriesDescription = clean_text(ds.get("SeriesDescription", "NA"))
+def destination(ds, dst):
+    """Destination path of a dicom header in the 4-tier nested folder structure"""
 
-#     # generate new, standardized file name
-#     modality = ds.get("Modality", "NA")
-#     studyInstanceUID = ds.get("StudyInstanceUID", "NA")
-#     seriesInstanceUID = ds.get("SeriesInstanceUID", "NA")
-#     instanceNumber = str(ds.get("InstanceNumber", "0"))
-#     fileName = modality + "." + seriesInstanceUID + "." + instanceNumber + ".dcm"
+    # get patient, study, and series information
+    patientID = clean_text(str(ds.get("PatientID", "NA")))
+    studyDate = clean_text(str(ds.get("StudyDate", "NA")))
+    studyDescription = clean_text(str(ds.get("StudyDescription", "NA")))
+    seriesDescription = clean_text(str(ds.get("SeriesDescription", "NA")))
 
-#     return opj(dst, patientID, studyDate, studyDescription, seriesDescription, fileName)
+    # generate new, standardized file name
+    modality = str(ds.get("Modality", "NA"))
+    seriesInstanceUID = str(ds.get("SeriesInstanceUID", "NA"))
+    instanceNumber = str(ds.get("InstanceNumber", "0"))
+    fileName = modality + "." + seriesInstanceUID + "." + instanceNumber + ".dcm"
 
+    return opj(dst, patientID, studyDate, studyDescription, seriesDescription, fileName)
 
-# %%
-# fileNames = process_map(create_folders, unsortedList, max_workers=2, chunksize=100)
 
-# with multiprocessing.Pool(processes=22) as pool:
-#     fileNames = pool.map(create_folders, unsortedList)
+def decompress_file(pair):
+    dicom_loc, dst_name = pair
+    ds = pydicom.dcmread(dicom_loc, force=True)
+    # uncompress files (using the gdcm package)
+    try:
+        if ds.file_meta.TransferSyntaxUID.is_compressed:
+            ds.decompress()
+        elif ds.file_meta.TransferSyntaxUID not in UNCOMPRESSED_TRANSFER_SYNTAXES:
+            # deflated, inflated while reading and deflated again when saving
+            ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    except Exception:
+        logger.warning("an instance in file %s could not be decompressed.", dicom_loc)
+    ds.save_as(dst_name + PART_SUFFIX)
+    os.replace(dst_name + PART_SUFFIX, dst_name)
 
-# %%
-# for f in fileNames:
-#     # save files to a 4-tier nested folder structure
-#     foldername = os.path.dirname(f)
-#     os.makedirs(foldername, exist_ok=True)
 
-# %%
-for dicom_loc in tqdm.tqdm(unsortedList):
-    # read the file
-    ds = pydicom.read_file(dicom_loc, force=True)
+def transfer_file(pair, link=False):
+    dicom_loc, dst_name = pair
+    if link:
+        try:
+            os.link(dicom_loc, dst_name)
+            return
+        except OSError:
+            # e.g. source and destination on different file systems
+            pass
+    shutil.copy2(dicom_loc, dst_name + PART_SUFFIX)
+    os.replace(dst_name + PART_SUFFIX, dst_name)
 
-    # get patient, study, and series information
-    patientID = clean_text(ds.get("PatientID", "NA"))
-    studyDate = clean_text(ds.get("StudyDate", "NA"))
-    studyDescription = clean_text(ds.get("StudyDescription", "NA"))
-    seriesDescription = clean_text(ds.get("SeriesDescription", "NA"))
 
-    # generate new, standardized file name
-    modality = ds.get("Modality", "NA")
-    studyInstanceUID = ds.get("StudyInstanceUID", "NA")
-    seriesInstanceUID = ds.get("SeriesInstanceUID", "NA")
-    instanceNumber = str(ds.get("InstanceNumber", "0"))
-    fileName = modality + "." + seriesInstanceUID + "." + instanceNumber + ".dcm"
+def route(examined, mode="auto"):
+    """Split (dicom_loc, dst_name, DicomFile) into files to decompress and to transfer"""
+    to_decompress, to_transfer = [], []
+    for dicom_loc, dst_name, dicom_file in examined:
+        if mode == "all":
+            decompress = dicom_file.compressed
+        elif mode == "auto":
+            decompress = dicom_file.needs_decompression
+        else:
+            decompress = False
+        (to_decompress if decompress else to_transfer).append(
+            (dicom_loc, dst_name, dicom_file)
+        )
+    return to_decompress, to_transfer
 
-    # uncompress files (using the gdcm package)
-    try:
-        ds.decompress()
-    except:
-        print(
-            'an instance in file %s - %s - %s - %s" could not be decompressed. exiting.'
-            % (patientID, studyDate, studyDescription, seriesDescription)
+
+def log_transfer_syntaxes(examined, to_decompress):
+    counts = Counter(dicom_file.transfer_syntax for _, _, dicom_file in examined)
+    decompressed = Counter(
+        dicom_file.transfer_syntax for _, _, dicom_file in to_decompress
+    )
+    for transfer_syntax, n in counts.most_common():
+        logger.info(
+            "%s files %s (%s), %s to decompress.",
+            n,
+            pydicom.uid.UID(transfer_syntax).name,
+            transfer_syntax,
+            decompressed[transfer_syntax],
         )
+    multiframe = [d for _, _, d in examined if d.n_frames > 1]
+    if multiframe:
+        logger.info(
+            "%s multiframe files with %s frames.",
+            len(multiframe),
+            sum(d.n_frames for d in multiframe),
+        )
+
+
+def structure(
+    src,
+    dst,
+    n_jobs=None,
+    decompress="auto",
+    link=False,
+    chunksize=64,
+    decompress_jobs=None,
+):
+    """Sort the dicoms below src into dst/patient/study date/study/series.
 
-    dst_name = os.path.join(
-        dst, patientID, studyDate, studyDescription, seriesDescription, fileName
+    Files are recognized by their preamble, whatever their extension. With
+    decompress "auto", only files in a transfer syntax dcm2niix can not read
+    are decompressed, all others are copied or linked as they are.
+    """
+    n_jobs = n_jobs or os.cpu_count()
+    decompress_jobs = decompress_jobs or n_jobs
+
+    logger.info("reading file list...")
+    unsortedList = []
+    for root, files in discover(src, DEFAULT_WORKERS):
+        for file in files:
+            if is_candidate(file):  # exclude non-dicoms, good for messy folders
+                unsortedList.append(os.path.join(root, file))
+    logger.info("%s files found.", len(unsortedList))
+
+    # headers are read in parallel worker processes
+    examined = process_map(
+        examine,
+        unsortedList,
+        [dst] * len(unsortedList),
+        max_workers=n_jobs,
+        chunksize=chunksize,
+        desc="reading headers",
     )
 
-    foldername = os.path.dirname(dst_name)
-    os.makedirs(foldername, exist_ok=True)
+    todo = []
+    for dicom_loc, result in zip(unsortedList, examined):
+        if result is None:
+            logger.debug("%s is no dicom, skipping.", dicom_loc)
+        elif os.path.exists(result[0]):
+            # already structured by a previous run
+            continue
+        else:
+            todo.append((dicom_loc, *result))
+    logger.info("%s files left to structure.", len(todo))
+
+    to_decompress, to_transfer = route(todo, decompress)
+    log_transfer_syntaxes(todo, to_decompress)
+
+    for foldername in sorted({os.path.dirname(p[1]) for p in todo}):
+        os.makedirs(foldername, exist_ok=True)
 
     # save files to a 4-tier nested folder structure
-    ds.save_as(dst_name)
+    if to_decompress:
+        # the whole pixel data of a file is held in memory, so at most
+        # decompress_jobs files at a time, the largest first
+        to_decompress.sort(key=lambda p: -p[2].n_frames)
+        process_map(
+            decompress_file,
+            [p[:2] for p in to_decompress],
+            max_workers=decompress_jobs,
+            chunksize=1,
+            desc="decompressing",
+        )
+    if to_transfer:
+        # no transcoding, so a plain copy or hard link of the original file
+        thread_map(
+            transfer_file,
+            [p[:2] for p in to_transfer],
+            [link] * len(to_transfer),
+            max_workers=n_jobs,
+            desc="linking" if link else "copying",
+        )
+
+    logger.info("done.")
+
+
+# %%
+def main_wrapper():
+    """Load arguments for structure"""
+    parser = argparse.ArgumentParser(
+        description="""Sort a messy folder of dicoms into a patient/study date/study/series tree""",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--dicom_path",
+        required=True,
+        help="directory containing the unsorted dicom files, e.g. a Horos DATABASE.noindex",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--out_path",
+        required=True,
+        help="sourcedata directory the patient/date/study/series tree is written to",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of worker processes, defaults to the number of cores",
+    )
+
+    parser.add_argument(
+        "--decompress",
+        nargs="?",
+        choices=DECOMPRESS_MODES,
+        default="auto",
+        const="all",
+        help="auto (default): decompress (using gdcm) only files in a transfer syntax dcm2niix can not read and copy the others as they are. all (also --decompress without a value): decompress every compressed file. none: copy every file as it is",
+    )
+
+    parser.add_argument(
+        "--decompress-jobs",
+        type=int,
+        default=None,
+        help="number of files decompressed at the same time, defaults to --jobs. Decompression holds the whole pixel data of a file in memory",
+    )
+
+    parser.add_argument(
+        "--link",
+        action="store_true",
+        help="hard link instead of copying files when not decompressing, falls back to copying across file systems",
+    )
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        return 0
+
+    args = parser.parse_args()
+    setup_logging()
+    return structure(
+        os.path.abspath(args.dicom_path),
+        os.path.abspath(args.out_path),
+        args.jobs,
+        args.decompress,
+        args.link,
+        decompress_jobs=args.decompress_jobs,
+    )
 
-print("done.")
 
 # %%
+if __name__ == "__main__":
+    sys.exit(main_wrapper())
@@ -0,0 +1,140 @@
+# %%
+import logging
+import os
+from os.path import join as opj
+
+from .discovery import DEFAULT_WORKERS, discover
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+
+def parse_ids(ids):
+    """participant_ids from --id values, which may also be comma separated"""
+    if not ids:
+        return None
+    if isinstance(ids, str):
+        ids = [ids]
+    parsed = []
+    for value in ids:
+        for id_ in str(value).split(","):
+            id_ = id_.strip()
+            if id_ and id_ not in parsed:
+                parsed.append(id_ if id_.startswith("sub-") else "sub-" + id_)
+    return parsed or None
+
+
+def top_level(dicom_path, directory):
+    """The folder directly below dicom_path that contains directory"""
+    rel = os.path.relpath(directory, dicom_path)
+    if rel == "." or rel.startswith(".."):
+        return directory
+    return opj(dicom_path, rel.split(os.sep)[0])
+
+
+def depth_below(dicom_path, directory):
+    rel = os.path.relpath(directory, dicom_path)
+    if rel == "." or rel.startswith(".."):
+        return 0
+    return len(rel.split(os.sep))
+
+
+def search_subjects(
+    planner, dicom_path, bids_ids, discovery_workers, max_depth, ignore
+):
+    """{bids_id: [folders below dicom_path]} holding dicoms of the subjects.
+
+    Walks dicom_path reading one header per directory. A subject with
+    several PatientIDs usually has several folders, so the whole tree is
+    searched. Only the rest of a folder found for all bids_ids is not read.
+    """
+    bids_ids = set(bids_ids)
+    found = {}
+    # folder below dicom_path -> subjects found in it
+    matched = {}
+
+    def unsettled(walk):
+        for directory, filelist in walk:
+            if matched.get(top_level(dicom_path, directory), set()) >= bids_ids:
+                continue
+            yield directory, filelist
+
+    walk = discover(dicom_path, discovery_workers, max_depth, ignore)
+    with METRICS.stage("search"):
+        for directory, bids_id in planner.locate(unsettled(walk)):
+            if bids_id not in bids_ids:
+                continue
+            folder = top_level(dicom_path, directory)
+            if bids_id in matched.setdefault(folder, set()):
+                continue
+            logger.info("%s: Found dicoms of %s", directory, bids_id)
+            matched[folder].add(bids_id)
+            found.setdefault(bids_id, []).append(folder)
+    return found
+
+
+def walk_roots(dicom_path, folders, directories, discovery_workers, max_depth, ignore):
+    """discover() over whole folders and single directories, each listed once"""
+    folders = sorted(set(folders))
+    roots = [
+        f
+        for f in folders
+        if not any(f != o and f.startswith(o.rstrip(os.sep) + os.sep) for o in folders)
+    ]
+    for root in roots:
+        depth = None
+        if max_depth is not None:
+            depth = max(max_depth - depth_below(dicom_path, root), 0)
+        yield from discover(root, discovery_workers, depth, ignore)
+    for directory in sorted(set(directories)):
+        if any(directory.startswith(r.rstrip(os.sep) + os.sep) for r in roots):
+            continue
+        yield from discover(directory, 1, 0)
+
+
+def walk_subjects(
+    planner, dicom_path, discovery_workers=DEFAULT_WORKERS, max_depth=None, ignore=None
+):
+    """Walk only where the planner's subjects are, or all of dicom_path.
+
+    Locations come from the folder_path column of participants.tsv and the
+    directories the scan index assigned to a subject. Subjects without any
+    are searched for, and their folder_path is stored for the next run.
+    """
+    if planner.subjects is None or planner.catch_all is not None:
+        yield from discover(dicom_path, discovery_workers, max_depth, ignore)
+        return
+
+    folders, directories, missing = [], [], []
+    for bids_id in sorted(planner.subjects):
+        subject_folders, subject_directories = planner.known_locations(bids_id)
+        if not (subject_folders or subject_directories):
+            missing.append(bids_id)
+        folders += subject_folders
+        directories += subject_directories
+
+    if missing:
+        logger.info(
+            "Searching %s for %s, their location is unknown...",
+            dicom_path,
+            ", ".join(missing),
+        )
+        found = search_subjects(
+            planner, dicom_path, missing, discovery_workers, max_depth, ignore
+        )
+        for bids_id in missing:
+            if bids_id not in found:
+                logger.warning("Did not find dicoms of %s in %s", bids_id, dicom_path)
+                continue
+            planner.set_folder_path(bids_id, found[bids_id])
+            folders += found[bids_id]
+
+    logger.info(
+        "Converting %d folders and %d directories of %d subjects",
+        len(set(folders)),
+        len(set(directories)),
+        len(planner.subjects),
+    )
+    yield from walk_roots(
+        dicom_path, folders, directories, discovery_workers, max_depth, ignore
+    )
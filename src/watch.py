@@ -0,0 +1,275 @@
+# %%
+import logging
+import os
+import time
+
+try:
+    # optional, without it dicom_path is polled
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from .discovery import DEFAULT_WORKERS, discover, is_ignored
+from .metrics import METRICS
+from .scan_index import dir_fingerprint
+from .subjects import depth_below
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUIESCENCE = 60
+DEFAULT_POLL_INTERVAL = 30
+DEFAULT_WRITE_INTERVAL = 300
+
+
+def content_signature(directory):
+    """(file count, total size, newest mtime) of the files in directory"""
+    n_files = n_bytes = newest = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                n_files += 1
+                n_bytes += st.st_size
+                newest = max(newest, st.st_mtime_ns)
+    return n_files, n_bytes, newest
+
+
+def list_files(directory):
+    with os.scandir(directory) as it:
+        return sorted(entry.name for entry in it if not entry.is_dir())
+
+
+class Quiescence:
+    """Directories waiting until they did not change for quiet_seconds.
+
+    Every change restarts the wait of a directory. Before a directory is
+    released, the sizes and mtimes of its files are compared to those at the
+    first change, so files still being written keep it waiting also when
+    the watcher only notices new or removed files.
+    """
+
+    def __init__(self, quiet_seconds=DEFAULT_QUIESCENCE, clock=time.monotonic):
+        self.quiet_seconds = quiet_seconds
+        self.clock = clock
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def touch(self, directory):
+        _, signature = self._pending.get(directory, (None, None))
+        if signature is None:
+            signature = self._signature(directory)
+        self._pending[directory] = (self.clock(), signature)
+
+    def ready(self):
+        """Pop the directories that were quiet long enough"""
+        now = self.clock()
+        released = []
+        for directory, (changed, signature) in list(self._pending.items()):
+            if now - changed < self.quiet_seconds:
+                continue
+            current = self._signature(directory)
+            if current is None:
+                # removed again
+                del self._pending[directory]
+            elif current != signature:
+                self._pending[directory] = (now, current)
+            else:
+                del self._pending[directory]
+                released.append(directory)
+        return released
+
+    @staticmethod
+    def _signature(directory):
+        try:
+            return content_signature(directory)
+        except OSError:
+            return None
+
+
+class PollingWatcher:
+    """Find changed directories by listing the tree every poll_interval seconds.
+
+    A directory counts as changed when its fingerprint (mtime, inode and
+    file count) differs from the last listing, so new, removed or renamed
+    files are noticed with one stat per directory.
+    """
+
+    def __init__(
+        self,
+        root,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        discovery_workers=DEFAULT_WORKERS,
+        max_depth=None,
+        ignore=None,
+    ):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.discovery_workers = discovery_workers
+        self.max_depth = max_depth
+        self.ignore = ignore
+        self._seen = {}
+        self._next_poll = None
+
+    def _walk(self):
+        for directory, filelist in discover(
+            self.root, self.discovery_workers, self.max_depth, self.ignore
+        ):
+            try:
+                fingerprint = dir_fingerprint(directory, filelist)
+            except OSError:
+                continue
+            yield directory, filelist, fingerprint
+
+    def start(self):
+        """Walk the tree once, yields (directory, filelist) like discover()"""
+        for directory, filelist, fingerprint in self._walk():
+            self._seen[directory] = fingerprint
+            yield directory, filelist
+        self._next_poll = time.monotonic() + self.poll_interval
+
+    def changes(self, timeout):
+        """Directories changed since the last call, waits at most timeout seconds"""
+        wait = self._next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        changed = []
+        seen = {}
+        with METRICS.stage("watch_poll"):
+            for directory, filelist, fingerprint in self._walk():
+                seen[directory] = fingerprint
+                if filelist and self._seen.get(directory) != fingerprint:
+                    changed.append(directory)
+        self._seen = seen
+        self._next_poll = time.monotonic() + self.poll_interval
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Find changed directories with inotify, one watch per directory.
+
+    New directories are watched as soon as they are created and listed
+    right away, since files may land in them before the watch exists.
+    inotify does not see changes made by other hosts of a network file
+    system, use the PollingWatcher for those.
+    """
+
+    def __init__(
+        self, root, discovery_workers=DEFAULT_WORKERS, max_depth=None, ignore=None
+    ):
+        self.root = root
+        self.discovery_workers = discovery_workers
+        self.max_depth = max_depth
+        self.ignore = ignore
+        self._inotify = INotify()
+        self._mask = (
+            flags.CREATE
+            | flags.CLOSE_WRITE
+            | flags.MODIFY
+            | flags.MOVED_TO
+            | flags.MOVED_FROM
+            | flags.DELETE
+            | flags.DELETE_SELF
+        )
+        self._paths = {}
+        self._warned = False
+
+    def _add_tree(self, directory):
+        """Watch directory and everything below it, yields discover() items"""
+        depth = None
+        if self.max_depth is not None:
+            depth = self.max_depth - depth_below(self.root, directory)
+            if depth < 0:
+                return
+        for sub, filelist in discover(
+            directory, self.discovery_workers, depth, self.ignore
+        ):
+            try:
+                wd = self._inotify.add_watch(sub, self._mask)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                # usually fs.inotify.max_user_watches
+                if not self._warned:
+                    logger.warning(
+                        "%s: Could not watch directory, changes in it are missed: %s",
+                        sub,
+                        e,
+                    )
+                    self._warned = True
+                METRICS.count("watch_errors")
+                yield sub, filelist
+                continue
+            self._paths[wd] = sub
+            yield sub, filelist
+
+    def start(self):
+        """Watch the tree, yields (directory, filelist) like discover()"""
+        yield from self._add_tree(self.root)
+        logger.info("Watching %d directories with inotify", len(self._paths))
+
+    def changes(self, timeout):
+        """Directories changed since the last call, waits at most timeout seconds"""
+        changed = set()
+        for event in self._inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, listing %s again", self.root)
+                changed.update(d for d, files in self._rewatch() if files)
+                continue
+            directory = self._paths.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & flags.IGNORED:
+                del self._paths[event.wd]
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO) and not (
+                    self.ignore and is_ignored(path, self.root, self.ignore)
+                ):
+                    changed.update(d for d, files in self._add_tree(path) if files)
+                continue
+            if event.name:
+                changed.add(directory)
+        METRICS.count("watch_events", len(changed))
+        return sorted(changed)
+
+    def _rewatch(self):
+        for wd in list(self._paths):
+            try:
+                self._inotify.rm_watch(wd)
+            except OSError:
+                pass
+        self._paths.clear()
+        return self._add_tree(self.root)
+
+    def close(self):
+        self._inotify.close()
+
+
+def make_watcher(
+    root,
+    poll=False,
+    poll_interval=DEFAULT_POLL_INTERVAL,
+    discovery_workers=DEFAULT_WORKERS,
+    max_depth=None,
+    ignore=None,
+):
+    """An InotifyWatcher if inotify_simple is installed and poll is not set,
+    else a PollingWatcher"""
+    if not poll and INotify is None:
+        logger.warning(
+            "inotify_simple is not installed, polling %s every %s s",
+            root,
+            poll_interval,
+        )
+        poll = True
+    if poll:
+        return PollingWatcher(root, poll_interval, discovery_workers, max_depth, ignore)
+    return InotifyWatcher(root, discovery_workers, max_depth, ignore)